@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Compares the annotation table parsers against the original row by row
+# (DataFrame.iterrows) implementations on synthetic full-size KEGG tables
+# -----------------------------------------------------------------------------
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+import pandas as pd
+
+from qp_shogun.shogun.utils import (
+    shogun_parse_enzyme_table, shogun_parse_module_table,
+    shogun_parse_pathway_table)
+
+
+def iterrows_parse_enzyme_table(f):
+    md = pd.read_csv(
+        f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
+    md.set_index(0, inplace=True)
+    metadata = {}
+    for i, row in md.iterrows():
+        metadata[i] = {'taxonomy': [x for x in row.values]}
+    return metadata
+
+
+def iterrows_parse_module_table(f):
+    md = pd.read_csv(
+        f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
+    metadata = {}
+    for i, row in md.iterrows():
+        module = row[4].split('  ')[0]
+        name = row[4].split('  ')[1]
+        if module not in metadata:
+            metadata[module] = {'taxonomy': [row[1], row[2], row[3], name]}
+    return metadata
+
+
+def iterrows_parse_pathway_table(f):
+    md = pd.read_csv(
+        f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
+    metadata = {}
+    for i, row in md.iterrows():
+        pathway = row[4]
+        if pathway not in metadata:
+            metadata[pathway] = {'taxonomy': [row[1], row[2], row[3]]}
+    return metadata
+
+
+def write_tables(out_dir, n_rows):
+    """Writes synthetic enzyme, module and pathway annotation tables
+
+    The shape follows the KEGG tables shipped with the Shogun databases:
+    KO ids are repeated across rows, as are modules and pathways.
+    """
+    fps = {}
+    fps['enzyme'] = join(out_dir, 'ko-enzyme-annotations.txt')
+    with open(fps['enzyme'], 'w') as f:
+        for i in range(n_rows):
+            f.write('K%05d\t"%d. Class"\t"%d.%d  Subclass"\t'
+                    '"%d.%d.%d  Group"\t"%d.%d.%d.%d  enzyme %d"\n'
+                    % (i, i % 7, i % 7, i % 20, i % 7, i % 20, i % 50,
+                       i % 7, i % 20, i % 50, i, i))
+    fps['module'] = join(out_dir, 'ko-module-annotations.txt')
+    with open(fps['module'], 'w') as f:
+        for i in range(n_rows):
+            f.write('K%05d\t"Pathway module"\t"Category %d"\t"Subcategory %d"'
+                    '\t"M%05d  Module %d biosynthesis [PATH:map%05d]"\n'
+                    % (i // 3, i % 10, i % 40, i % 900, i % 900, i % 900))
+    fps['pathway'] = join(out_dir, 'ko-pathway-annotations.txt')
+    with open(fps['pathway'], 'w') as f:
+        for i in range(n_rows):
+            f.write('K%05d\t"Metabolism"\t"%d. Class"\t"%d.%d  Subclass"\t'
+                    '"%d.%d.%d  Pathway"\n'
+                    % (i // 3, i % 7, i % 7, i % 20, i % 7, i % 20, i % 500))
+    return fps
+
+
+def _time(func, fp, repeats):
+    best = None
+    for _ in range(repeats):
+        start = perf_counter()
+        result = func(fp)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+@click.command()
+@click.option('--rows', default=100000, show_default=True,
+              help='Number of rows of each synthetic table')
+@click.option('--repeats', default=3, show_default=True,
+              help='Best of this many runs is reported')
+def bench(rows, repeats):
+    """Benchmarks the annotation table parsers"""
+    parsers = [
+        ('enzyme', iterrows_parse_enzyme_table, shogun_parse_enzyme_table),
+        ('module', iterrows_parse_module_table, shogun_parse_module_table),
+        ('pathway', iterrows_parse_pathway_table,
+         shogun_parse_pathway_table)]
+    with TemporaryDirectory() as out_dir:
+        fps = write_tables(out_dir, rows)
+        click.echo('table\trows\titerrows (s)\tvectorized (s)\tspeedup')
+        for name, old, new in parsers:
+            old_time, old_md = _time(old, fps[name], repeats)
+            new_time, new_md = _time(new, fps[name], repeats)
+            if old_md != new_md:
+                raise ValueError('The %s parsers disagree' % name)
+            click.echo('%s\t%d\t%.3f\t%.3f\t%.1fx' % (
+                name, rows, old_time, new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    bench()
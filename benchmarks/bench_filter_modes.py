@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Runs the QC_Filter modes on the same sample, reporting their time, peak
+# memory and disk writes, and checks that they keep the same read pairs
+# -----------------------------------------------------------------------------
+
+import gzip
+from hashlib import md5
+from os import environ, makedirs
+from os.path import join, getsize, basename, commonprefix
+from tempfile import TemporaryDirectory
+
+import click
+
+from synthetic import write_samples
+from qp_shogun.filter.filter import generate_filter_commands, FILTER_MODES
+from qp_shogun.utils import _system_call_with_metrics
+
+
+def _read_name(header):
+    # the name without the comment and the mate suffix
+    name = header[1:].split(None, 1)[0]
+    if name.endswith((b'/1', b'/2')):
+        name = name[:-2]
+    return name
+
+
+def check_pairs(fwd_fp, rev_fp):
+    """Checks that the mates of both files are in the same order
+
+    Returns the number of pairs and a digest of their names that doesn't
+    depend on their order, so the modes can be compared without holding the
+    names in memory.
+    """
+    n_pairs = 0
+    digest = 0
+    with gzip.open(fwd_fp, 'rb') as fwd, gzip.open(rev_fp, 'rb') as rev:
+        for i, (fwd_line, rev_line) in enumerate(zip(fwd, rev)):
+            if i % 4:
+                continue
+            name = _read_name(fwd_line)
+            if name != _read_name(rev_line):
+                raise ValueError('Mates out of order in pair %d: %s, %s'
+                                 % (n_pairs, fwd_line, rev_line))
+            digest ^= int(md5(name).hexdigest(), 16)
+            n_pairs += 1
+        if next(fwd, None) is not None or next(rev, None) is not None:
+            raise ValueError('The files have a different number of reads')
+
+    return n_pairs, digest
+
+
+@click.command()
+@click.option('--reads', default=20000000, show_default=True,
+              help='Read pairs of the synthetic sample (20M are ~3GB of '
+                   'compressed fastq)')
+@click.option('--fwd', type=click.Path(exists=True),
+              help='Forward reads to use instead of a synthetic sample')
+@click.option('--rev', type=click.Path(exists=True),
+              help='Reverse reads to use with --fwd')
+@click.option('--db', help='Bowtie2 database, phix in QC_FILTER_DB_DP by '
+                           'default')
+@click.option('--threads', default=4, show_default=True)
+@click.option('--mode', 'modes', multiple=True,
+              type=click.Choice(FILTER_MODES), default=FILTER_MODES,
+              show_default=True)
+@click.option('--work-dir', default=None,
+              help='Where the sample and outputs are written')
+def bench(reads, fwd, rev, db, threads, modes, work_dir):
+    """Benchmarks the QC_Filter modes"""
+    if db is None:
+        db = join(environ['QC_FILTER_DB_DP'], 'phix', 'phix')
+    params = {'Bowtie2 database to filter': db,
+              'Number of threads': str(threads)}
+
+    with TemporaryDirectory(dir=work_dir) as out_dir:
+        if fwd is None:
+            click.echo('Generating %d read pairs...' % reads)
+            samples, map_fp, _ = write_samples(out_dir, 1, reads)
+            fwd, rev = samples[0][2:]
+        else:
+            map_fp = join(out_dir, 'mapping_file.txt')
+            with open(map_fp, 'w') as f:
+                f.write('#SampleID\trun_prefix\nsample.0\t%s\n'
+                        % commonprefix([basename(fwd), basename(rev)]))
+        click.echo('Input: %.1f MB' % ((getsize(fwd) + getsize(rev)) / 1e6))
+
+        click.echo('mode\tseconds\tCPU seconds\tpeak RSS MB\twritten MB\t'
+                   'pairs')
+        results = {}
+        for mode in modes:
+            mode_dir = join(out_dir, mode)
+            temp_dir = join(mode_dir, 'temp')
+            makedirs(temp_dir)
+            cmds, samples = generate_filter_commands(
+                [fwd], [rev], map_fp, mode_dir, temp_dir, params, mode=mode)
+            std_out, std_err, return_value, metrics = \
+                _system_call_with_metrics(cmds[0])
+            if return_value != 0:
+                raise click.ClickException(
+                    'The %s mode failed:\n%s' % (mode, std_err))
+            sample = samples[0][1]
+            results[mode] = check_pairs(
+                join(mode_dir, '%s.R1.fastq.gz' % sample),
+                join(mode_dir, '%s.R2.fastq.gz' % sample))
+            click.echo('%s\t%.1f\t%.1f\t%.1f\t%.1f\t%d' % (
+                mode, metrics['wall_time'],
+                metrics['user_time'] + metrics['system_time'],
+                metrics['max_rss'] / 1e6, metrics['written_bytes'] / 1e6,
+                results[mode][0]))
+
+        if len(set(results.values())) > 1:
+            raise click.ClickException('The modes kept different read pairs')
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Runs QC_Trim, QC_Filter and Shogun end to end without a Qiita server or the
+# external tools, which are replaced by the stubs in stub_tool.py, and reports
+# the time each job spends outside of the tools: the plugin's orchestration
+# overhead
+# -----------------------------------------------------------------------------
+
+from os import environ, makedirs, pathsep
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+
+from offline import (LocalQiita, install_stub_tools, write_databases,
+                     read_tool_log)
+from synthetic import write_samples
+
+
+def _modes(modes, option):
+    # The modes to run, all the plugin's by default; qp_shogun can only be
+    # imported once the databases exist, so they aren't click choices
+    from qp_shogun.filter.filter import FILTER_MODES
+    from qp_shogun.shogun.shogun import FNA_MODES
+    valid = {'--filter-mode': FILTER_MODES, '--fna-mode': FNA_MODES}[option]
+    for mode in modes:
+        if mode not in valid:
+            raise click.BadParameter(
+                '%s is not one of %s' % (mode, ', '.join(valid)),
+                param_hint=option)
+    return modes or valid
+
+
+def _jobs(commands, filter_modes, fna_modes):
+    # (name, command, environment) of each job to run
+    filter_modes = _modes(filter_modes, '--filter-mode')
+    fna_modes = _modes(fna_modes, '--fna-mode')
+    jobs = []
+    if 'trim' in commands:
+        jobs.append(('trim', 'trim', {}))
+    if 'filter' in commands:
+        jobs.extend(('filter %s' % mode, 'filter', {'QC_FILTER_MODE': mode})
+                    for mode in filter_modes)
+    if 'shogun' in commands:
+        jobs.extend(('shogun %s' % mode, 'shogun',
+                     {'QC_SHOGUN_FNA_MODE': mode}) for mode in fna_modes)
+    return jobs
+
+
+def _parameters(command, filter_dp, shogun_dp, threads):
+    # qp_shogun reads the database locations when it is imported
+    if command == 'trim':
+        from qp_shogun.trim import dflt_param_set
+        parameters = {k: str(v) for k, v in
+                      dflt_param_set['KAPA HyperPlus with iTru'].items()}
+        parameters['Number of threads used'] = str(threads)
+    elif command == 'filter':
+        parameters = {
+            'Bowtie2 database to filter': join(filter_dp, 'phix', 'phix'),
+            'Number of threads': str(threads)}
+    else:
+        parameters = {'Database': join(shogun_dp, 'shogun'),
+                      'Aligner tool': 'bowtie2',
+                      'Number of threads': str(threads)}
+    parameters['input'] = 1
+    return parameters
+
+
+def run_job(command, qclient, parameters, out_dir):
+    """Runs a plugin command, returns its wall time"""
+    from qp_shogun.trim.trim import trim
+    from qp_shogun.filter.filter import filter
+    from qp_shogun.shogun.shogun import shogun
+    function = {'trim': trim, 'filter': filter, 'shogun': shogun}[command]
+
+    start = perf_counter()
+    success, _, msg = function(qclient, 'job-id', parameters, out_dir)
+    wall_time = perf_counter() - start
+    if not success:
+        raise click.ClickException('%s failed: %s' % (command, msg))
+    return wall_time
+
+
+@click.command()
+@click.option('--samples', 'n_samples', default=10, show_default=True)
+@click.option('--reads-per-sample', default=10000, show_default=True,
+              help='Read pairs of each synthetic sample')
+@click.option('--command', 'commands', multiple=True,
+              type=click.Choice(['trim', 'filter', 'shogun']),
+              default=['trim', 'filter', 'shogun'], show_default=True)
+@click.option('--filter-mode', 'filter_modes', multiple=True,
+              help='QC_FILTER_MODE, all of them by default')
+@click.option('--fna-mode', 'fna_modes', multiple=True,
+              help='QC_SHOGUN_FNA_MODE, all of them by default')
+@click.option('--delay', default=0.0, show_default=True,
+              help='Seconds each tool run sleeps, standing for its computing')
+@click.option('--latency', default=0.0, show_default=True,
+              help='Seconds each job step update to Qiita takes')
+@click.option('--threads', default=1, show_default=True)
+@click.option('--parallel-jobs', default=1, show_default=True,
+              help='QC_PARALLEL_JOBS')
+@click.option('--work-dir', default=None,
+              help='Where the samples and outputs are written')
+def bench(n_samples, reads_per_sample, commands, filter_modes, fna_modes,
+          delay, latency, threads, parallel_jobs, work_dir):
+    """Benchmarks the orchestration overhead of the plugin commands"""
+    with TemporaryDirectory(dir=work_dir) as tmp_dir:
+        bin_dir = join(tmp_dir, 'bin')
+        install_stub_tools(bin_dir)
+        filter_dp, shogun_dp = write_databases(tmp_dir)
+        jobs = _jobs(commands, filter_modes, fna_modes)
+        environ['PATH'] = bin_dir + pathsep + environ['PATH']
+        environ['STUB_DELAY'] = str(delay)
+        environ['QC_PARALLEL_JOBS'] = str(parallel_jobs)
+
+        samples_dir = join(tmp_dir, 'samples')
+        makedirs(samples_dir)
+        click.echo('Generating %d samples of %d read pairs...'
+                   % (n_samples, reads_per_sample))
+        samples, map_fp, n_bytes = write_samples(
+            samples_dir, n_samples, reads_per_sample)
+        files = {'raw_forward_seqs': [s[2] for s in samples],
+                 'raw_reverse_seqs': [s[3] for s in samples]}
+        click.echo('Input: %.1f MB' % (n_bytes / 1e6))
+
+        click.echo('job\tseconds\ttool seconds\ttool runs\toverhead seconds'
+                   '\toverhead ms/sample\tstep updates')
+        for i, (name, command, env) in enumerate(jobs):
+            job_dir = join(tmp_dir, 'job%d' % i)
+            out_dir = join(job_dir, 'output')
+            makedirs(out_dir)
+            log_fp = join(job_dir, 'tools.log')
+            environ['STUB_LOG'] = log_fp
+            environ.update(env)
+
+            qclient = LocalQiita(files, map_fp, latency)
+            wall_time = run_job(
+                command, qclient,
+                _parameters(command, filter_dp, shogun_dp, threads), out_dir)
+            busy, n_runs = read_tool_log(log_fp)
+            overhead = wall_time - busy
+            click.echo('%s\t%.2f\t%.2f\t%d\t%.2f\t%.1f\t%d' % (
+                name, wall_time, busy, n_runs, overhead,
+                1000 * overhead / n_samples, len(qclient.steps)))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Compares make_read_pairs_per_sample against the original matcher, which
+# tries every run prefix on every file, as the number of samples grows
+# -----------------------------------------------------------------------------
+
+from os.path import basename, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from itertools import zip_longest
+
+import click
+from qiita_client.util import get_sample_names_by_run_prefix
+
+from qp_shogun.utils import make_read_pairs_per_sample
+
+
+def startswith_make_read_pairs_per_sample(forward_seqs, reverse_seqs,
+                                          map_file):
+    # the pairing loop of the original implementation
+    forward_seqs.sort()
+    reverse_seqs.sort()
+    sn_by_rp = get_sample_names_by_run_prefix(map_file)
+    samples = []
+    used_prefixes = set()
+    for fwd_fp, rev_fp in zip_longest(forward_seqs, reverse_seqs):
+        fwd_fn = basename(fwd_fp)
+        run_prefix = None
+        for rp in sn_by_rp:
+            if fwd_fn.startswith(rp) and run_prefix is None:
+                run_prefix = rp
+            elif fwd_fn.startswith(rp) and run_prefix is not None:
+                raise ValueError('Multiple run prefixes match this fwd read: '
+                                 '%s' % fwd_fn)
+        if run_prefix is None:
+            raise ValueError('No run prefix matching this fwd read: %s'
+                             % fwd_fn)
+        if run_prefix in used_prefixes:
+            raise ValueError('This run prefix matches multiple fwd reads: '
+                             '%s' % run_prefix)
+        samples.append((run_prefix, sn_by_rp[run_prefix], fwd_fp, rev_fp))
+        used_prefixes.add(run_prefix)
+    return samples
+
+
+def write_study(out_dir, n_samples):
+    """Writes the mapping file of n_samples and returns the read filepaths
+
+    Run prefixes have different lengths, like in studies that mix runs,
+    and no files are written as the pairing only looks at their names.
+    """
+    map_fp = join(out_dir, 'mapping_file.txt')
+    fwd_fps = []
+    rev_fps = []
+    with open(map_fp, 'w') as f:
+        f.write('#SampleID\trun_prefix\n')
+        for i in range(n_samples):
+            run_prefix = 'study_%d_S%d' % (i, i % 384)
+            f.write('sample.%d\t%s\n' % (i, run_prefix))
+            fwd_fps.append('/data/%s_L001_R1_001.fastq.gz' % run_prefix)
+            rev_fps.append('/data/%s_L001_R2_001.fastq.gz' % run_prefix)
+    return map_fp, fwd_fps, rev_fps
+
+
+def _time(func, map_fp, fwd_fps, rev_fps):
+    start = perf_counter()
+    result = func(list(fwd_fps), list(rev_fps), map_fp)
+    return perf_counter() - start, result
+
+
+@click.command()
+@click.option('--samples', '-n', multiple=True, type=int,
+              default=[1000, 10000, 100000], show_default=True,
+              help='Number of samples of each run')
+@click.option('--max-original', default=10000, show_default=True,
+              help='Largest number of samples the original matcher, which '
+                   'is quadratic, is timed with')
+def bench(samples, max_original):
+    """Benchmarks make_read_pairs_per_sample"""
+    click.echo('samples\toriginal (s)\tindexed (s)\tspeedup')
+    for n_samples in samples:
+        with TemporaryDirectory() as out_dir:
+            map_fp, fwd_fps, rev_fps = write_study(out_dir, n_samples)
+            new_time, new_samples = _time(
+                make_read_pairs_per_sample, map_fp, fwd_fps, rev_fps)
+            if n_samples > max_original:
+                click.echo('%d\t-\t%.3f\t-' % (n_samples, new_time))
+                continue
+            old_time, old_samples = _time(
+                startswith_make_read_pairs_per_sample, map_fp, fwd_fps,
+                rev_fps)
+            if old_samples != new_samples:
+                raise ValueError('The matchers disagree with %d samples'
+                                 % n_samples)
+            click.echo('%d\t%.3f\t%.3f\t%.1fx' % (
+                n_samples, old_time, new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,137 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# This file contains what the commands need to run without a Qiita server or
+# the external tools: a stand-in for the Qiita client, the stub tools and
+# their databases
+# -----------------------------------------------------------------------------
+
+import sys
+from os import environ, makedirs, chmod
+from os.path import join, dirname, abspath
+from time import perf_counter, sleep
+
+STUB_TOOL = join(dirname(abspath(__file__)), 'stub_tool.py')
+STUB_TOOLS = ('atropos', 'bowtie2', 'samtools', 'bedtools', 'pigz', 'shogun')
+
+
+class LocalQiita(object):
+    """Answers the Qiita client calls the commands make
+
+    Parameters
+    ----------
+    files : dict of {str: list of str}
+        The artifact's filepaths, keyed by filepath type
+    map_fp : str
+        The artifact's mapping file
+    latency : float, optional
+        The seconds each step update takes, as the round trip to Qiita would
+
+    Attributes
+    ----------
+    steps : list of (float, str, str)
+        The time (perf_counter), job id and step of every step update
+    """
+    def __init__(self, files, map_fp, latency=0):
+        self.files = files
+        self.map_fp = map_fp
+        self.latency = latency
+        self.steps = []
+
+    def get(self, url):
+        if url.startswith('/qiita_db/artifacts/'):
+            return {'files': self.files, 'prep_information': [1]}
+        if url.startswith('/qiita_db/prep_template/'):
+            return {'qiime-map': self.map_fp}
+        raise ValueError('Unknown url: %s' % url)
+
+    def update_job_step(self, job_id, new_step):
+        sleep(self.latency)
+        self.steps.append((perf_counter(), job_id, new_step))
+
+
+def install_stub_tools(bin_dir):
+    """Writes a wrapper running stub_tool.py for each tool to bin_dir
+
+    The wrappers run the stubs with this interpreter, without site packages
+    so they start quickly; put bin_dir first in PATH to use them.
+    """
+    makedirs(bin_dir, exist_ok=True)
+    for tool in STUB_TOOLS:
+        fp = join(bin_dir, tool)
+        with open(fp, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" -S "%s" %s "$@"\n'
+                    % (sys.executable, STUB_TOOL, tool))
+        chmod(fp, 0o755)
+
+
+def write_databases(db_dir, n_annotations=10000):
+    """Writes the filter and Shogun databases the stubs use
+
+    QC_FILTER_DB_DP and QC_SHOGUN_DB_DP are set to their folders, so this
+    has to be called before qp_shogun is imported.
+
+    Parameters
+    ----------
+    db_dir : str
+        The directory where the databases are written
+    n_annotations : int, optional
+        The number of rows of each KEGG annotation table
+
+    Returns
+    -------
+    str, str
+        The filter and Shogun database folders
+    """
+    filter_dp = join(db_dir, 'filter_dbs')
+    makedirs(join(filter_dp, 'phix'))
+    # bowtie2 databases are found by their files' names
+    for ext in ('1.bt2', '2.bt2', 'rev.1.bt2'):
+        open(join(filter_dp, 'phix', 'phix.%s' % ext), 'w').close()
+
+    shogun_dp = join(db_dir, 'shogun_dbs')
+    makedirs(join(shogun_dp, 'shogun', 'function'))
+    with open(join(shogun_dp, 'shogun', 'metadata.yaml'), 'w') as f:
+        f.write('general:\n  taxonomy: stub\nfunction: function/ko\n')
+
+    environ['QC_FILTER_DB_DP'] = filter_dp
+    environ['QC_SHOGUN_DB_DP'] = shogun_dp
+    # bench_annotation_parsers imports qp_shogun
+    from bench_annotation_parsers import write_tables
+    write_tables(join(shogun_dp, 'shogun', 'function'), n_annotations)
+
+    return filter_dp, shogun_dp
+
+
+def read_tool_log(log_fp):
+    """Returns the time the stub tools were running, from their STUB_LOG
+
+    Returns
+    -------
+    float
+        The seconds during which at least one tool was running, so tools
+        running at the same time are only counted once
+    int
+        The number of tool runs
+    """
+    with open(log_fp) as f:
+        intervals = sorted(tuple(map(float, line.split('\t')[1:]))
+                           for line in f)
+
+    busy = 0
+    end = None
+    for start, stop in intervals:
+        if end is None or start > end:
+            busy += stop - start
+            end = stop
+        elif stop > end:
+            busy += stop - end
+            end = stop
+
+    return busy, len(intervals)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Throughput and peak memory benchmarks of the plugin's Python hot paths on
+# synthetic data
+# -----------------------------------------------------------------------------
+
+import gzip
+import json
+import resource
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from os.path import join, getsize
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+
+from synthetic import write_samples, write_profile
+from bench_annotation_parsers import write_tables
+
+# samples, read pairs per sample, profile observations, profile samples and
+# annotation table rows of each scale
+SCALES = {
+    'small': (10, 100, 1000, 10, 10000),
+    'medium': (100, 10000, 10000, 100, 100000),
+    'large': (1000, 100000, 50000, 1000, 100000),
+    'xlarge': (10000, 10000, 100000, 10000, 100000)}
+
+
+def bench_readfq(data):
+    from qp_shogun.shogun.utils import readfq
+    n_reads = 0
+    for fp in data['fastqs']:
+        with gzip.open(fp, 'rt') as f:
+            for _ in readfq(f):
+                n_reads += 1
+    return n_reads, data['fastq_bytes']
+
+
+def bench_readfq_blocks(data):
+    from qp_shogun.shogun.utils import readfq_blocks
+    n_reads = 0
+    for fp in data['fastqs']:
+        with gzip.open(fp, 'rb') as f:
+            for records in readfq_blocks(f):
+                n_reads += len(records)
+    return n_reads, data['fastq_bytes']
+
+
+def _bench_generate_fna_file(data, n_jobs):
+    from qp_shogun.shogun.shogun import generate_fna_file
+    with TemporaryDirectory(dir=data['out_dir']) as temp_dir:
+        generate_fna_file(temp_dir, data['samples'], n_jobs=n_jobs)
+    return data['n_reads'], data['fastq_bytes']
+
+
+def bench_generate_fna_file(data):
+    return _bench_generate_fna_file(data, 1)
+
+
+def bench_generate_fna_file_parallel(data):
+    return _bench_generate_fna_file(data, data['n_jobs'])
+
+
+def bench_make_read_pairs_per_sample(data):
+    from qp_shogun.utils import make_read_pairs_per_sample
+    samples = data['samples']
+    make_read_pairs_per_sample([s[2] for s in samples],
+                               [s[3] for s in samples], data['map_fp'])
+    return len(samples), 0
+
+
+def bench_import_shogun_biom(data):
+    from qp_shogun.shogun.utils import import_shogun_biom
+    table = import_shogun_biom(data['profile'], names_to_taxonomy=True)
+    return table.shape[0], data['profile_bytes']
+
+
+def _bench_parser(data, name):
+    from qp_shogun.shogun import utils
+    parse = getattr(utils, 'shogun_parse_%s_table' % name)
+    parse(data['annotations'][name])
+    return data['annotation_rows'], data['annotation_bytes'][name]
+
+
+def bench_parse_enzyme_table(data):
+    return _bench_parser(data, 'enzyme')
+
+
+def bench_parse_module_table(data):
+    return _bench_parser(data, 'module')
+
+
+def bench_parse_pathway_table(data):
+    return _bench_parser(data, 'pathway')
+
+
+BENCHMARKS = {
+    'readfq': bench_readfq,
+    'readfq_blocks': bench_readfq_blocks,
+    'generate_fna_file': bench_generate_fna_file,
+    'generate_fna_file_parallel': bench_generate_fna_file_parallel,
+    'make_read_pairs_per_sample': bench_make_read_pairs_per_sample,
+    'import_shogun_biom': bench_import_shogun_biom,
+    'shogun_parse_enzyme_table': bench_parse_enzyme_table,
+    'shogun_parse_module_table': bench_parse_module_table,
+    'shogun_parse_pathway_table': bench_parse_pathway_table}
+
+
+def _maxrss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _measure(name, data):
+    # Runs a benchmark; meant to run in a fresh process so the peak memory
+    # belongs to this benchmark only
+    # import outside of the measurement
+    import qp_shogun.shogun.shogun  # noqa
+    rss_before = _maxrss_mb()
+    start = perf_counter()
+    n_items, n_bytes = BENCHMARKS[name](data)
+    seconds = perf_counter() - start
+    return {'seconds': seconds,
+            'items': n_items,
+            'items_per_second': n_items / seconds,
+            'mb_per_second': n_bytes / 1048576. / seconds,
+            'peak_mb': _maxrss_mb(),
+            'peak_delta_mb': _maxrss_mb() - rss_before}
+
+
+def run_isolated(name, data):
+    """Runs the benchmark name in a new interpreter and returns its metrics"""
+    with ProcessPoolExecutor(max_workers=1,
+                             mp_context=get_context('spawn')) as pool:
+        return pool.submit(_measure, name, data).result()
+
+
+def compare(results, baseline, tolerance):
+    """Compares results with a baseline
+
+    Returns the names of the benchmarks that are slower, or use more memory,
+    than the baseline by more than tolerance (a fraction)
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        slower = result['seconds'] > base['seconds'] * (1 + tolerance)
+        bigger = result['peak_mb'] > base['peak_mb'] * (1 + tolerance)
+        if slower or bigger:
+            regressions.append(name)
+    return regressions
+
+
+@click.command()
+@click.option('--scale', type=click.Choice(sorted(SCALES)), default='small',
+              show_default=True, help='Size of the synthetic data')
+@click.option('--samples', type=int, help='Overrides the number of samples')
+@click.option('--reads-per-sample', type=int,
+              help='Overrides the number of read pairs per sample')
+@click.option('--n-jobs', type=int, default=cpu_count(), show_default=True,
+              help='Processes used by the parallel benchmarks')
+@click.option('--only', multiple=True, type=click.Choice(sorted(BENCHMARKS)),
+              help='Run only these benchmarks')
+@click.option('--work-dir', default=None,
+              help='Where the synthetic data is written')
+@click.option('--baseline', type=click.Path(exists=True),
+              help='JSON results of a previous run to compare with')
+@click.option('--save', type=click.Path(), help='Write the results as JSON')
+@click.option('--tolerance', default=0.2, show_default=True,
+              help='Allowed slowdown/memory growth over the baseline')
+def run(scale, samples, reads_per_sample, n_jobs, only, work_dir, baseline,
+        save, tolerance):
+    """Runs the benchmarks and reports throughput and peak memory"""
+    (n_samples, n_reads, profile_observations, profile_samples,
+     annotation_rows) = SCALES[scale]
+    n_samples = samples or n_samples
+    n_reads = reads_per_sample or n_reads
+    names = only or sorted(BENCHMARKS)
+
+    with TemporaryDirectory(dir=work_dir) as out_dir:
+        click.echo('Generating %d samples x %d read pairs...'
+                   % (n_samples, n_reads))
+        samples, map_fp, fastq_bytes = write_samples(
+            out_dir, n_samples, n_reads)
+        profile = join(out_dir, 'profile.tsv')
+        annotations = write_tables(out_dir, annotation_rows)
+        data = {
+            'out_dir': out_dir, 'n_jobs': n_jobs,
+            'samples': samples, 'map_fp': map_fp,
+            'fastqs': [fp for s in samples for fp in s[2:]],
+            'fastq_bytes': fastq_bytes, 'n_reads': 2 * n_samples * n_reads,
+            'profile': profile,
+            'profile_bytes': write_profile(
+                profile, profile_observations, profile_samples),
+            'annotations': annotations, 'annotation_rows': annotation_rows,
+            'annotation_bytes': {
+                k: getsize(v)
+                for k, v in annotations.items()}}
+
+        results = {}
+        click.echo('benchmark\tseconds\titems/s\tMB/s\tpeak MB\tgrowth MB')
+        for name in names:
+            result = run_isolated(name, data)
+            results[name] = result
+            click.echo('%s\t%.3f\t%.0f\t%.1f\t%.1f\t%.1f' % (
+                name, result['seconds'], result['items_per_second'],
+                result['mb_per_second'], result['peak_mb'],
+                result['peak_delta_mb']))
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump({'scale': scale, 'samples': n_samples,
+                       'reads_per_sample': n_reads, 'results': results},
+                      f, indent=4, sort_keys=True)
+
+    if baseline:
+        with open(baseline) as f:
+            base = json.load(f)
+        regressions = compare(results, base['results'], tolerance)
+        for name in regressions:
+            click.echo('REGRESSION %s: %.3fs/%.1fMB, baseline %.3fs/%.1fMB'
+                       % (name, results[name]['seconds'],
+                          results[name]['peak_mb'],
+                          base['results'][name]['seconds'],
+                          base['results'][name]['peak_mb']))
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    run()
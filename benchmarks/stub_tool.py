@@ -0,0 +1,276 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# Stands in for the external tools the plugin runs: atropos, bowtie2,
+# samtools, bedtools, pigz and shogun. Run as `stub_tool.py <tool> <args>`
+# through the wrappers offline.install_stub_tools writes. Every stub reads its
+# inputs whole and writes outputs of about the size the real tool would, plus
+# the messages the plugin parses, so only the computing is left out.
+#
+# STUB_DELAY (or STUB_DELAY_<TOOL>, e.g. STUB_DELAY_BOWTIE2) is a number of
+# seconds each run sleeps, to stand for that computing, and each run appends
+# "<tool>\t<start>\t<end>" to STUB_LOG, if set, so the time spent in the tools
+# can be told apart from the plugin's own.
+# -----------------------------------------------------------------------------
+
+import gzip
+import sys
+from os import (environ, makedirs, open as os_open, write, close, walk,
+                sysconf, O_WRONLY, O_APPEND, O_CREAT)
+from os.path import join
+from time import time, sleep
+
+
+# flags of the tools that take a value
+VALUE_FLAGS = {
+    # atropos
+    '--adapter', '-A', '--quality-cutoff', '--minimum-length',
+    '--pair-filter', '--max-n', '--threads', '-o', '-p', '-pe1', '-pe2',
+    # bowtie2, samtools and bedtools
+    '-x', '-1', '-2', '-f', '-F', '-T', '-@', '-c', '-0', '-s', '-i', '-fq',
+    '-fq2',
+    # shogun
+    '--aligner', '--database', '--input', '--output', '--level'}
+
+ALN2EXT = {'utree': 'tsv', 'burst': 'b6', 'bowtie2': 'sam'}
+
+BLOCK_SIZE = 1048576
+
+
+def _start_time():
+    # when the process started, so the interpreter's start up counts as the
+    # tool's time; now when /proc isn't available
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time() - uptime + ticks / sysconf('SC_CLK_TCK')
+    except (OSError, ValueError):
+        return time()
+
+
+START = _start_time()
+
+
+def parse_args(args, value_flags=VALUE_FLAGS):
+    """Returns the flags, with their values, and the positional arguments"""
+    flags = {}
+    positional = []
+    args = iter(args)
+    for arg in args:
+        if arg in value_flags:
+            flags[arg] = next(args, None)
+        elif arg.startswith('-') and arg != '-':
+            flags[arg] = True
+        else:
+            positional.append(arg)
+    return flags, positional
+
+
+def open_input(fp):
+    if fp in (None, '-'):
+        # so closing it leaves stdin open
+        return open(sys.stdin.fileno(), 'rb', closefd=False)
+    with open(fp, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return gzip.open(fp, 'rb') if compressed else open(fp, 'rb')
+
+
+def open_output(fp, compress=False):
+    if fp in (None, '-'):
+        return open(sys.stdout.fileno(), 'wb', closefd=False)
+    if compress:
+        return gzip.open(fp, 'wb', compresslevel=1)
+    return open(fp, 'wb')
+
+
+def blocks(f):
+    return iter(lambda: f.read(BLOCK_SIZE), b'')
+
+
+def copy(in_fp, out_fp, compress=False):
+    """Copies in_fp to out_fp, returns the number of lines"""
+    n_lines = 0
+    with open_input(in_fp) as src, open_output(out_fp, compress) as dst:
+        for block in blocks(src):
+            n_lines += block.count(b'\n')
+            dst.write(block)
+    return n_lines
+
+
+def split(in_fp, out_fps, compress=False):
+    """Deals in_fp's blocks to out_fps in turn, returns the number of lines
+    """
+    n_lines = 0
+    outputs = [open_output(fp, compress) for fp in out_fps]
+    with open_input(in_fp) as src:
+        for i, block in enumerate(blocks(src)):
+            n_lines += block.count(b'\n')
+            outputs[i % len(outputs)].write(block)
+    for output in outputs:
+        output.close()
+    return n_lines
+
+
+def atropos(flags, positional):
+    n_reads = copy(flags['-pe1'], flags['-o']) // 4
+    copy(flags['-pe2'], flags['-p'])
+    # the synthetic reads are 150 bases long
+    n_bases = n_reads * 150
+    sys.stdout.write(
+        'Total read pairs processed:          {0:,d}\n'
+        'Pairs written (passing filters):     {0:,d}   100.0%\n'
+        'Total basepairs processed:           {1:,d}\n'
+        'Total written (filtered):            {1:,d}   100.0%\n'
+        .format(n_reads, 2 * n_bases))
+
+
+def bowtie2(flags, positional):
+    # the SAM output has about the size of the uncompressed reads
+    n_reads = copy(flags['-1'], '-') // 4
+    copy(flags['-2'], '-')
+    sys.stderr.write(
+        '%d reads; of these:\n'
+        '  %d (100.00%%) were paired; of these:\n'
+        '    %d (100.00%%) aligned concordantly 0 times\n'
+        '0.00%% overall alignment rate\n' % (n_reads, n_reads, n_reads))
+
+
+def samtools(flags, positional):
+    command, positional = positional[0], positional[1:]
+    if command == 'fastq':
+        n_reads = split('-', [flags['-1'], flags['-2']], compress=True) // 4
+        sys.stderr.write('[M::bam2fq_mainloop] discarded 0 singletons\n'
+                         '[M::bam2fq_mainloop] processed %d reads\n'
+                         % (2 * n_reads))
+    else:
+        # view, sort and collate, whose input is the first positional
+        copy(positional[0] if positional else '-', flags.get('-o', '-'))
+
+
+def bedtools(flags, positional):
+    split(flags['-i'], [flags['-fq'], flags['-fq2']])
+
+
+def pigz(flags, positional):
+    copy(positional[0], '-', compress=True)
+
+
+def _annotation_ids(database, n_ids):
+    # the first n_ids enzyme, module and pathway ids of the database
+    ids = {'enzyme': [], 'module': [], 'pathway': []}
+    for root, _, fns in walk(database):
+        for fn in fns:
+            for kind in ids:
+                if not fn.endswith('-%s-annotations.txt' % kind):
+                    continue
+                with open(join(root, fn)) as f:
+                    for line in f:
+                        columns = line.rstrip('\n').split('\t')
+                        if kind == 'enzyme':
+                            id_ = columns[0]
+                        elif kind == 'module':
+                            id_ = columns[4].strip('"').split('  ')[0]
+                        else:
+                            id_ = columns[4].strip('"')
+                        if id_ not in ids[kind]:
+                            ids[kind].append(id_)
+                        if len(ids[kind]) == n_ids:
+                            break
+    return ids
+
+
+def _write_profile(fp, obs_ids, samples):
+    with open(fp, 'w') as f:
+        f.write('#OTU ID\t%s\n' % '\t'.join(samples))
+        for i, obs_id in enumerate(obs_ids):
+            f.write('%s\t%s\n' % (obs_id, '\t'.join(
+                str((i * (j + 7)) % 101) for j in range(len(samples)))))
+
+
+def _profile_samples(fp):
+    with open(fp) as f:
+        return f.readline().rstrip('\n').split('\t')[1:]
+
+
+def shogun(flags, positional):
+    command = positional[0]
+    if command == 'align':
+        ext = ALN2EXT[flags['--aligner']]
+        aln_fp = join(flags['--output'], 'alignment.%s.%s'
+                      % (flags['--aligner'], ext))
+        # the input can be a named pipe, it is opened once
+        with open(flags['--input'], 'rb') as src, open(aln_fp, 'w') as dst:
+            for line in src:
+                if line.startswith(b'>'):
+                    dst.write('%s\t0\tref\n' % line[1:].decode().strip())
+    elif command == 'assign_taxonomy':
+        samples = []
+        with open(flags['--input']) as f:
+            for line in f:
+                sample = line.split('\t', 1)[0].rsplit('_', 1)[0]
+                if not samples or samples[-1] != sample:
+                    samples.append(sample)
+        n_taxa = int(environ.get('STUB_TAXA', 1000))
+        _write_profile(
+            flags['--output'],
+            ['k__Bacteria;p__P%d;c__C%d;o__O%d;f__F%d;g__G%d;s__S%d'
+             % (i % 30, i % 90, i % 200, i % 500, i % 2000, i)
+             for i in range(n_taxa)],
+            list(dict.fromkeys(samples)))
+    elif command == 'redistribute':
+        copy(flags['--input'], flags['--output'])
+    elif command == 'functional':
+        samples = _profile_samples(flags['--input'])
+        ids = _annotation_ids(flags['--database'],
+                              int(environ.get('STUB_FUNCTIONS', 1000)))
+        out_dir = flags['--output']
+        makedirs(out_dir, exist_ok=True)
+        level = flags['--level']
+        for name, kind in [('kegg.modules.coverage', 'module'),
+                           ('kegg.modules', 'module'),
+                           ('kegg.pathways.coverage', 'pathway'),
+                           ('kegg.pathways', 'pathway'),
+                           ('kegg', 'enzyme'), ('normalized', 'enzyme')]:
+            _write_profile(join(out_dir, 'profile.%s.%s.txt' % (level, name)),
+                           ids[kind], samples)
+    else:
+        raise ValueError('Unknown shogun command: %s' % command)
+
+
+TOOLS = {'atropos': atropos, 'bowtie2': bowtie2, 'samtools': samtools,
+         'bedtools': bedtools, 'pigz': pigz, 'shogun': shogun}
+
+
+def main(tool, args):
+    # pigz's -c is a switch, samtools fastq's takes the compression level
+    flags, positional = parse_args(
+        args, VALUE_FLAGS - {'-c'} if tool == 'pigz' else VALUE_FLAGS)
+    if tool == 'atropos':
+        # atropos trim
+        positional = positional[1:]
+    TOOLS[tool](flags, positional)
+    sys.stdout.flush()
+
+    delay = environ.get('STUB_DELAY_%s' % tool.upper(),
+                        environ.get('STUB_DELAY', 0))
+    sleep(float(delay))
+
+    log_fp = environ.get('STUB_LOG')
+    if log_fp:
+        fd = os_open(log_fp, O_WRONLY | O_APPEND | O_CREAT, 0o644)
+        try:
+            write(fd, ('%s\t%f\t%f\n' % (tool, START, time())).encode())
+        finally:
+            close(fd)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,153 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------------
+# This file contains the synthetic data generators used by the benchmarks
+# -----------------------------------------------------------------------------
+
+import gzip
+from os.path import join, dirname, abspath, getsize
+from itertools import cycle, islice
+
+import numpy as np
+
+SUPPORT_FILES = join(dirname(dirname(abspath(__file__))), 'support_files')
+
+
+def template_reads(fp=join(SUPPORT_FILES, 'kd_test_1_R1.fastq.gz')):
+    """Returns the (seq, qual) pairs of a support file fastq
+
+    The synthetic files repeat these reads so they have the read length,
+    base composition and quality profile of real data.
+    """
+    reads = []
+    with gzip.open(fp, 'rt') as f:
+        while True:
+            record = list(islice(f, 4))
+            if len(record) < 4:
+                break
+            reads.append((record[1].rstrip('\n'), record[3].rstrip('\n')))
+
+    return reads
+
+
+def write_fastq(fp, n_reads, templates, read=1, offset=0):
+    """Writes a gzipped fastq with n_reads reads cycling through templates
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath
+    n_reads : int
+        The number of reads to write
+    templates : list of (str, str)
+        The (seq, qual) pairs to cycle through
+    read : {1, 2}, optional
+        The mate number written in the headers
+    offset : int, optional
+        The template to start from, so every sample has different reads
+
+    Returns
+    -------
+    int
+        The size in bytes of the written file
+    """
+    start = offset % len(templates)
+    reads = islice(cycle(templates[start:] + templates[:start]), n_reads)
+    # low compression level: writing the inputs shouldn't dominate the run
+    with gzip.open(fp, 'wt', compresslevel=1) as f:
+        batch = []
+        for i, (seq, qual) in enumerate(reads):
+            batch.append('@SYN:1:FC:1:1:%d:%d %d:N:0:ACGT\n%s\n+\n%s\n'
+                         % (offset, i, read, seq, qual))
+            if len(batch) == 10000:
+                f.write(''.join(batch))
+                batch = []
+        f.write(''.join(batch))
+
+    return getsize(fp)
+
+
+def write_samples(out_dir, n_samples, reads_per_sample, templates=None):
+    """Writes paired gzipped fastq files and a mapping file for n_samples
+
+    Parameters
+    ----------
+    out_dir : str
+        The directory where the files are written
+    n_samples : int
+        The number of samples
+    reads_per_sample : int
+        The number of read pairs of each sample
+    templates : list of (str, str), optional
+        The (seq, qual) pairs to cycle through, template_reads() by default
+
+    Returns
+    -------
+    samples : list of tup
+        4-tuples with run prefix, sample name, fwd read fp, rev read fp, the
+        same as make_read_pairs_per_sample returns
+    map_fp : str
+        The mapping file, with a run_prefix column
+    n_bytes : int
+        The total size of the fastq files
+    """
+    if templates is None:
+        templates = template_reads()
+    samples = []
+    n_bytes = 0
+    map_fp = join(out_dir, 'mapping_file.txt')
+    with open(map_fp, 'w') as map_f:
+        map_f.write('#SampleID\trun_prefix\n')
+        for i in range(n_samples):
+            run_prefix = 'S%06d_S%d' % (i, i)
+            sample = 'sample.%d' % i
+            fwd_fp = join(out_dir, '%s_L001_R1_001.fastq.gz' % run_prefix)
+            rev_fp = join(out_dir, '%s_L001_R2_001.fastq.gz' % run_prefix)
+            n_bytes += write_fastq(fwd_fp, reads_per_sample, templates, 1, i)
+            n_bytes += write_fastq(rev_fp, reads_per_sample, templates, 2, i)
+            samples.append((run_prefix, sample, fwd_fp, rev_fp))
+            map_f.write('%s\t%s\n' % (sample, run_prefix))
+
+    return samples, map_fp, n_bytes
+
+
+def write_profile(fp, n_observations, n_samples, density=0.01, seed=0):
+    """Writes a Shogun-like profile TSV
+
+    Parameters
+    ----------
+    fp : str
+        The output filepath
+    n_observations : int
+        The number of rows, named like Shogun's taxonomy strings
+    n_samples : int
+        The number of sample columns
+    density : float, optional
+        The fraction of non-zero counts
+    seed : int, optional
+        The random seed
+
+    Returns
+    -------
+    int
+        The size in bytes of the written file
+    """
+    rng = np.random.RandomState(seed)
+    with open(fp, 'w') as f:
+        f.write('#OTU ID\t%s\n' % '\t'.join(
+            'sample.%d' % i for i in range(n_samples)))
+        for i in range(n_observations):
+            row = np.zeros(n_samples, dtype=int)
+            nonzero = rng.rand(n_samples) < density
+            row[nonzero] = rng.randint(1, 1000, nonzero.sum())
+            f.write('k__Bacteria;p__P%d;c__C%d;o__O%d;f__F%d;g__G%d;s__S%d'
+                    '\t%s\n' % (i % 30, i % 90, i % 200, i % 500, i % 2000,
+                                i, '\t'.join(map(str, row))))
+
+    return getsize(fp)
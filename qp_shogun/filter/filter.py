@@ -6,19 +6,56 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
+from os import environ
 from os.path import join
+from re import search
 from tempfile import TemporaryDirectory
 from qp_shogun.utils import (
     _format_params, make_read_pairs_per_sample,
-    _run_commands, _per_sample_ainfo)
+    _run_commands, _per_sample_ainfo, _get_n_jobs, JobMetrics,
+    _cached_commands, _cache_results, _get_core_budget, _allocate_threads,
+    _sample_read_stats, _write_read_stats, _with_progress_reporter)
 
 BOWTIE2_PARAMS = {
     'x': 'Bowtie2 database to filter',
     'p': 'Number of threads'}
 
+FILTER_MODES = ('default', 'streamed', 'collate')
+
+# how the streamed modes bring the mates of each pair together
+PAIRING_CMDS = {
+    'streamed': 'samtools sort -T {sample_path} -@ {thrds} -n -u - | ',
+    'collate': 'samtools collate -f -O -u -@ {thrds} - {sample_path} | '}
+
+
+def _pipeline_threads(threads):
+    """Splits the threads of a streamed command between its stages
+
+    Parameters
+    ----------
+    threads : int
+        The threads of the command
+
+    Returns
+    -------
+    int, int
+        The threads of bowtie2 and the extra threads (-@) of each of the
+        samtools pairing and fastq stages
+
+    Notes
+    -----
+    The stages of a streamed command run at the same time, so they share
+    the command's threads instead of each using all of them: the samtools
+    stages get a quarter each, bowtie2, which does most of the work, the
+    rest and at least one.
+    """
+    samtools_threads = threads // 4
+    return max(1, threads - 2 * samtools_threads), samtools_threads
+
 
 def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
-                             out_dir, temp_dir, parameters):
+                             out_dir, temp_dir, parameters, mode='default',
+                             core_budget=None):
     """Generates the QC_Filter commands
 
     Parameters
@@ -33,6 +70,11 @@ def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
         The job output directory
     parameters : dict
         The command's parameters, keyed by parameter name
+    mode : {'default', 'streamed', 'collate'}, optional
+        How the unmapped pairs are turned into the filtered files, see Notes
+    core_budget : int, optional
+        If given, the threads of each command are allocated from it with
+        _allocate_threads instead of taken from the parameters
 
     Returns
     -------
@@ -47,7 +89,22 @@ def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
     step but implicitly allowing empty reverse reads in the actual command
     generation. This behavior may allow support of situations with empty
     reverse reads in some samples, for example after trimming and QC.
+
+    In 'default' mode the unmapped pairs are written to a BAM file, name
+    sorted to a second BAM file, converted to uncompressed fastq files and
+    finally compressed. In 'streamed' mode the same steps are piped into
+    each other and samtools writes the compressed fastq files, so only the
+    final files and the sort's temporary files are written to disk.
+    'collate' mode is 'streamed' without the name sort: samtools fastq only
+    needs the mates of a pair next to each other, which bowtie2 already
+    does, so samtools collate in fast mode just groups the few pairs that
+    aren't instead of sorting every read. In the streamed
+    modes the command's threads are split between bowtie2 and samtools with
+    _pipeline_threads, as the stages run at the same time.
     """
+    if mode not in FILTER_MODES:
+        raise ValueError('Unknown filter mode: %s' % mode)
+
     # we match filenames, samples, and run prefixes
     samples = make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file)
 
@@ -55,8 +112,34 @@ def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
 
     param_string = _format_params(parameters, BOWTIE2_PARAMS)
     threads = parameters['Number of threads']
+    if core_budget is not None:
+        sample_threads = _allocate_threads(samples, core_budget)
+
+    for i, (run_prefix, sample, f_fp, r_fp) in enumerate(samples):
+        if core_budget is not None:
+            threads = str(sample_threads[i])
+            sample_params = dict(parameters)
+            sample_params['Number of threads'] = threads
+            param_string = _format_params(sample_params, BOWTIE2_PARAMS)
+        if mode in PAIRING_CMDS:
+            bowtie2_threads, samtools_threads = _pipeline_threads(
+                int(threads))
+            pipeline_params = dict(parameters)
+            pipeline_params['Number of threads'] = str(bowtie2_threads)
+            cmds.append(
+                ('bowtie2 {params} --very-sensitive -1 {fwd_ip} -2 {rev_ip} | '
+                 'samtools view -f 12 -F 256 -u - | ' + PAIRING_CMDS[mode] +
+                 'samtools fastq -@ {thrds} -c 6 -1 {gz_op_one} '
+                 '-2 {gz_op_two} -0 /dev/null -s /dev/null -')
+                .format(params=_format_params(pipeline_params,
+                                              BOWTIE2_PARAMS),
+                        thrds=samtools_threads,
+                        fwd_ip=f_fp, rev_ip=r_fp,
+                        sample_path=join(temp_dir, '%s' % sample),
+                        gz_op_one=join(out_dir, '%s.R1.fastq.gz' % sample),
+                        gz_op_two=join(out_dir, '%s.R2.fastq.gz' % sample)))
+            continue
 
-    for run_prefix, sample, f_fp, r_fp in samples:
         cmds.append('bowtie2 {params} --very-sensitive -1 {fwd_ip} -2 {rev_ip}'
                     ' | samtools view -f 12 -F 256 -b -o {bow_op}; '
 
@@ -91,6 +174,25 @@ def generate_filter_commands(forward_seqs, reverse_seqs, map_file,
     return cmds, samples
 
 
+def _parse_filter_report(std_out, std_err):
+    """Returns the read statistics in the std err of a QC_Filter command
+
+    The pairs in come from the bowtie2 alignment summary and, in the
+    streamed modes, the pairs out from the reads samtools fastq processed;
+    bedtools doesn't report them, so 'default' mode only has the pairs in.
+    """
+    stats = {}
+    match = search(r'(\d+) reads; of these:', std_err)
+    if match is not None:
+        stats['reads_in'] = int(match.group(1))
+    match = search(r'processed (\d+) reads', std_err)
+    if match is not None:
+        stats['reads_out'] = int(match.group(1)) // 2
+
+    return(stats)
+
+
+@_with_progress_reporter
 def filter(qclient, job_id, parameters, out_dir):
     """Run filtering using Bowtie2 with the given parameters
 
@@ -110,7 +212,10 @@ def filter(qclient, job_id, parameters, out_dir):
     bool, list, str
         The results of the job
     """
+    metrics = JobMetrics()
+
     # Step 1 get the rest of the information need to run Bowtie2
+    metrics.stage('Collecting information')
     qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
     artifact_id = parameters['input']
     del parameters['input']
@@ -125,30 +230,59 @@ def filter(qclient, job_id, parameters, out_dir):
     qiime_map = prep_info['qiime-map']
 
     # Step 2 generating command
+    metrics.stage('Generating QC_Filter commands')
     qclient.update_job_step(job_id, "Step 2 of 4: Generating"
                                     " QC_Filter commands")
     # Creating temporary directory for intermediate files
     with TemporaryDirectory(dir=out_dir, prefix='filter_') as temp_dir:
         rs = fps['raw_reverse_seqs'] if 'raw_reverse_seqs' in fps else []
+        mode = environ.get('QC_FILTER_MODE', 'default')
+        if mode not in FILTER_MODES:
+            return False, None, 'Unknown QC_FILTER_MODE: %s' % mode
+        core_budget = _get_core_budget()
         commands, samples = generate_filter_commands(fps['raw_forward_seqs'],
                                                      rs, qiime_map, out_dir,
-                                                     temp_dir, parameters)
+                                                     temp_dir, parameters,
+                                                     mode=mode,
+                                                     core_budget=core_budget)
+        threads = None
+        if core_budget is not None:
+            threads = dict(zip(commands,
+                               _allocate_threads(samples, core_budget)))
 
         # Step 3 execute filtering command
+        metrics.stage('Executing QC_Filter')
+        suffixes = ['%s.R1.fastq.gz',
+                    '%s.R2.fastq.gz']
+        sample_cmds = commands
+        # the mode is part of the key as the outputs of each mode can differ
+        commands, to_store = _cached_commands(
+            commands, samples, out_dir, suffixes, 'QC_Filter %s' % mode,
+            _format_params(parameters, BOWTIE2_PARAMS))
         len_cmd = len(commands)
         msg = "Step 3 of 4: Executing QC_Trim job (%d/{0})".format(len_cmd)
+        outputs = {}
         success, msg = _run_commands(
-            qclient, job_id, commands, msg, 'QC_Filter')
+            qclient, job_id, commands, msg, 'QC_Filter', n_jobs=_get_n_jobs(),
+            metrics=metrics, threads=threads, core_budget=core_budget,
+            outputs=outputs)
         if not success:
+            metrics.write(out_dir)
             return False, None, msg
+        _cache_results(to_store)
+        _write_read_stats(out_dir, _sample_read_stats(
+            sample_cmds, samples, outputs, _parse_filter_report))
 
     # Step 4 generating artifacts
+    metrics.stage('Generating new artifacts')
     msg = "Step 4 of 4: Generating new artifacts (%d/{0})".format(len_cmd)
-    suffixes = ['%s.R1.fastq.gz',
-                '%s.R2.fastq.gz']
     prg_name = 'Filtering'
     file_type_name = 'Filtered files'
     ainfo = _per_sample_ainfo(
         out_dir, samples, suffixes, prg_name, file_type_name, bool(rs))
 
+    metrics.write(out_dir)
+    qclient.update_job_step(
+        job_id, "Step 4 of 4: Finished, %s" % metrics.summary())
+
     return True, ainfo, ""
@@ -17,7 +17,8 @@ import os
 from qiita_client.testing import PluginTestCase
 from qp_shogun import plugin
 from qp_shogun.filter.filter import (
-    generate_filter_commands, filter)
+    generate_filter_commands, filter, _parse_filter_report,
+    _pipeline_threads)
 from qp_shogun.filter.utils import (
     get_dbs, get_dbs_list, generate_filter_dflt_params)
 from qp_shogun.utils import (_format_params, _per_sample_ainfo)
@@ -117,6 +118,96 @@ class QC_FilterTests(PluginTestCase):
         self.assertEqual(obs_cmd, exp_cmd)
         self.assertEqual(obs_sample, exp_sample)
 
+    def test_generate_filter_analysis_commands_streamed(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+
+        exp_cmd = [
+            ('bowtie2 -p 1 -x %sphix/phix --very-sensitive '
+             '-1 fastq/s1.fastq.gz -2 fastq/s1.R2.fastq.gz | '
+             'samtools view -f 12 -F 256 -u - | '
+             'samtools sort -T temp/SKB8.640193 -@ 0 -n -u - | '
+             'samtools fastq -@ 0 -c 6 -1 output/SKB8.640193.R1.fastq.gz '
+             '-2 output/SKB8.640193.R2.fastq.gz -0 /dev/null -s /dev/null -'
+             ) % db_path
+            ]
+
+        obs_cmd, _ = generate_filter_commands(
+            ['fastq/s1.fastq.gz'],
+            ['fastq/s1.R2.fastq.gz'],
+            fp, 'output', 'temp', self.params, mode='streamed')
+
+        self.assertEqual(obs_cmd, exp_cmd)
+
+        # the threads are split between bowtie2 and samtools
+        params = dict(self.params)
+        params['Number of threads'] = '8'
+        obs_cmd, _ = generate_filter_commands(
+            ['fastq/s1.fastq.gz'],
+            ['fastq/s1.R2.fastq.gz'],
+            fp, 'output', 'temp', params, mode='streamed')
+        self.assertEqual(obs_cmd, [exp_cmd[0].replace(
+            '-p 1', '-p 4').replace('-@ 0', '-@ 2')])
+
+        with self.assertRaises(ValueError):
+            generate_filter_commands(
+                ['fastq/s1.fastq.gz'], ['fastq/s1.R2.fastq.gz'],
+                fp, 'output', 'temp', self.params, mode='unknown')
+
+    def test_generate_filter_analysis_commands_collate(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write(MAPPING_FILE)
+        self._clean_up_files.append(fp)
+        db_path = os.environ["QC_FILTER_DB_DP"]
+
+        exp_cmd = [
+            ('bowtie2 -p 1 -x %sphix/phix --very-sensitive '
+             '-1 fastq/s1.fastq.gz -2 fastq/s1.R2.fastq.gz | '
+             'samtools view -f 12 -F 256 -u - | '
+             'samtools collate -f -O -u -@ 0 - temp/SKB8.640193 | '
+             'samtools fastq -@ 0 -c 6 -1 output/SKB8.640193.R1.fastq.gz '
+             '-2 output/SKB8.640193.R2.fastq.gz -0 /dev/null -s /dev/null -'
+             ) % db_path
+            ]
+
+        obs_cmd, _ = generate_filter_commands(
+            ['fastq/s1.fastq.gz'],
+            ['fastq/s1.R2.fastq.gz'],
+            fp, 'output', 'temp', self.params, mode='collate')
+
+        self.assertEqual(obs_cmd, exp_cmd)
+
+    def test_pipeline_threads(self):
+        self.assertEqual(_pipeline_threads(1), (1, 0))
+        self.assertEqual(_pipeline_threads(3), (3, 0))
+        self.assertEqual(_pipeline_threads(4), (2, 1))
+        self.assertEqual(_pipeline_threads(10), (6, 2))
+
+    def test_parse_filter_report(self):
+        bowtie2_summary = (
+            "10000 reads; of these:\n"
+            "  10000 (100.00%) were paired; of these:\n"
+            "    9350 (93.50%) aligned concordantly 0 times\n"
+            "    600 (6.00%) aligned concordantly exactly 1 time\n"
+            "    50 (0.50%) aligned concordantly >1 times\n"
+            "6.83% overall alignment rate\n")
+        # default mode, only bowtie2 reports
+        self.assertEqual(_parse_filter_report('', bowtie2_summary),
+                         {'reads_in': 10000})
+        # streamed modes, samtools fastq counts both mates
+        self.assertEqual(
+            _parse_filter_report(
+                '', bowtie2_summary +
+                "[M::bam2fq_mainloop] discarded 0 singletons\n"
+                "[M::bam2fq_mainloop] processed 18600 reads\n"),
+            {'reads_in': 10000, 'reads_out': 9300})
+
     def test_filter(self):
         # generating filepaths
         in_dir = mkdtemp()
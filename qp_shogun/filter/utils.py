@@ -12,16 +12,15 @@
 # ------------------------------------------------------------------------------
 
 import os
-from os.path import join, isdir
+from os.path import join
+from qp_shogun.utils import get_registered_dbs
 
 
 def get_dbs(db_folder):
     dbs = {}
     # Loop through the databases and create a dict of them
-    for folder in os.listdir(db_folder):
-            folder_path = join(db_folder, folder)
-            if isdir(folder_path):
-                dbs[folder] = join(folder_path, folder)
+    for folder in get_registered_dbs(db_folder):
+        dbs[folder] = join(db_folder, folder, folder)
 
     return(dbs)
 
@@ -29,10 +28,8 @@ def get_dbs(db_folder):
 def get_dbs_list(db_folder):
     dbs = []
     # Loop through the databases and create a list string
-    for folder in sorted(os.listdir(db_folder)):
-            folder_path = join(db_folder, folder)
-            if isdir(folder_path):
-                dbs.append(join(folder_path, folder))
+    for folder in get_registered_dbs(db_folder):
+        dbs.append(join(db_folder, folder, folder))
     dbs_formatted = (', '.join('"' + item + '"' for item in dbs))
 
     return(dbs_formatted)
@@ -5,10 +5,28 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
-from os.path import join
+from os import (remove, makedirs, rename, environ, open as os_open, fstat,
+                sendfile, mkfifo, close, stat, O_WRONLY, O_CREAT, O_RDONLY,
+                O_NONBLOCK, SEEK_END)
+from os.path import join, getsize, exists, abspath
+from glob import glob
+from errno import EXDEV, ENOSYS, EINVAL, EOPNOTSUPP, ENOTSUP, ENOTSOCK
+from itertools import accumulate
+from collections import Counter
+from shutil import copyfileobj, copyfile, rmtree
+from hashlib import sha256
+from json import dumps, dump, load
 from tempfile import TemporaryDirectory
-from .utils import readfq, import_shogun_biom, shogun_db_functional_parser
-from qp_shogun.utils import (make_read_pairs_per_sample, _run_commands)
+from multiprocessing import get_context
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait)
+from .utils import (
+    readfq_blocks, import_shogun_biom, shogun_db_functional_parser,
+    fna_index_fp, FNA_INDEX_COLUMNS, compile_annotation_table)
+from qp_shogun.utils import (
+    make_read_pairs_per_sample, _run_commands, _get_n_jobs, JobMetrics,
+    _get_core_budget, _write_read_stats, READ_STATS_FN,
+    _with_progress_reporter)
 import gzip
 from qiita_client import ArtifactInfo
 from biom import util
@@ -17,31 +35,401 @@ SHOGUN_PARAMS = {
     'Database': 'database', 'Aligner tool': 'aligner',
     'Number of threads': 'threads'}
 
+ALN2EXT = {'utree': 'tsv', 'burst': 'b6', 'bowtie2': 'sam'}
+
+FNA_MODES = ('file', 'streamed')
+
+# the aligners that read their input once, front to back, so they can read it
+# from a named pipe while it is written
+STREAMED_ALIGNERS = ('bowtie2',)
+
+try:
+    from os import copy_file_range
+except ImportError:
+    # only available on Linux
+    copy_file_range = None
+
+# the errors of a kernel copy that the files don't support
+UNSUPPORTED_COPY_ERRORS = {EXDEV, ENOSYS, EINVAL, EOPNOTSUPP, ENOTSUP,
+                           ENOTSOCK}
+
+# how the process pools start their workers: forking the job's process could
+# copy a lock held by its other threads, e.g. the progress reporter's while
+# it talks to Qiita, which would never be released in the child. The fork
+# server imports this module once, so the workers start without importing it
+POOL_CONTEXT = get_context('forkserver')
+POOL_CONTEXT.set_forkserver_preload([__name__])
+
+
+def _write_fna(output, sample, fps, count, lengths):
+    # Writes the reads in fps to the binary file output as fasta, numbering
+    # them from count, and adds their lengths to the Counter lengths.
+    # Returns the number to use for the next read
+    sample = sample.encode()
+    for fp in fps:
+        with gzip.open(fp, 'rb') as f:
+            for records in readfq_blocks(f):
+                seqs = [seq for _, seq, _ in records]
+                output.write(b''.join(
+                    b'>%s_%d\n%s\n' % (sample, i, seq)
+                    for i, seq in enumerate(seqs, count)))
+                lengths.update(map(len, seqs))
+                count += len(seqs)
+
+    return count
+
+
+def _write_fna_part(part_fp, sample, fps, count=0):
+    # Writes a sample to its own part file, returns the Counter of its read
+    # lengths
+    lengths = Counter()
+    with open(part_fp, 'wb') as output:
+        _write_fna(output, sample, fps, count, lengths)
+    return lengths
+
+
+def _renumber_fna_part(part_fp, sample, start):
+    # Adds start to the numbers of the reads of a part written by
+    # _write_fna_part from 0. Only the headers are parsed, each read is a
+    # header line and a sequence line
+    if not start:
+        return
+    prefix = b'>%s_' % sample.encode()
+    tmp_fp = part_fp + '.tmp'
+    with open(part_fp, 'rb') as part, open(tmp_fp, 'wb') as output:
+        while True:
+            lines = part.readlines(1 << 22)
+            if not lines:
+                break
+            if len(lines) % 2:
+                lines.append(part.readline())
+            lines[::2] = [b'%s%d\n' % (prefix, int(header[len(prefix):]) +
+                                       start) for header in lines[::2]]
+            output.write(b''.join(lines))
+    rename(tmp_fp, part_fp)
+
+
+def _fna_stats(samples, lengths):
+    # The read statistics of each sample from the Counter of its read
+    # lengths; no read is removed when converting to fasta
+    stats = []
+    for (_, sample, _, _), sample_lengths in zip(samples, lengths):
+        n_reads = sum(sample_lengths.values())
+        n_bases = sum(length * n for length, n in sample_lengths.items())
+        stats.append({'sample': sample, 'reads_in': n_reads,
+                      'reads_out': n_reads, 'bases_in': n_bases,
+                      'bases_out': n_bases,
+                      'length_histogram': sample_lengths})
+    return stats
+
+
+def _write_fna_index(fna_fp, names, offsets, lengths):
+    # Writes the sidecar index of fna_fp with the byte range and number of
+    # reads of each sample, from the offsets where each sample starts plus
+    # the one where the last sample ends, and the Counters of read lengths
+    with open(fna_index_fp(fna_fp), 'w') as f:
+        f.write('%s\n' % '\t'.join(FNA_INDEX_COLUMNS))
+        for name, start, end, sample_lengths in zip(names, offsets,
+                                                    offsets[1:], lengths):
+            f.write('%s\t%d\t%d\t%d\n' % (
+                name, start, end - start, sum(sample_lengths.values())))
+
+
+def _merge_indexed_fna_parts(part_fps, output_fp, names, lengths):
+    # Merges the part files as _merge_fna_parts does and writes the index of
+    # the samples they hold; the offsets come from the sizes of the parts
+    offsets = [getsize(output_fp) if exists(output_fp) else 0]
+    for part_fp in part_fps:
+        offsets.append(offsets[-1] + getsize(part_fp))
+    _merge_fna_parts(part_fps, output_fp)
+    _write_fna_index(output_fp, names, offsets, lengths)
+
+
+def _generate_fna_parts(temp_path, samples, n_jobs=1):
+    # Converts each sample to its own fasta part file, numbering the reads
+    # consecutively across samples. Returns the part filepaths and the
+    # Counter of the read lengths of each sample. In parallel, each sample
+    # is numbered from 0 as its start isn't known yet, and its headers are
+    # renumbered once all the samples are converted
+    names = [sample for _, sample, _, _ in samples]
+    sample_fps = [[fp for fp in (f_fp, r_fp) if fp is not None]
+                  for _, _, f_fp, r_fp in samples]
+    part_fps = [join(temp_path, 'combined.%d.fna' % i)
+                for i in range(len(samples))]
+
+    if n_jobs <= 1:
+        count = 0
+        lengths = []
+        for part_fp, sample, fps in zip(part_fps, names, sample_fps):
+            lengths.append(_write_fna_part(part_fp, sample, fps, count))
+            count += sum(lengths[-1].values())
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=POOL_CONTEXT) as pool:
+            lengths = list(pool.map(
+                _write_fna_part, part_fps, names, sample_fps))
+            starts = [0] + list(accumulate(
+                sum(sample_lengths.values()) for sample_lengths in lengths))
+            list(pool.map(_renumber_fna_part, part_fps, names, starts))
+
+    return part_fps, lengths
+
+
+def _sendfile(src_fd, dst_fd, count):
+    return sendfile(dst_fd, src_fd, None, count)
+
+
+def _copy_contents(src, dst):
+    # Copies the contents of the file object src to the current position of
+    # dst. The copy is done by the kernel, with copy_file_range (which may
+    # just share the blocks, e.g. in XFS or Btrfs) or else sendfile, so the
+    # data doesn't go through Python; copyfileobj is only used when the file
+    # systems support neither, or when they copy nothing. A copy that stops
+    # part way is an error, the output would be truncated
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    size = fstat(src_fd).st_size
+    dst.flush()
+    for copy in (copy_file_range, _sendfile):
+        if copy is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                n = copy(src_fd, dst_fd, min(size - copied, 1 << 30))
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+            continue
+        if copied == size:
+            return
+        if copied:
+            raise OSError('Copied %d of the %d bytes of %s'
+                          % (copied, size, src.name))
+    copyfileobj(src, dst)
+
+
+def _merge_fna_parts(part_fps, output_fp):
+    # Concatenates the part files, in order, to output_fp and removes them.
+    # When there is no output_fp yet the first part becomes it, so a single
+    # part isn't copied at all
+    part_fps = list(part_fps)
+    if part_fps and not exists(output_fp):
+        rename(part_fps.pop(0), output_fp)
+    if not part_fps:
+        return
+
+    # not opened in append mode as copy_file_range doesn't allow it
+    with open(os_open(output_fp, O_WRONLY | O_CREAT, 0o666), 'wb') as output:
+        output.seek(0, SEEK_END)
+        for part_fp in part_fps:
+            with open(part_fp, 'rb') as part:
+                _copy_contents(part, output)
+            remove(part_fp)
+
+
+def _remove_fna_files(temp_path):
+    # Removes the combined FNA files, shards, parts and their indexes
+    for fp in glob(join(temp_path, 'combined*.fna')) + \
+            glob(join(temp_path, 'combined*.fna.idx')):
+        remove(fp)
+
+
+def generate_fna_file(temp_path, samples, n_jobs=1, stats=None):
+    """Combines reverse and forward seqs of all samples in a fasta file
+
+    Parameters
+    ----------
+    temp_path : str
+        The directory where the fasta file is written
+    samples : list of tup
+        list of 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+    n_jobs : int, optional
+        The number of processes used to convert the samples
+    stats : list, optional
+        If given, the read statistics of each sample, as taken by
+        _write_read_stats, are appended to it
 
-def generate_fna_file(temp_path, samples):
-    # Combines reverse and forward seqs per sample
-    # Returns filepaths of new combined files
+    Returns
+    -------
+    str
+        The filepath of the combined fasta file
+
+    Notes
+    -----
+    Reads are numbered consecutively across samples, so when running in
+    parallel each sample is converted to its own part file, numbered from 0,
+    and the headers of each part are renumbered from where the previous
+    samples end once their number of reads is known; the parts are then
+    concatenated in the samples' order.
+
+    The byte range and number of reads of each sample are written to an
+    index next to the file (see read_fna_index), so a sample can be read
+    without scanning the file; there is no index when the file is a named
+    pipe.
+    """
     output_fp = join(temp_path, 'combined.fna')
-    output = open(output_fp, "a")
-    count = 0
-    for run_prefix, sample, f_fp, r_fp in samples:
-        with gzip.open(f_fp, 'rt') as fp:
-            # Loop through forward file
-            for header, seq, qual in readfq(fp):
-                output.write(">%s_%d\n" % (sample, count))
-                output.write("%s\n" % seq)
-                count += 1
-        with gzip.open(r_fp, 'rt') as fp:
-            # Loop through reverse file
-            for header, seq, qual in readfq(fp):
-                output.write(">%s_%d\n" % (sample, count))
-                output.write("%s\n" % seq)
-                count += 1
-    output.close()
+    names = [sample for _, sample, _, _ in samples]
+
+    if n_jobs <= 1 or len(samples) <= 1:
+        sample_fps = [[fp for fp in (f_fp, r_fp) if fp is not None]
+                      for _, _, f_fp, r_fp in samples]
+        lengths = [Counter() for _ in samples]
+        with open(output_fp, 'ab') as output:
+            indexed = output.seekable()
+            offsets = []
+            count = 0
+            for sample, fps, sample_lengths in zip(names, sample_fps,
+                                                   lengths):
+                if indexed:
+                    offsets.append(output.tell())
+                count = _write_fna(output, sample, fps, count,
+                                   sample_lengths)
+            if indexed:
+                offsets.append(output.tell())
+        if indexed:
+            _write_fna_index(output_fp, names, offsets, lengths)
+    else:
+        part_fps, lengths = _generate_fna_parts(temp_path, samples, n_jobs)
+        _merge_indexed_fna_parts(part_fps, output_fp, names, lengths)
+
+    if stats is not None:
+        stats.extend(_fna_stats(samples, lengths))
 
     return output_fp
 
 
+def generate_fna_shards(temp_path, samples, n_shards, n_jobs=1,
+                        stats=None):
+    """Splits the reverse and forward seqs of all samples in fasta shards
+
+    Parameters
+    ----------
+    temp_path : str
+        The directory where the fasta files are written
+    samples : list of tup
+        list of 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+    n_shards : int
+        The number of shards to generate
+    n_jobs : int, optional
+        The number of processes used to convert the samples
+    stats : list, optional
+        If given, the read statistics of each sample, as taken by
+        _write_read_stats, are appended to it
+
+    Returns
+    -------
+    list of str
+        The filepaths of the shards
+
+    Notes
+    -----
+    Every sample goes whole to a single shard; samples are assigned largest
+    first to the shard with the fewest bytes so the shards are balanced, and
+    keep their relative order within the shard. Reads are numbered as in
+    generate_fna_file so the merged results are the same as without shards,
+    and each shard has an index of its samples.
+    """
+    part_fps, lengths = _generate_fna_parts(temp_path, samples, n_jobs)
+    if stats is not None:
+        stats.extend(_fna_stats(samples, lengths))
+    n_shards = max(1, min(n_shards, len(part_fps)))
+
+    sizes = [0] * n_shards
+    shards = [[] for _ in range(n_shards)]
+    for i in sorted(range(len(part_fps)),
+                    key=lambda i: getsize(part_fps[i]), reverse=True):
+        shard = sizes.index(min(sizes))
+        sizes[shard] += getsize(part_fps[i])
+        shards[shard].append(i)
+
+    shard_fps = []
+    for shard, idx in enumerate(shards):
+        shard_fp = join(temp_path, 'combined.shard_%d.fna' % shard)
+        # the parts are appended to an existing file, e.g. one left by an
+        # interrupted run
+        if exists(shard_fp):
+            remove(shard_fp)
+        idx = sorted(idx)
+        _merge_indexed_fna_parts(
+            [part_fps[i] for i in idx], shard_fp,
+            [samples[i][1] for i in idx], [lengths[i] for i in idx])
+        shard_fps.append(shard_fp)
+
+    return shard_fps
+
+
+def _align_streamed(qclient, job_id, samples, temp_dir, parameters, msg,
+                    metrics, stats):
+    """Aligns the samples while they are converted to FNA
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    samples : list of tup
+        list of 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+    temp_dir : str
+        The directory where the aligner writes its output
+    parameters : dict
+        The formatted shogun parameters
+    msg : str
+        The step message, formatted with the number of finished commands
+    metrics : JobMetrics
+        The job metrics the aligner's resource usage is added to
+    stats : list
+        The read statistics of each sample are appended to it
+
+    Returns
+    -------
+    bool, str
+        Whether the alignment succeeded and the error message, if any
+
+    Notes
+    -----
+    combined.fna is a named pipe: a thread writes the samples to it, as
+    generate_fna_file does, while the aligner reads it, so decompressing and
+    aligning overlap and the FNA file is never written to disk.
+    """
+    fifo_fp = join(temp_dir, 'combined.fna')
+    if exists(fifo_fp):
+        remove(fifo_fp)
+    mkfifo(fifo_fp)
+
+    align_cmd = generate_shogun_align_commands(fifo_fp, temp_dir, parameters)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            writer = pool.submit(generate_fna_file, temp_dir, samples,
+                                 stats=stats)
+            success, error_msg = _run_commands(
+                qclient, job_id, align_cmd, msg, 'Shogun Align',
+                metrics=metrics)
+            # if the aligner exited without reading the whole pipe, or
+            # without opening it, opening and closing the reading end
+            # unblocks the writer, which then fails writing to it
+            while not writer.done():
+                close(os_open(fifo_fp, O_RDONLY | O_NONBLOCK))
+                wait([writer], timeout=1)
+            try:
+                writer.result()
+            except Exception as e:
+                # any error reading the samples, e.g. a corrupt gzip member
+                # raises zlib.error; a failed aligner is reported instead,
+                # its error is more useful
+                if success:
+                    success = False
+                    error_msg = 'Error converting to FNA for Shogun:\n%s' % e
+    finally:
+        remove(fifo_fp)
+
+    return success, error_msg
+
+
 def _format_params(parameters, func_params):
     params = {}
     # Loop through all of the commands alphabetically
@@ -68,10 +456,88 @@ def generate_shogun_align_commands(input_fp, temp_dir, parameters):
     return cmds
 
 
+def generate_shogun_sharded_align_commands(shard_fps, temp_dir, parameters):
+    """Generates one shogun align command per shard
+
+    Parameters
+    ----------
+    shard_fps : list of str
+        The fasta shards to align
+    temp_dir : str
+        The directory where the per shard output directories are created
+    parameters : dict
+        The formatted shogun parameters
+
+    Returns
+    -------
+    cmds : list of str
+        The shogun align commands
+    aln_fps : list of str
+        The alignment file generated by each command
+
+    Notes
+    -----
+    The threads are split evenly between the shards, with at least one
+    thread per shard.
+    """
+    threads = max(1, int(parameters['threads']) // len(shard_fps))
+    shard_params = dict(parameters, threads=threads)
+    aln_fn = 'alignment.%s.%s' % (parameters['aligner'],
+                                  ALN2EXT[parameters['aligner']])
+    cmds = []
+    aln_fps = []
+    for i, shard_fp in enumerate(shard_fps):
+        shard_dir = join(temp_dir, 'align_shard_%d' % i)
+        makedirs(shard_dir, exist_ok=True)
+        cmds.extend(generate_shogun_align_commands(
+            shard_fp, shard_dir, shard_params))
+        aln_fps.append(join(shard_dir, aln_fn))
+
+    return cmds, aln_fps
+
+
+def merge_shogun_alignments(aln_fps, temp_dir, parameters):
+    """Merges the shard alignments in the file assign_taxonomy expects
+
+    Parameters
+    ----------
+    aln_fps : list of str
+        The alignment files of the shards
+    temp_dir : str
+        The directory where the merged alignment is written
+    parameters : dict
+        The formatted shogun parameters
+
+    Returns
+    -------
+    str
+        The filepath of the merged alignment
+
+    Notes
+    -----
+    The shards' SAM headers are identical, as all the shards are aligned to
+    the same database, so only the first one is kept.
+    """
+    ext = ALN2EXT[parameters['aligner']]
+    output_fp = join(temp_dir, 'alignment.%s.%s' % (parameters['aligner'],
+                                                    ext))
+    with open(output_fp, 'wb') as output:
+        for i, aln_fp in enumerate(aln_fps):
+            with open(aln_fp, 'rb') as aln:
+                if ext == 'sam' and i > 0:
+                    for line in aln:
+                        if not line.startswith(b'@'):
+                            output.write(line)
+                            break
+                copyfileobj(aln, output)
+            remove(aln_fp)
+
+    return output_fp
+
+
 def generate_shogun_assign_taxonomy_commands(temp_dir, parameters):
     cmds = []
-    aln2ext = {'utree': 'tsv', 'burst': 'b6', 'bowtie2': 'sam'}
-    ext = aln2ext[parameters['aligner']]
+    ext = ALN2EXT[parameters['aligner']]
     output_fp = join(temp_dir, 'profile.tsv')
     cmds.append(
         'shogun assign_taxonomy '
@@ -138,6 +604,114 @@ def run_shogun_to_biom(in_fp, biom_in, out_dir, level, version):
     return output_fp
 
 
+def _run_biom_conversions(qclient, job_id, conversions, out_dir, msg,
+                          n_jobs=1):
+    """Converts the Shogun profiles to BIOM
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    job_id : str
+        The job id
+    conversions : list of tup
+        The in_fp, biom_in, level and version arguments of each
+        run_shogun_to_biom call
+    out_dir : str
+        The path to the job's output directory
+    msg : str
+        The job step, formatted with the number of conversions finished,
+        sent after each one
+    n_jobs : int, optional
+        The number of processes converting at the same time, which also
+        bounds the number of tables held in memory
+
+    Returns
+    -------
+    list of str
+        The BIOM filepaths, in the order of conversions
+    """
+    if n_jobs <= 1 or len(conversions) <= 1:
+        outputs = []
+        for in_fp, biom_in, level, version in conversions:
+            outputs.append(
+                run_shogun_to_biom(in_fp, biom_in, out_dir, level, version))
+            qclient.update_job_step(job_id, msg % len(outputs))
+        return(outputs)
+
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(conversions)),
+                             mp_context=POOL_CONTEXT) as pool:
+        futures = [pool.submit(run_shogun_to_biom, in_fp, biom_in, out_dir,
+                               level, version)
+                   for in_fp, biom_in, level, version in conversions]
+        for i, _ in enumerate(as_completed(futures), 1):
+            qclient.update_job_step(job_id, msg % i)
+
+    return([future.result() for future in futures])
+
+
+def _get_work_dir(samples, parameters):
+    """Returns the persistent directory for the intermediate files of a job
+
+    Parameters
+    ----------
+    samples : list of tup
+        list of 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+    parameters : dict
+        The formatted shogun parameters
+
+    Returns
+    -------
+    str or None
+        A directory in QC_SHOGUN_WORK_DP named after the sample names, the
+        paths, sizes and modification times of their files and the
+        parameters, so a retried job finds the files of the stages that
+        already finished; None if QC_SHOGUN_WORK_DP is not set
+
+    Notes
+    -----
+    The files are identified by their metadata instead of their contents so
+    the inputs aren't read before any work starts.
+    """
+    work_dp = environ.get('QC_SHOGUN_WORK_DP')
+    if not work_dp:
+        return None
+
+    parts = [dumps(parameters, sort_keys=True)]
+    for _, sample, f_fp, r_fp in samples:
+        parts.append(sample)
+        for fp in (f_fp, r_fp):
+            if fp is None:
+                parts.append('')
+            else:
+                st = stat(fp)
+                parts.append('%s:%d:%d' % (abspath(fp), st.st_size,
+                                           st.st_mtime_ns))
+    work_dir = join(work_dp, sha256('\0'.join(parts).encode()).hexdigest())
+    makedirs(work_dir, exist_ok=True)
+
+    return work_dir
+
+
+def _stage_outputs(work_dir, stage):
+    # Returns the outputs recorded when stage finished, None if it didn't
+    marker_fp = join(work_dir, '%s.done' % stage)
+    if not exists(marker_fp):
+        return None
+    with open(marker_fp) as f:
+        return load(f)
+
+
+def _finish_stage(work_dir, stage, outputs):
+    # Marks stage as finished; the marker is renamed into place so it only
+    # exists once it is complete
+    marker_fp = join(work_dir, '%s.done' % stage)
+    with open(marker_fp + '.tmp', 'w') as f:
+        dump(outputs, f)
+    rename(marker_fp + '.tmp', marker_fp)
+
+
+@_with_progress_reporter
 def shogun(qclient, job_id, parameters, out_dir):
     """Run Shogun with the given parameters
 
@@ -157,7 +731,10 @@ def shogun(qclient, job_id, parameters, out_dir):
     bool, list, str
         The results of the job
     """
+    metrics = JobMetrics()
+
     # Step 1 get the rest of the information need to run Atropos
+    metrics.stage('Collecting information')
     qclient.update_job_step(job_id, "Step 1 of 7: Collecting information")
     artifact_id = parameters['input']
     del parameters['input']
@@ -172,6 +749,7 @@ def shogun(qclient, job_id, parameters, out_dir):
     qiime_map = prep_info['qiime-map']
 
     # Step 2 converting to fna
+    metrics.stage('Converting to FNA')
     qclient.update_job_step(
         job_id, "Step 2 of 7: Converting to FNA for Shogun")
 
@@ -180,67 +758,154 @@ def shogun(qclient, job_id, parameters, out_dir):
         samples = make_read_pairs_per_sample(
             fps['raw_forward_seqs'], rs, qiime_map)
 
-        # Combining files
-        comb_fp = generate_fna_file(temp_dir, samples)
-
         # Formatting parameters
         parameters = _format_params(parameters, SHOGUN_PARAMS)
+        fna_mode = environ.get('QC_SHOGUN_FNA_MODE', 'file')
+        if fna_mode not in FNA_MODES:
+            return False, None, 'Unknown QC_SHOGUN_FNA_MODE: %s' % fna_mode
+
+        # When resuming, the intermediate files go to a persistent directory
+        # and the stages that already finished there are skipped
+        work_dir = _get_work_dir(samples, parameters)
+        if work_dir is not None:
+            temp_dir = work_dir
+
+        # With a core budget the aligners, split between the shards, and the
+        # FNA conversion use all the cores; the number of shards is still
+        # bounded by QC_PARALLEL_JOBS as each aligner loads the database
+        n_jobs = _get_n_jobs()
+        fna_jobs = n_jobs
+        core_budget = _get_core_budget()
+        if core_budget is not None:
+            parameters['threads'] = core_budget
+            fna_jobs = core_budget
+
+        # Combining files, in shards if we have threads for more than one
+        # aligner. The read statistics are collected while converting and
+        # kept with the FNA files, so a resumed job still has them. When
+        # streamed, the samples are combined while aligning them instead;
+        # that takes a single aligner that reads its input in one pass
+        fna_fps = _stage_outputs(temp_dir, 'fna')
+        n_shards = min(n_jobs, int(parameters['threads']), len(samples))
+        streamed = (fna_mode == 'streamed' and fna_fps is None and
+                    n_shards <= 1 and
+                    parameters['aligner'] in STREAMED_ALIGNERS)
+        if fna_fps is None and not streamed:
+            # the FNA files are appended to, so the partial ones left by an
+            # interrupted run have to go
+            _remove_fna_files(temp_dir)
+            stats = []
+            if n_shards > 1:
+                fna_fps = generate_fna_shards(
+                    temp_dir, samples, n_shards, n_jobs=fna_jobs,
+                    stats=stats)
+            else:
+                fna_fps = [generate_fna_file(
+                    temp_dir, samples, n_jobs=fna_jobs, stats=stats)]
+            _write_read_stats(temp_dir, stats)
+            _finish_stage(temp_dir, 'fna', fna_fps)
 
         # Step 3 align
+        metrics.stage('Aligning')
         sys_msg = "Step 3 of 7: Aligning FNA with Shogun (%d/{0})"
-        align_cmd = generate_shogun_align_commands(
-            comb_fp, temp_dir, parameters)
-        success, msg = _run_commands(
-            qclient, job_id, align_cmd, sys_msg, 'Shogun Align')
+        if _stage_outputs(temp_dir, 'align') is None:
+            if streamed:
+                stats = []
+                success, msg = _align_streamed(
+                    qclient, job_id, samples, temp_dir, parameters,
+                    "Step 3 of 7: Converting to FNA and aligning with Shogun "
+                    "(%d/1)", metrics, stats)
+            else:
+                if len(fna_fps) > 1:
+                    align_cmd, aln_fps = \
+                        generate_shogun_sharded_align_commands(
+                            fna_fps, temp_dir, parameters)
+                else:
+                    align_cmd = generate_shogun_align_commands(
+                        fna_fps[0], temp_dir, parameters)
+                success, msg = _run_commands(
+                    qclient, job_id, align_cmd, sys_msg, 'Shogun Align',
+                    n_jobs=len(align_cmd), metrics=metrics)
 
-        if not success:
-            return False, None, msg
+            if not success:
+                metrics.write(out_dir)
+                return False, None, msg
+
+            if streamed:
+                _write_read_stats(temp_dir, stats)
+            elif len(fna_fps) > 1:
+                merge_shogun_alignments(aln_fps, temp_dir, parameters)
+            _finish_stage(temp_dir, 'align', [])
+        stats_fp = join(temp_dir, READ_STATS_FN)
+        if exists(stats_fp):
+            copyfile(stats_fp, join(out_dir, READ_STATS_FN))
 
         # Step 4 taxonomic profile
+        metrics.stage('Taxonomic profile')
         sys_msg = "Step 4 of 7: Taxonomic profile with Shogun (%d/{0})"
         assign_cmd, profile_fp = generate_shogun_assign_taxonomy_commands(
             temp_dir, parameters)
-        success, msg = _run_commands(
-            qclient, job_id, assign_cmd, sys_msg, 'Shogun taxonomy assignment')
-        if not success:
-            return False, None, msg
-
-        # Step 5 redistribute profile
-        sys_msg = "Step 5 of 7: Redistributed profile with Shogun (%d/{0})"
+        if _stage_outputs(temp_dir, 'taxonomy') is None:
+            success, msg = _run_commands(
+                qclient, job_id, assign_cmd, sys_msg,
+                'Shogun taxonomy assignment', metrics=metrics)
+            if not success:
+                metrics.write(out_dir)
+                return False, None, msg
+            _finish_stage(temp_dir, 'taxonomy', [profile_fp])
+
+        # Steps 5 and 6 redistributed and functional profiles, these only
+        # read the taxonomic profile so they run at the same time. Each
+        # command is a stage of its own, so a retried job only runs the ones
+        # that didn't finish
+        metrics.stage('Redistributed and functional profiles')
+        profile_stages = {}
         levels = ['genus', 'species', 'strain']
         redist_fps = []
         for level in levels:
             redist_cmd, output = generate_shogun_redist_commands(
                 profile_fp, temp_dir, parameters, level)
             redist_fps.append(output)
-            success, msg = _run_commands(
-                qclient, job_id, redist_cmd, sys_msg, 'Shogun redistribute')
-            if not success:
-                return False, None, msg
+            profile_stages[redist_cmd[0]] = ('redist_%s' % level, output)
 
-        # Step 6 functional profile
-        sys_msg = "Step 6 of 7: Functional profile with Shogun (%d/{0})"
         levels = ['species']
         func_fp = ''
         for level in levels:
             func_cmd, output = generate_shogun_functional_commands(
                 profile_fp, temp_dir, parameters, level)
             func_fp = output
+            profile_stages[func_cmd[0]] = ('functional_%s' % level, output)
+
+        profile_cmds = [cmd for cmd, (stage, _) in profile_stages.items()
+                        if _stage_outputs(temp_dir, stage) is None]
+        sys_msg = ("Steps 5 and 6 of 7: Redistributed and functional "
+                   "profiles with Shogun (%d/{0})".format(len(profile_cmds)))
+        if profile_cmds:
+            outputs = {}
             success, msg = _run_commands(
-                qclient, job_id, func_cmd, sys_msg, 'Shogun functional')
+                qclient, job_id, profile_cmds, sys_msg,
+                'Shogun redistribute/functional', n_jobs=len(profile_cmds),
+                metrics=metrics, threads=dict.fromkeys(profile_cmds, 1),
+                core_budget=core_budget, outputs=outputs)
+            # the commands that finished keep their results even if another
+            # one failed
+            for cmd in profile_cmds:
+                if cmd in outputs:
+                    stage, output = profile_stages[cmd]
+                    _finish_stage(temp_dir, stage, [output])
             if not success:
+                metrics.write(out_dir)
                 return False, None, msg
-        # Step 6 functional profile
-        sys_msg = "Step 7 of 7: Converting results to BIOM (%d/{0})"
-        func_biom_outputs = []
-        redist_biom_outputs = []
+
+        # Step 7 converting to BIOM
+        metrics.stage('Converting to BIOM')
+        conversions = []
         # Converting redistributed files to biom
         redist_levels = ['genus', 'species', 'strain']
         for redist_fp, level in zip(redist_fps, redist_levels):
             biom_in = ["redist", None, '', True]
-            output = run_shogun_to_biom(
-                redist_fp, biom_in, out_dir, level, 'redist')
-            redist_biom_outputs.append(output)
+            conversions.append((redist_fp, biom_in, level, 'redist'))
+        n_redist = len(conversions)
         # Coverting funcitonal files to biom
         func_db_fp = shogun_db_functional_parser(parameters['database'])
         for level in levels:
@@ -258,13 +923,35 @@ def shogun(qclient, job_id, parameters, out_dir):
             for biom_in in func_to_biom_fps:
                 biom_in_fp = join(func_fp, "profile.%s.%s.txt"
                                   % (level, biom_in[0]))
-                output = run_shogun_to_biom(biom_in_fp, biom_in, out_dir,
-                                            level, 'func')
-                func_biom_outputs.append(output)
+                conversions.append((biom_in_fp, biom_in, level, 'func'))
+
+        # The annotation tables are compiled to their index, if they weren't
+        # yet, before the conversions look their ids up in them
+        for annotation_fp, annotation_type in sorted(
+                {tuple(biom_in[1:3]) for _, biom_in, _, _ in conversions
+                 if biom_in[1] is not None}):
+            compile_annotation_table(annotation_fp, annotation_type)
+
+        # The tables are independent of each other, so they are converted
+        # by up to QC_PARALLEL_JOBS processes
+        sys_msg = ("Step 7 of 7: Converting results to BIOM "
+                   "(%d/{0})".format(len(conversions)))
+        biom_outputs = _run_biom_conversions(
+            qclient, job_id, conversions, out_dir, sys_msg, n_jobs=n_jobs)
+        redist_biom_outputs = biom_outputs[:n_redist]
+        func_biom_outputs = biom_outputs[n_redist:]
+
+        # the job finished, its intermediate files are no longer needed
+        if work_dir is not None:
+            rmtree(work_dir)
 
     func_files_type_name = 'Functional Predictions'
     redist_files_type_name = 'Taxonomic Predictions'
     ainfo = [ArtifactInfo(func_files_type_name, 'BIOM', func_biom_outputs),
              ArtifactInfo(redist_files_type_name, 'BIOM', redist_biom_outputs)]
 
+    metrics.write(out_dir)
+    qclient.update_job_step(
+        job_id, "Step 7 of 7: Finished, %s" % metrics.summary())
+
     return True, ainfo, ""
@@ -9,26 +9,35 @@
 from unittest import main
 from qiita_client.testing import PluginTestCase
 import os
-from os import remove
-from os.path import exists, isdir, join
+from os import remove, listdir, makedirs
+from os.path import exists, isdir, join, basename, dirname
 from shutil import rmtree, copyfile
 from tempfile import TemporaryDirectory
 from qp_shogun import plugin
 from tempfile import mkdtemp
 from json import dumps
 from functools import partial
-from biom import Table
+from biom import Table, load_table
 import numpy as np
-from io import StringIO
+from io import StringIO, BytesIO
+from errno import EXDEV
+from unittest.mock import patch
+import sqlite3
 from qp_shogun.shogun.utils import (
-    get_dbs, get_dbs_list, generate_shogun_dflt_params,
+    get_dbs, get_dbs_list, generate_shogun_dflt_params, readfq, readfq_blocks,
     import_shogun_biom, shogun_db_functional_parser, shogun_parse_module_table,
-    shogun_parse_enzyme_table, shogun_parse_pathway_table)
+    shogun_parse_enzyme_table, shogun_parse_pathway_table,
+    load_annotation_table, read_shogun_profile, read_fna_index,
+    iter_fna_sample, compile_annotation_table, lookup_annotations,
+    _write_annotation_index)
 from qp_shogun.shogun.shogun import (
     generate_shogun_align_commands, _format_params,
     generate_shogun_assign_taxonomy_commands, generate_fna_file,
     generate_shogun_functional_commands, generate_shogun_redist_commands,
-    shogun)
+    generate_fna_shards, generate_shogun_sharded_align_commands,
+    merge_shogun_alignments, shogun, _get_work_dir, _stage_outputs,
+    _finish_stage, _merge_fna_parts, _run_biom_conversions,
+    _remove_fna_files, _copy_contents, _sendfile, _align_streamed)
 
 SHOGUN_PARAMS = {
     'Database': 'database', 'Aligner tool': 'aligner',
@@ -196,6 +205,193 @@ class ShogunTests(PluginTestCase):
 
         self.assertEqual(obs, exp)
 
+    def test_generate_fna_file_parallel(self):
+        out_dir = self.out_dir
+        samples = [
+            ('s1', 'SKB8.640193', 'support_files/kd_test_1_R1.fastq.gz',
+             'support_files/kd_test_1_R2.fastq.gz'),
+            ('s2', 'SKD8.640184', 'support_files/kd_test_2_R1.fastq.gz',
+             'support_files/kd_test_2_R2.fastq.gz')]
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            serial_fp = generate_fna_file(fp, samples)
+            with open(serial_fp) as f:
+                exp = f.read()
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            parallel_fp = generate_fna_file(fp, samples, n_jobs=2)
+            with open(parallel_fp) as f:
+                obs = f.read()
+            self.assertEqual(sorted(listdir(fp)),
+                             ['combined.fna', 'combined.fna.idx'])
+
+        self.assertEqual(obs, exp)
+        self.assertTrue(obs.startswith('>SKB8.640193_0\n'))
+
+    def test_generate_fna_file_stats(self):
+        out_dir = self.out_dir
+        samples = [
+            ('s1', 'SKB8.640193', 'support_files/kd_test_1_R1.fastq.gz',
+             'support_files/kd_test_1_R2.fastq.gz'),
+            ('s2', 'SKD8.640184', 'support_files/kd_test_2_R1.fastq.gz',
+             None)]
+        exp = [{'sample': 'SKB8.640193', 'reads_in': 5000,
+                'reads_out': 5000, 'bases_in': 750000, 'bases_out': 750000,
+                'length_histogram': {150: 5000}},
+               {'sample': 'SKD8.640184', 'reads_in': 2500,
+                'reads_out': 2500, 'bases_in': 375000, 'bases_out': 375000,
+                'length_histogram': {150: 2500}}]
+        for n_jobs in (1, 2):
+            with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+                obs = []
+                generate_fna_file(fp, samples, n_jobs=n_jobs, stats=obs)
+            self.assertEqual(obs, exp)
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            obs = []
+            generate_fna_shards(fp, samples, 2, stats=obs)
+        self.assertEqual(obs, exp)
+
+    def test_fna_index(self):
+        out_dir = self.out_dir
+        samples = [
+            ('s1', 'SKB8.640193', 'support_files/kd_test_1_R1.fastq.gz',
+             'support_files/kd_test_1_R2.fastq.gz'),
+            ('s2', 'SKD8.640184', 'support_files/kd_test_2_R1.fastq.gz',
+             None)]
+        for n_jobs in (1, 2):
+            with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+                fna_fp = generate_fna_file(fp, samples, n_jobs=n_jobs)
+                with open(fna_fp, 'rb') as f:
+                    records = list(readfq(StringIO(f.read().decode())))
+                index = read_fna_index(fna_fp)
+                self.assertEqual(list(index), ['SKB8.640193', 'SKD8.640184'])
+                self.assertEqual(index['SKB8.640193'][::2], (0, 5000))
+                self.assertEqual(index['SKD8.640184'][2], 2500)
+                self.assertEqual(sum(index['SKB8.640193'][:2]),
+                                 index['SKD8.640184'][0])
+                self.assertEqual(sum(index['SKD8.640184'][:2]),
+                                 os.path.getsize(fna_fp))
+
+                for sample, exp in [('SKB8.640193', records[:5000]),
+                                    ('SKD8.640184', records[5000:])]:
+                    # blocks smaller than the sample and than a record
+                    for block_size in (4194304, 100):
+                        obs = []
+                        for block in iter_fna_sample(
+                                fna_fp, sample, block_size=block_size):
+                            obs.extend((n.decode(), s.decode(), q)
+                                       for n, s, q in block)
+                        self.assertEqual(obs, exp)
+                with self.assertRaises(KeyError):
+                    list(iter_fna_sample(fna_fp, 'SKB8.640194', index))
+
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            shard_fps = generate_fna_shards(fp, samples, 2)
+            for shard_fp in shard_fps:
+                index = read_fna_index(shard_fp)
+                self.assertEqual(len(index), 1)
+                for sample, (offset, length, n_reads) in index.items():
+                    self.assertEqual(offset, 0)
+                    self.assertEqual(length, os.path.getsize(shard_fp))
+                    self.assertEqual(
+                        sum(map(len, iter_fna_sample(shard_fp, sample))),
+                        n_reads)
+
+    def test_merge_fna_parts(self):
+        out_dir = self.out_dir
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            part_fps = []
+            for i in range(3):
+                part_fps.append(join(fp, 'combined.%d.fna' % i))
+                with open(part_fps[-1], 'w') as f:
+                    f.write('>s%d_0\nACGT\n' % i)
+            output_fp = join(fp, 'combined.fna')
+            with open(output_fp, 'w') as f:
+                f.write('>s_0\nTTTT\n')
+
+            # appended to the existing file
+            _merge_fna_parts(part_fps[:2], output_fp)
+            with open(output_fp) as f:
+                self.assertEqual(
+                    f.read(), '>s_0\nTTTT\n>s0_0\nACGT\n>s1_0\nACGT\n')
+            self.assertEqual(sorted(listdir(fp)),
+                             ['combined.2.fna', 'combined.fna'])
+
+            # a new file is the first part
+            remove(output_fp)
+            _merge_fna_parts(part_fps[2:], output_fp)
+            with open(output_fp) as f:
+                self.assertEqual(f.read(), '>s2_0\nACGT\n')
+            self.assertEqual(listdir(fp), ['combined.fna'])
+
+    def test_copy_contents_fallback(self):
+        out_dir = self.out_dir
+
+        def unsupported(src_fd, dst_fd, count):
+            raise OSError(EXDEV, 'Invalid cross-device link')
+
+        def nothing(src_fd, dst_fd, count):
+            return 0
+
+        def partial_copy(src_fd, dst_fd, count):
+            # copies 4 bytes, then stops
+            if os.lseek(src_fd, 0, os.SEEK_CUR):
+                return 0
+            return os.sendfile(dst_fd, src_fd, None, 4)
+
+        def copy(output_fp, copy_file_range, sendfile):
+            with patch('qp_shogun.shogun.shogun.copy_file_range',
+                       copy_file_range), \
+                    patch('qp_shogun.shogun.shogun._sendfile', sendfile):
+                with open(part_fp, 'rb') as part, \
+                        open(output_fp, 'wb') as output:
+                    _copy_contents(part, output)
+            with open(output_fp) as f:
+                return f.read()
+
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            part_fp = join(fp, 'combined.0.fna')
+            with open(part_fp, 'w') as f:
+                f.write('>s0_0\nACGT\n>s0_1\nTTTT\n')
+            output_fp = join(fp, 'combined.fna')
+            exp = '>s0_0\nACGT\n>s0_1\nTTTT\n'
+
+            # not supported by the file system, the next method is used
+            self.assertEqual(copy(output_fp, unsupported, _sendfile), exp)
+            # nothing copied, copyfileobj is used
+            self.assertEqual(copy(output_fp, unsupported, nothing), exp)
+            self.assertEqual(copy(output_fp, nothing, nothing), exp)
+            # a copy that stops part way is an error
+            with self.assertRaisesRegex(OSError, 'Copied 4 of the 22 bytes'):
+                copy(output_fp, partial_copy, nothing)
+            with self.assertRaisesRegex(OSError, 'Copied 4 of the 22 bytes'):
+                copy(output_fp, unsupported, partial_copy)
+
+    def _assert_readfq_blocks(self, data):
+        exp = [(n.encode(), s.encode(), q if q is None else q.encode())
+               for n, s, q in readfq(StringIO(data))]
+        for block_size in [1, 5, 16, 4194304]:
+            obs = []
+            for records in readfq_blocks(BytesIO(data.encode()), block_size):
+                obs.extend(records)
+            self.assertEqual(obs, exp)
+
+    def test_readfq_blocks_fastq(self):
+        self._assert_readfq_blocks(
+            '@r1 1:N:0\nACGT\n+\nFFFF\n'
+            '@r2 1:N:0\nAC\nGT\n+r2\n@F\nFF\n'
+            '@r3\n\n+\n\n'
+            '@r4\nACGTA\n+\nFFFFF\n')
+
+    def test_readfq_blocks_fasta(self):
+        self._assert_readfq_blocks(
+            '>s1 some description\nACGT\nAC\n'
+            '>s2\nGGGG\n'
+            '>s3\n\n>s4\nTT\n')
+
+    def test_readfq_blocks_truncated(self):
+        data = '@r1\nACGT\n+\nFFFF\n@r2\nACGTAC\n+\nFFF'
+        for i in range(len(data)):
+            self._assert_readfq_blocks(data[:i])
+
     def test_shogun_db_functional_parser(self):
         db_path = self.params['Database']
         func_prefix = 'function/ko'
@@ -223,6 +419,116 @@ class ShogunTests(PluginTestCase):
 
         self.assertDictEqual(self.path_md, out_table)
 
+    def test_load_annotation_table(self):
+        fp = join(self.out_dir, 'ko-module-annotations.txt')
+        with open(fp, 'w') as f:
+            f.write(self.modules)
+
+        self.assertDictEqual(load_annotation_table(fp, 'module'), self.mod_md)
+        # second call is served from the cache, which is only in memory
+        self.assertDictEqual(load_annotation_table(fp, 'module'), self.mod_md)
+        self.assertEqual(listdir(self.out_dir), ['ko-module-annotations.txt'])
+
+        # changing the table invalidates the cache
+        with open(fp, 'w') as f:
+            f.write(self.modules.split('\n')[0])
+        self.assertDictEqual(load_annotation_table(fp, 'module'),
+                             {'M00017': self.mod_md['M00017']})
+
+        # file-like objects are parsed
+        self.assertDictEqual(
+            load_annotation_table(StringIO(self.enzymes), 'enzyme'),
+            self.enz_md)
+
+    def test_lookup_annotations(self):
+        fp = join(self.out_dir, 'ko-module-annotations.txt')
+        with open(fp, 'w') as f:
+            f.write(self.modules)
+        index_fp = join(self.out_dir,
+                        '.ko-module-annotations.txt.module.sqlite')
+
+        self.assertEqual(compile_annotation_table(fp, 'module'), index_fp)
+        self.assertEqual(
+            lookup_annotations(fp, 'module', ['M00018', 'M99999']),
+            {'M00018': self.mod_md['M00018']})
+        self.assertEqual(lookup_annotations(fp, 'module', []), {})
+        # the index is the only file written
+        self.assertEqual(sorted(listdir(self.out_dir)),
+                         ['.ko-module-annotations.txt.module.sqlite',
+                          'ko-module-annotations.txt'])
+
+        # changing the table compiles the index again
+        with open(fp, 'w') as f:
+            f.write(self.modules.split('\n')[0])
+        self.assertEqual(
+            lookup_annotations(fp, 'module', ['M00017', 'M00018']),
+            {'M00017': self.mod_md['M00017']})
+
+        # as does corrupting it
+        with open(index_fp, 'w') as f:
+            f.write('not a database')
+        self.assertEqual(
+            lookup_annotations(fp, 'module', ['M00017', 'M00018']),
+            {'M00017': self.mod_md['M00017']})
+
+        # a read only database has its index in the registry directory
+        registry_dir = join(self.out_dir, 'registry')
+        os.environ['QC_REGISTRY_DP'] = registry_dir
+        self.addCleanup(os.environ.pop, 'QC_REGISTRY_DP')
+
+        def read_only(index_fp, *args):
+            if index_fp.startswith(join(self.out_dir, '.ko-')):
+                raise sqlite3.OperationalError(
+                    'attempt to write a readonly database')
+            return _write_annotation_index(index_fp, *args)
+
+        remove(index_fp)
+        with patch('qp_shogun.shogun.utils._write_annotation_index',
+                   read_only):
+            index_fp = compile_annotation_table(fp, 'module')
+            self.assertEqual(dirname(index_fp), registry_dir)
+            self.assertEqual(
+                lookup_annotations(fp, 'module', ['M00017', 'M00018']),
+                {'M00017': self.mod_md['M00017']})
+        self.assertEqual(listdir(registry_dir), [basename(index_fp)])
+        self.assertFalse(exists(join(
+            self.out_dir, '.ko-module-annotations.txt.module.sqlite')))
+
+        # file-like objects are parsed
+        self.assertEqual(
+            lookup_annotations(StringIO(self.enzymes), 'enzyme',
+                               ['K00002', 'K00004']),
+            {'K00002': self.enz_md['K00002']})
+
+        # the BIOM table is the same either way
+        fp = join(self.out_dir, 'ko-enzyme-annotations.txt')
+        with open(fp, 'w') as f:
+            f.write(self.enzymes)
+        profile = '#OTU ID\t1450\nK00002\t3\nK00009\t1\n'
+        self.assertEqual(
+            import_shogun_biom(StringIO(profile), fp, 'enzyme', True),
+            import_shogun_biom(StringIO(profile), StringIO(self.enzymes),
+                               'enzyme', True))
+
+    def test_read_shogun_profile(self):
+        shogun_table = ('#OTU ID\t1450\t2563\t3001\n'
+                        'k__Archaea\t26\t0\t0.0\n'
+                        'k__Archaea;p__Crenarchaeota\t0\t0\t0\n'
+                        'k__Bacteria\t0\t2.5\t1\n')
+
+        obs_data, obs_obs_ids, obs_sample_ids = read_shogun_profile(
+            StringIO(shogun_table))
+
+        self.assertEqual(obs_obs_ids, ['k__Archaea',
+                                       'k__Archaea;p__Crenarchaeota',
+                                       'k__Bacteria'])
+        self.assertEqual(obs_sample_ids, ['1450', '2563', '3001'])
+        # only the non-zero values are stored
+        self.assertEqual(obs_data.nnz, 3)
+        np.testing.assert_array_equal(
+            obs_data.toarray(), np.array([[26, 0, 0], [0, 0, 0],
+                                          [0, 2.5, 1]]))
+
     def test_import_shogun_biom(self):
         shogun_table = ('#OTU ID\t1450\t2563\n'
                         'k__Archaea\t26\t25\n'
@@ -328,6 +634,61 @@ class ShogunTests(PluginTestCase):
 
         self.assertEqual(exp_empty_biom, obs_empty_biom)
 
+    def test_run_biom_conversions(self):
+        class StepRecorder(list):
+            # records each step with the number of tables converted by then
+            def __init__(self, out_dir):
+                self.out_dir = out_dir
+
+            def update_job_step(self, job_id, new_step):
+                self.append((new_step, len(listdir(self.out_dir))))
+
+        in_dir = mkdtemp()
+        self._clean_up_files.append(in_dir)
+        enzyme_fp = join(in_dir, 'ko-enzyme-annotations.txt')
+        with open(enzyme_fp, 'w') as f:
+            f.write(self.enzymes)
+        conversions = []
+        for i, level in enumerate(['genus', 'species', 'strain']):
+            fp = join(in_dir, 'redist.%s.txt' % level)
+            with open(fp, 'w') as f:
+                f.write('#OTU ID\ts1\ts2\nk__A;p__B\t%d\t2\n'
+                        'k__A;p__C\t1\t%d\n' % (i, i + 3))
+            conversions.append(
+                (fp, ["redist", None, '', True], level, 'redist'))
+        fp = join(in_dir, 'profile.species.kegg.txt')
+        with open(fp, 'w') as f:
+            f.write('#OTU ID\ts1\ts2\nK00001\t4\t0\nK00003\t1\t7\n')
+        conversions.append(
+            (fp, ["kegg", enzyme_fp, 'enzyme', True], 'species', 'func'))
+
+        serial_dir = join(self.out_dir, 'serial')
+        parallel_dir = join(self.out_dir, 'parallel')
+        makedirs(serial_dir)
+        makedirs(parallel_dir)
+        # the steps are sent once the conversions finish
+        steps = StepRecorder(serial_dir)
+        serial = _run_biom_conversions(
+            steps, 'job-id', conversions, serial_dir, 'Converting (%d/4)')
+        self.assertEqual(steps, [('Converting (%d/4)' % i, i)
+                                 for i in range(1, 5)])
+        steps = StepRecorder(parallel_dir)
+        parallel = _run_biom_conversions(
+            steps, 'job-id', conversions, parallel_dir, 'Converting (%d/4)',
+            n_jobs=3)
+        self.assertEqual([step for step, _ in steps],
+                         ['Converting (%d/4)' % i for i in range(1, 5)])
+        for i, (_, n_converted) in enumerate(steps, 1):
+            self.assertGreaterEqual(n_converted, i)
+
+        exp = ['otu_table.redist.genus.biom', 'otu_table.redist.species.biom',
+               'otu_table.redist.strain.biom',
+               'otu_table.func.species.kegg.biom']
+        self.assertEqual([basename(fp) for fp in serial], exp)
+        self.assertEqual([basename(fp) for fp in parallel], exp)
+        for serial_fp, parallel_fp in zip(serial, parallel):
+            self.assertEqual(load_table(serial_fp), load_table(parallel_fp))
+
     def test_format_shogun_params(self):
         obs = _format_params(self.params, SHOGUN_PARAMS)
         exp = {
@@ -355,6 +716,225 @@ class ShogunTests(PluginTestCase):
 
         self.assertEqual(obs_cmd, exp_cmd)
 
+    def test_generate_fna_shards(self):
+        out_dir = self.out_dir
+        samples = [
+            ('s1', 'SKB8.640193', 'support_files/kd_test_1_R1.fastq.gz',
+             'support_files/kd_test_1_R2.fastq.gz'),
+            ('s2', 'SKD8.640184', 'support_files/kd_test_2_R1.fastq.gz',
+             'support_files/kd_test_2_R2.fastq.gz')]
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            with open(generate_fna_file(fp, samples)) as f:
+                exp = f.read()
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            obs_fps = generate_fna_shards(fp, samples, 2)
+            self.assertEqual(obs_fps, [join(fp, 'combined.shard_0.fna'),
+                                       join(fp, 'combined.shard_1.fna')])
+            obs = []
+            for shard_fp in obs_fps:
+                with open(shard_fp) as f:
+                    obs.append(f.read())
+
+        # each sample goes to a shard, with the same reads and numbering
+        self.assertEqual(''.join(sorted(obs)), exp)
+
+    def test_generate_fna_shards_retry(self):
+        out_dir = self.out_dir
+        samples = [
+            ('s1', 'SKB8.640193', 'support_files/kd_test_1_R1.fastq.gz',
+             'support_files/kd_test_1_R2.fastq.gz'),
+            ('s2', 'SKD8.640184', 'support_files/kd_test_2_R1.fastq.gz',
+             'support_files/kd_test_2_R2.fastq.gz')]
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as fp:
+            exp = []
+            for shard_fp in generate_fna_shards(fp, samples, 2):
+                with open(shard_fp) as f:
+                    exp.append(f.read())
+
+            # a run interrupted after writing the shards, before marking
+            # the stage as finished, leaves them and maybe some parts
+            with open(join(fp, 'combined.1.fna'), 'w') as f:
+                f.write('>SKD8.640184_0\nAC')
+            obs = []
+            for shard_fp in generate_fna_shards(fp, samples, 2):
+                with open(shard_fp) as f:
+                    obs.append(f.read())
+            self.assertEqual(obs, exp)
+
+            # shogun removes every FNA file before converting again
+            _remove_fna_files(fp)
+            self.assertEqual(listdir(fp), [])
+
+    def test_generate_shogun_sharded_align_commands(self):
+        out_dir = self.out_dir
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as temp_dir:
+            shard_fps = [join(temp_dir, 'combined.shard_0.fna'),
+                         join(temp_dir, 'combined.shard_1.fna')]
+            params = _format_params(self.params, SHOGUN_PARAMS)
+            params['threads'] = 5
+            exp_cmd = [
+                ('shogun align --aligner bowtie2 --threads 2 '
+                 '--database %sshogun --input %s '
+                 '--output %s') %
+                (self.db_path, shard_fps[i],
+                 join(temp_dir, 'align_shard_%d' % i)) for i in range(2)]
+            exp_aln_fps = [
+                join(temp_dir, 'align_shard_%d' % i, 'alignment.bowtie2.sam')
+                for i in range(2)]
+            obs_cmd, obs_aln_fps = generate_shogun_sharded_align_commands(
+                shard_fps, temp_dir, params)
+            self.assertTrue(isdir(join(temp_dir, 'align_shard_1')))
+
+        self.assertEqual(obs_cmd, exp_cmd)
+        self.assertEqual(obs_aln_fps, exp_aln_fps)
+
+    def test_get_work_dir(self):
+        samples = [
+            ('s1', 'SKB8.640193', 'support_files/kd_test_1_R1.fastq.gz',
+             'support_files/kd_test_1_R2.fastq.gz'),
+            ('s2', 'SKD8.640184', 'support_files/kd_test_2_R1.fastq.gz',
+             None)]
+        params = {'database': self.db_path, 'aligner': 'bowtie2',
+                  'threads': 2}
+
+        self.assertIsNone(_get_work_dir(samples, params))
+
+        work_dp = mkdtemp()
+        self._clean_up_files.append(work_dp)
+        os.environ['QC_SHOGUN_WORK_DP'] = work_dp
+        try:
+            work_dir = _get_work_dir(samples, params)
+            self.assertTrue(isdir(work_dir))
+            self.assertEqual(listdir(work_dp), [os.path.basename(work_dir)])
+            # same inputs and parameters, same directory
+            self.assertEqual(_get_work_dir(samples, params), work_dir)
+            # anything else is a different directory
+            self.assertNotEqual(
+                _get_work_dir(samples, dict(params, threads=4)), work_dir)
+            self.assertNotEqual(_get_work_dir(samples[:1], params), work_dir)
+        finally:
+            del os.environ['QC_SHOGUN_WORK_DP']
+
+    def test_stage_markers(self):
+        work_dir = mkdtemp()
+        self._clean_up_files.append(work_dir)
+
+        self.assertIsNone(_stage_outputs(work_dir, 'fna'))
+        _finish_stage(work_dir, 'fna', [join(work_dir, 'combined.fna')])
+        self.assertEqual(_stage_outputs(work_dir, 'fna'),
+                         [join(work_dir, 'combined.fna')])
+        self.assertEqual(listdir(work_dir), ['fna.done'])
+
+    def test_shogun_resume(self):
+        class LocalQiita(list):
+            # answers the calls of a job on the samples in map_fp, and
+            # records its steps
+            def __init__(self, fps, map_fp):
+                self.fps = fps
+                self.map_fp = map_fp
+
+            def get(self, url):
+                if url.startswith('/qiita_db/artifacts/'):
+                    return {'files': self.fps, 'prep_information': [1]}
+                return {'qiime-map': self.map_fp}
+
+            def update_job_step(self, job_id, new_step):
+                self.append(new_step)
+
+        map_fp = join(self.out_dir, 'prep.tsv')
+        with open(map_fp, 'w') as f:
+            f.write('#SampleID\trun_prefix\nSKB8.640193\tkd_test_1\n'
+                    'SKD8.640184\tkd_test_2\n')
+        fps = {'raw_forward_seqs': ['support_files/kd_test_1_R1.fastq.gz',
+                                    'support_files/kd_test_2_R1.fastq.gz'],
+               'raw_reverse_seqs': ['support_files/kd_test_1_R2.fastq.gz',
+                                    'support_files/kd_test_2_R2.fastq.gz']}
+        samples = [
+            ('kd_test_1', 'SKB8.640193',
+             'support_files/kd_test_1_R1.fastq.gz',
+             'support_files/kd_test_1_R2.fastq.gz'),
+            ('kd_test_2', 'SKD8.640184',
+             'support_files/kd_test_2_R1.fastq.gz',
+             'support_files/kd_test_2_R2.fastq.gz')]
+
+        work_dp = mkdtemp()
+        self._clean_up_files.append(work_dp)
+        os.environ['QC_SHOGUN_WORK_DP'] = work_dp
+        self.addCleanup(os.environ.pop, 'QC_SHOGUN_WORK_DP')
+        work_dir = _get_work_dir(
+            samples, _format_params(self.params, SHOGUN_PARAMS))
+
+        # a job that failed while running the redistributed strain profile
+        _finish_stage(work_dir, 'fna', [join(work_dir, 'combined.fna')])
+        for stage in ['align', 'taxonomy', 'redist_genus', 'redist_species',
+                      'functional_species']:
+            _finish_stage(work_dir, stage, [])
+
+        qclient = LocalQiita(fps, map_fp)
+        success, ainfo, msg = shogun(
+            qclient, 'job-id', dict(self.params, input=1), self.out_dir)
+
+        # only the stage without a marker ran again, and failed as the
+        # taxonomic profile isn't there
+        self.assertFalse(success)
+        self.assertIn('--level strain', msg)
+        self.assertNotIn('--level genus', msg)
+        self.assertIn('Steps 5 and 6 of 7: Redistributed and functional '
+                      'profiles with Shogun (0/1)', qclient)
+        self.assertFalse(any(step.startswith(('Step 3', 'Step 4'))
+                             for step in qclient))
+        self.assertEqual(sorted(listdir(work_dir)), [
+            'align.done', 'fna.done', 'functional_species.done',
+            'redist_genus.done', 'redist_species.done', 'taxonomy.done'])
+
+    def test_align_streamed_corrupt_input(self):
+        def aligner(qclient, job_id, commands, msg, cmd_name, metrics):
+            # reads the whole named pipe, as bowtie2 does
+            with open(commands[0].split(' --input ')[1].split()[0]) as f:
+                f.read()
+            return True, ''
+
+        fp = join(self.out_dir, 'corrupt_R1.fastq.gz')
+        with open(fp, 'wb') as f:
+            # a valid gzip header followed by an invalid deflate block
+            f.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03' +
+                    b'\xff' * 100)
+        samples = [('s1', 'SKB8.640193', fp, None)]
+        temp_dir = join(self.out_dir, 'temp')
+        makedirs(temp_dir)
+        params = _format_params(self.params, SHOGUN_PARAMS)
+
+        with patch('qp_shogun.shogun.shogun._run_commands', aligner):
+            success, msg = _align_streamed(
+                None, 'job-id', samples, temp_dir, params, 'Aligning', None,
+                [])
+        self.assertFalse(success)
+        self.assertIn('Error converting to FNA for Shogun', msg)
+        self.assertIn('invalid block type', msg)
+        self.assertEqual(listdir(temp_dir), [])
+
+    def test_merge_shogun_alignments(self):
+        out_dir = self.out_dir
+        params = _format_params(self.params, SHOGUN_PARAMS)
+        with TemporaryDirectory(dir=out_dir, prefix='shogun_') as temp_dir:
+            aln_fps = [join(temp_dir, 'shard_0.sam'),
+                       join(temp_dir, 'shard_1.sam')]
+            for i, aln_fp in enumerate(aln_fps):
+                with open(aln_fp, 'w') as f:
+                    f.write('@HD\tVN:1.0\n@SQ\tSN:ref\tLN:10\n'
+                            'SKB8.640193_%d\t0\tref\n' % i)
+            obs_fp = merge_shogun_alignments(aln_fps, temp_dir, params)
+            with open(obs_fp) as f:
+                obs = f.read()
+
+            self.assertEqual(obs_fp,
+                             join(temp_dir, 'alignment.bowtie2.sam'))
+            self.assertFalse(exists(aln_fps[0]))
+
+        self.assertEqual(obs, '@HD\tVN:1.0\n@SQ\tSN:ref\tLN:10\n'
+                              'SKB8.640193_0\t0\tref\n'
+                              'SKB8.640193_1\t0\tref\n')
+
     def test_generate_shogun_assign_taxonomy_commands(self):
         out_dir = self.out_dir
         with TemporaryDirectory(dir=out_dir, prefix='shogun_') as temp_dir:
@@ -491,6 +1071,70 @@ class ShogunTests(PluginTestCase):
         self.assertEqual(obs_func_fps, exp_func_fps)
         self.assertEqual(obs_redist_fps, exp_redist_fps)
 
+    def test_shogun_bt2_streamed(self):
+        # generating filepaths
+        in_dir = mkdtemp()
+        self._clean_up_files.append(in_dir)
+
+        fp1_1 = join(in_dir, 'S22205_S104_L001_R1_001.fastq.gz')
+        fp1_2 = join(in_dir, 'S22205_S104_L001_R2_001.fastq.gz')
+        fp2_1 = join(in_dir, 'S22282_S102_L001_R1_001.fastq.gz')
+        fp2_2 = join(in_dir, 'S22282_S102_L001_R2_001.fastq.gz')
+
+        copyfile('support_files/S22205_S104_L001_R1_001.fastq.gz', fp1_1)
+        copyfile('support_files/S22205_S104_L001_R2_001.fastq.gz', fp1_2)
+        copyfile('support_files/S22282_S102_L001_R1_001.fastq.gz', fp2_1)
+        copyfile('support_files/S22282_S102_L001_R2_001.fastq.gz', fp2_2)
+
+        # inserting new prep template
+        prep_info_dict = {
+            'SKB8.640193': {'run_prefix': 'S22205_S104'},
+            'SKD8.640184': {'run_prefix': 'S22282_S102'}}
+        data = {'prep_info': dumps(prep_info_dict),
+                # magic #1 = testing study
+                'study': 1,
+                'data_type': 'Metagenomic'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        # inserting artifacts
+        data = {
+            'filepaths': dumps([
+                (fp1_1, 'raw_forward_seqs'),
+                (fp1_2, 'raw_reverse_seqs'),
+                (fp2_1, 'raw_forward_seqs'),
+                (fp2_2, 'raw_reverse_seqs')]),
+            'type': "per_sample_FASTQ",
+            'name': "Test Shogun artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        self.params['input'] = aid
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['qp-shogun', '0.0.1', 'Shogun']),
+                'status': 'running',
+                'parameters': dumps(self.params)}
+        jid = self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+        # the same job, writing the FNA file and streaming it to the aligner
+        results = {}
+        for mode in ('file', 'streamed'):
+            out_dir = mkdtemp()
+            self._clean_up_files.append(out_dir)
+            os.environ['QC_SHOGUN_FNA_MODE'] = mode
+            try:
+                success, ainfo, msg = shogun(
+                    self.qclient, jid, dict(self.params), out_dir)
+            finally:
+                del os.environ['QC_SHOGUN_FNA_MODE']
+            self.assertEqual("", msg)
+            self.assertTrue(success)
+            with open(join(out_dir, 'read_stats.tsv')) as f:
+                results[mode] = [f.read()]
+            for a in ainfo:
+                results[mode].extend(load_table(fp) for fp in a.files)
+
+        self.assertEqual(results['streamed'], results['file'])
+
     def test_shogun_burst(self):
         # generating filepaths
         in_dir = mkdtemp()
@@ -12,9 +12,18 @@
 # ------------------------------------------------------------------------------
 
 import os
-from os.path import join, isdir
+import sqlite3
+from json import dumps, loads
+from mmap import mmap, ACCESS_READ, ALLOCATIONGRANULARITY
+from os.path import join, abspath, basename, dirname, exists
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 from biom import Table
+from qp_shogun.utils import (
+    get_registered_dbs, get_registered_metadata, _registry_dir)
 
 ALIGNERS = ["utree", "burst", "bowtie2"]
 
@@ -22,10 +31,8 @@ ALIGNERS = ["utree", "burst", "bowtie2"]
 def get_dbs(db_folder):
     dbs = {}
     # Loop through the databases and create a dict of them
-    for folder in os.listdir(db_folder):
-        folder_path = join(db_folder, folder)
-        if isdir(folder_path):
-            dbs[folder] = folder_path
+    for folder in get_registered_dbs(db_folder):
+        dbs[folder] = join(db_folder, folder)
 
     return(dbs)
 
@@ -33,10 +40,8 @@ def get_dbs(db_folder):
 def get_dbs_list(db_folder):
     dbs = []
     # Loop through the databases and create a list string
-    for folder in sorted(os.listdir(db_folder)):
-        folder_path = join(db_folder, folder)
-        if isdir(folder_path):
-            dbs.append(folder_path)
+    for folder in get_registered_dbs(db_folder):
+        dbs.append(join(db_folder, folder))
     dbs_formatted = (', '.join('"' + item + '"' for item in dbs))
 
     return(dbs_formatted)
@@ -91,11 +96,209 @@ def readfq(fp):  # this is a generator function
                 break
 
 
-def shogun_db_functional_parser(db_path):
-    # Metadata file path
-    md_fp = join(db_path, 'metadata.yaml')
+def _iter_line_blocks(fp, block_size):
+    # Yields the lines of the binary file fp, without their newline, in lists
+    # covering block_size bytes; a line split between two reads is kept
+    # whole in the second list
+    rest = b''
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        yield lines
+    if rest:
+        # like readfq, which drops the last character of every line, a last
+        # line without a newline loses its last character
+        yield [rest[:-1]]
+
+
+def _parse_fq_lines(lines, eof):
+    # Parses the records in lines the same way readfq does. Returns the
+    # parsed records and the index of the first line of the first record
+    # that is not complete yet, unless eof is set
+    records = []
+    append = records.append
+    n = len(lines)
+    i = 0
+    while i < n:
+        header = lines[i]
+        if not header.startswith((b'>', b'@')):
+            i += 1
+            continue
+
+        # fast path: 4-line fastq record
+        if i + 3 < n:
+            seq = lines[i + 1]
+            qual = lines[i + 3]
+            if (lines[i + 2].startswith(b'+') and len(qual) >= len(seq) and
+                    not seq.startswith((b'@', b'+', b'>'))):
+                append((header[1:].partition(b' ')[0], seq, qual))
+                i += 4
+                continue
+
+        name = header[1:].partition(b' ')[0]
+        j = i + 1
+        while j < n and not lines[j].startswith((b'@', b'+', b'>')):
+            j += 1
+        if j == n and not eof:
+            return records, i
+        seq = b''.join(lines[i + 1:j])
+        if j == n or not lines[j].startswith(b'+'):
+            # this is a fasta record
+            append((name, seq, None))
+            i = j
+            continue
+
+        # this is a fastq record, read the quality
+        k, leng, done = j + 1, 0, False
+        while k < n:
+            leng += len(lines[k])
+            k += 1
+            if leng >= len(seq):
+                done = True
+                break
+        if done:
+            append((name, seq, b''.join(lines[j + 1:k])))
+            i = k
+        elif not eof:
+            return records, i
+        else:
+            # reach EOF before reading enough quality
+            append((name, seq, None))
+            i = n
+
+    return records, n
+
+
+def readfq_blocks(fp, block_size=4194304):
+    """Parses a fasta/fastq file in blocks of records
+
+    Parameters
+    ----------
+    fp : file-like
+        The file to parse, opened in binary mode
+    block_size : int, optional
+        The number of bytes read from fp at a time
+
+    Returns
+    -------
+    generator of list of tup
+        Lists of (name, seq, qual) records, as bytes, in file order; qual is
+        None for fasta records
+
+    Notes
+    -----
+    The records are the same ones that readfq yields, including for
+    truncated files, but work is done on whole blocks of undecoded lines
+    instead of line by line.
+    """
+    lines = []
+    for block in _iter_line_blocks(fp, block_size):
+        if lines:
+            lines.extend(block)
+        else:
+            lines = block
+        records, start = _parse_fq_lines(lines, False)
+        if records:
+            yield records
+        lines = lines[start:]
+
+    records, _ = _parse_fq_lines(lines, True)
+    if records:
+        yield records
+
+
+FNA_INDEX_COLUMNS = ['sample', 'offset', 'length', 'n_reads']
+
+
+def fna_index_fp(fna_fp):
+    # The sidecar index written next to a FNA file
+    return(fna_fp + '.idx')
+
+
+def read_fna_index(fna_fp):
+    """Reads the sample index of a FNA file written by generate_fna_file
+
+    Parameters
+    ----------
+    fna_fp : str
+        The FNA file
+
+    Returns
+    -------
+    dict of {str: (int, int, int)}
+        The offset and length, in bytes, and the number of reads of each
+        sample, in file order
+    """
+    index = {}
+    with open(fna_index_fp(fna_fp)) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header != FNA_INDEX_COLUMNS:
+            raise ValueError('Not a FNA index: %s' % fna_index_fp(fna_fp))
+        for line in f:
+            sample, offset, length, n_reads = line.rstrip('\n').split('\t')
+            index[sample] = (int(offset), int(length), int(n_reads))
+
+    return(index)
+
+
+def iter_fna_sample(fna_fp, sample, index=None, block_size=4194304):
+    """Parses the reads of a single sample of a FNA file
+
+    Parameters
+    ----------
+    fna_fp : str
+        The FNA file, with its sample index
+    sample : str
+        The sample name
+    index : dict, optional
+        The index, as returned by read_fna_index, which is read if not given
+    block_size : int, optional
+        The number of bytes parsed at a time
+
+    Returns
+    -------
+    generator of list of tup
+        Lists of (name, seq, None) records, as bytes, as readfq_blocks
+        yields them
+
+    Raises
+    ------
+    KeyError
+        If the sample is not in the file
+
+    Notes
+    -----
+    Only the sample's byte range is memory mapped, so the cost depends on
+    the size of the sample and not of the file.
+    """
+    if index is None:
+        index = read_fna_index(fna_fp)
+    offset, length, _ = index[sample]
+    if length == 0:
+        return
+
+    # mmap offsets have to be a multiple of the allocation granularity
+    start = offset - offset % ALLOCATIONGRANULARITY
+    with open(fna_fp, 'rb') as f, \
+            mmap(f.fileno(), offset + length - start, offset=start,
+                 access=ACCESS_READ) as mm:
+        mm.seek(offset - start)
+        yield from readfq_blocks(mm, block_size)
+
+
+def _parse_function_prefix(md_fp):
     metadata = pd.read_csv(md_fp, sep=':', index_col=0)
-    func_prefix = metadata.loc['function'].values[0].strip()
+    return metadata.loc['function'].values[0].strip()
+
+
+def shogun_db_functional_parser(db_path):
+    # The functional prefix from the metadata file, through the registry so
+    # the file is only parsed when it changes
+    func_prefix = get_registered_metadata(
+        db_path, 'metadata.yaml', _parse_function_prefix)
     fp_array = {
         'enzyme': join(db_path, '%s-enzyme-annotations.txt' % func_prefix),
         'module': join(db_path, '%s-module-annotations.txt' % func_prefix),
@@ -108,46 +311,307 @@ def shogun_parse_enzyme_table(f):
     md = pd.read_csv(
         f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
     md.set_index(0, inplace=True)
-    metadata = {}
-    for i, row in md.iterrows():
-        metadata[i] = {'taxonomy': [x for x in row.values]}
+    # as with a dict built row by row, the last duplicated enzyme wins
+    metadata = {i: {'taxonomy': values}
+                for i, values in zip(md.index, md.values.tolist())}
     return(metadata)
 
 
 def shogun_parse_module_table(f):
     md = pd.read_csv(
         f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
-    metadata = {}
-    for i, row in md.iterrows():
-        module = row[4].split('  ')[0]
-        name = row[4].split('  ')[1]
-        if module not in metadata:
-            metadata[module] = {'taxonomy': [row[1], row[2], row[3], name]}
+    # column 4 is "<module>  <name>"
+    split = md[4].str.split('  ')
+    md['module'] = split.str[0]
+    md['name'] = split.str[1]
+    # keep the first row of each module
+    md.drop_duplicates('module', inplace=True)
+    metadata = {module: {'taxonomy': [c1, c2, c3, name]}
+                for module, c1, c2, c3, name in zip(
+                    md['module'], md[1], md[2], md[3], md['name'])}
     return(metadata)
 
 
 def shogun_parse_pathway_table(f):
     md = pd.read_csv(
         f, sep='\t', header=None, error_bad_lines=False, warn_bad_lines=False)
-    metadata = {}
-    for i, row in md.iterrows():
-        pathway = row[4]
-        if pathway not in metadata:
-            metadata[pathway] = {'taxonomy': [row[1], row[2], row[3]]}
+    # keep the first row of each pathway
+    md.drop_duplicates(4, inplace=True)
+    metadata = {pathway: {'taxonomy': [c1, c2, c3]}
+                for pathway, c1, c2, c3 in zip(md[4], md[1], md[2], md[3])}
     return(metadata)
 
 
+ANNOTATION_PARSERS = {'module': shogun_parse_module_table,
+                      'pathway': shogun_parse_pathway_table,
+                      'enzyme': shogun_parse_enzyme_table}
+
+# parsed annotation tables, keyed by _annotation_key
+_ANNOTATION_CACHE = {}
+
+# the number of ids looked up in the annotation index at a time, below
+# SQLite's limit of variables per statement
+ANNOTATION_LOOKUP_SIZE = 500
+
+
+def _annotation_key(f, annotation_type):
+    # The file is identified by its path, modification time and size
+    st = os.stat(f)
+    return (abspath(f), st.st_mtime_ns, st.st_size, annotation_type)
+
+
+def load_annotation_table(f, annotation_type):
+    """Parses an annotation table, caching the result
+
+    Parameters
+    ----------
+    f : str or file-like
+        The annotation table
+    annotation_type : {'module', 'pathway', 'enzyme'}
+        The parser to use
+
+    Returns
+    -------
+    dict
+        The observation metadata, as returned by the shogun_parse_*_table
+        functions
+
+    Notes
+    -----
+    Tables given by filepath are cached in memory, keyed on the table's
+    path, modification time and size, so they are only parsed again when
+    they change; the persistent cache is the index of lookup_annotations.
+    File-like objects are always parsed.
+    """
+    if not isinstance(f, str):
+        return ANNOTATION_PARSERS[annotation_type](f)
+
+    key = _annotation_key(f, annotation_type)
+    if key not in _ANNOTATION_CACHE:
+        _ANNOTATION_CACHE[key] = ANNOTATION_PARSERS[annotation_type](f)
+
+    return _ANNOTATION_CACHE[key]
+
+
+def _annotation_index_fps(f, annotation_type):
+    # Where the index of the table f is kept: next to the table or, when the
+    # database can't be written, in the plugin's cache directory, named
+    # after the table's path
+    f = abspath(f)
+    return [join(dirname(f), '.%s.%s.sqlite' % (basename(f), annotation_type)),
+            join(_registry_dir(), 'annotations.%s.%s.sqlite'
+                 % (sha256(f.encode()).hexdigest(), annotation_type))]
+
+
+def _write_annotation_index(index_fp, key, f, annotation_type):
+    # Writes the parsed table f, and the key of the version parsed, to the
+    # SQLite database index_fp
+    conn = sqlite3.connect(index_fp)
+    try:
+        with conn:
+            conn.execute('CREATE TABLE source (key TEXT)')
+            conn.execute('INSERT INTO source VALUES (?)', (dumps(key),))
+            conn.execute('CREATE TABLE annotations '
+                         '(id TEXT PRIMARY KEY, metadata TEXT) WITHOUT ROWID')
+            # only string ids can match the ids of a profile
+            conn.executemany(
+                'INSERT INTO annotations VALUES (?, ?)',
+                ((id_, dumps(md)) for id_, md in
+                 ANNOTATION_PARSERS[annotation_type](f).items()
+                 if isinstance(id_, str)))
+    finally:
+        conn.close()
+
+
+def _compile_annotation_index(index_fp, key, f, annotation_type):
+    # Compiles the index of the table f to index_fp; False if it can't be
+    # written
+    try:
+        os.makedirs(dirname(index_fp), exist_ok=True)
+        with NamedTemporaryFile(dir=dirname(index_fp), delete=False,
+                                prefix=basename(index_fp)) as tf:
+            pass
+    except OSError:
+        return False
+    # the temporary file never outlives a failed or interrupted compilation
+    try:
+        _write_annotation_index(tf.name, key, f, annotation_type)
+        os.replace(tf.name, index_fp)
+    except (OSError, sqlite3.Error):
+        os.remove(tf.name)
+        return False
+    except BaseException:
+        os.remove(tf.name)
+        raise
+
+    return True
+
+
+def _find_annotation_index(f, annotation_type):
+    # Returns the filepath of the index of the table f, which is compiled
+    # when it is missing or was compiled from a different version of the
+    # table; None if it can't be written anywhere
+    key = list(_annotation_key(f, annotation_type))
+    index_fps = _annotation_index_fps(f, annotation_type)
+    for index_fp in index_fps:
+        if not exists(index_fp):
+            continue
+        conn = sqlite3.connect(index_fp)
+        try:
+            row = conn.execute('SELECT key FROM source').fetchone()
+            if row is not None and loads(row[0]) == key:
+                return index_fp
+        except (sqlite3.DatabaseError, ValueError):
+            # corrupted or incomplete, compile it again
+            pass
+        finally:
+            conn.close()
+
+    for index_fp in index_fps:
+        if _compile_annotation_index(index_fp, key, f, annotation_type):
+            return index_fp
+
+    return None
+
+
+def compile_annotation_table(f, annotation_type):
+    """Compiles an annotation table into an SQLite index
+
+    Parameters
+    ----------
+    f : str
+        The annotation table
+    annotation_type : {'module', 'pathway', 'enzyme'}
+        The parser to use
+
+    Returns
+    -------
+    str or None
+        The index filepath, None if it can't be written
+
+    Notes
+    -----
+    The index is written next to the table or, if the database is read
+    only, to the directory of the database manifests (see QC_REGISTRY_DP).
+    It is only compiled again when the table's path, modification time or
+    size change, so this can be called before every lookup.
+    """
+    return _find_annotation_index(f, annotation_type)
+
+
+def lookup_annotations(f, annotation_type, ids):
+    """Returns the observation metadata of some ids of an annotation table
+
+    Parameters
+    ----------
+    f : str or file-like
+        The annotation table
+    annotation_type : {'module', 'pathway', 'enzyme'}
+        The parser to use
+    ids : iterable of str
+        The ids to look up
+
+    Returns
+    -------
+    dict
+        The metadata of the ids that are in the table, as returned by the
+        shogun_parse_*_table functions
+
+    Notes
+    -----
+    Tables given by filepath are looked up in their index (see
+    compile_annotation_table), so only the metadata of ids is read. If the
+    index can't be written anywhere the table is loaded whole by
+    load_annotation_table, as are file-like objects.
+    """
+    index_fp = None
+    if isinstance(f, str):
+        index_fp = _find_annotation_index(f, annotation_type)
+    if index_fp is None:
+        table = load_annotation_table(f, annotation_type)
+        return {id_: table[id_] for id_ in ids if id_ in table}
+
+    conn = sqlite3.connect(index_fp)
+    ids = list(ids)
+    metadata = {}
+    try:
+        for i in range(0, len(ids), ANNOTATION_LOOKUP_SIZE):
+            chunk = ids[i:i + ANNOTATION_LOOKUP_SIZE]
+            rows = conn.execute(
+                'SELECT id, metadata FROM annotations WHERE id IN (%s)'
+                % ', '.join('?' * len(chunk)), chunk)
+            metadata.update((id_, loads(md)) for id_, md in rows)
+    finally:
+        conn.close()
+
+    return metadata
+
+
+def read_shogun_profile(f):
+    """Reads a Shogun profile into a sparse matrix
+
+    Parameters
+    ----------
+    f : str or file-like
+        The profile, a TSV with a header of sample ids and one row per
+        observation
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        The counts, observations by samples
+    list of str
+        The observation ids
+    list of str
+        The sample ids
+
+    Notes
+    -----
+    The profile is read one row at a time and only the non-zero values of
+    each row are kept, so memory is proportional to the number of non-zero
+    values instead of the size of the full matrix. As rows are read in
+    order the CSR arrays are built directly.
+    """
+    if isinstance(f, str):
+        with open(f) as fh:
+            return read_shogun_profile(fh)
+
+    header = f.readline().rstrip('\r\n')
+    sample_ids = header.split('\t')[1:]
+
+    obs_ids = []
+    data = []
+    indices = []
+    indptr = [0]
+    for line in f:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        obs_id, _, values = line.partition('\t')
+        values = values.split('\t') if sample_ids else []
+        # most values are zeros, skip them before converting
+        columns = [i for i, v in enumerate(values) if v != '0']
+        row = np.array([values[i] for i in columns], dtype=float)
+        nonzero = row != 0
+        obs_ids.append(obs_id)
+        data.append(row[nonzero])
+        indices.append(np.array(columns, dtype=int)[nonzero])
+        indptr.append(indptr[-1] + len(data[-1]))
+
+    matrix = csr_matrix(
+        (np.concatenate(data) if data else np.zeros(0),
+         np.concatenate(indices) if indices else np.zeros(0, dtype=int),
+         np.array(indptr)),
+        shape=(len(obs_ids), len(sample_ids)))
+
+    return matrix, obs_ids, sample_ids
+
+
 def import_shogun_biom(f, annotation_table=None,
                        annotation_type=None, names_to_taxonomy=False):
-    import_funcs = {'module': shogun_parse_module_table,
-                    'pathway': shogun_parse_pathway_table,
-                    'enzyme': shogun_parse_enzyme_table}
-
-    table = pd.read_csv(f, sep='\t', index_col=0)
+    data, obs_ids, sample_ids = read_shogun_profile(f)
 
-    bt = Table(table.values,
-               observation_ids=list(map(str, table.index)),
-               sample_ids=list(map(str, table.columns)))
+    bt = Table(data, observation_ids=obs_ids, sample_ids=sample_ids)
 
     if names_to_taxonomy:
         metadata = {
@@ -155,7 +619,8 @@ def import_shogun_biom(f, annotation_table=None,
         bt.add_metadata(metadata, axis='observation')
 
     if annotation_table is not None:
-        metadata = import_funcs[annotation_type](annotation_table)
+        metadata = lookup_annotations(annotation_table, annotation_type,
+                                      bt.ids(axis='observation'))
         bt.add_metadata(metadata, axis='observation')
 
     return(bt)
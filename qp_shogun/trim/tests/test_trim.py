@@ -7,19 +7,26 @@
 # -----------------------------------------------------------------------------
 
 from unittest import main
-from os import close, remove, makedirs
-from os.path import exists, isdir, join, dirname
+from os import close, remove, makedirs, environ, listdir, utime
+from os.path import exists, isdir, join, dirname, basename
 from shutil import rmtree, copyfile
 from tempfile import mkstemp, mkdtemp
-from json import dumps
+from json import dumps, load
 from functools import partial
+from threading import Thread, Event
 
 from qiita_client.testing import PluginTestCase
 
 from qp_shogun import plugin
-from qp_shogun.trim.trim import (generate_trim_commands, trim)
+from qp_shogun.trim.trim import (
+    generate_trim_commands, trim, _parse_atropos_report)
 from qp_shogun.utils import (
-    _format_params, make_read_pairs_per_sample, _per_sample_ainfo)
+    _format_params, make_read_pairs_per_sample, _per_sample_ainfo,
+    _run_commands, _system_call_with_metrics, JobMetrics, METRICS_FN,
+    _cached_commands, _cache_results, get_registered_dbs,
+    get_registered_metadata, _allocate_threads, _CoreBudget,
+    _sample_read_stats, _write_read_stats, READ_STATS_FN, ProgressReporter,
+    _with_progress_reporter)
 import qp_shogun.trim as kd
 
 ATROPOS_PARAMS = {
@@ -188,6 +195,40 @@ class QC_TrimTests(PluginTestCase):
         with self.assertRaises(ValueError):
             make_read_pairs_per_sample(fwd_fp, rev_fp, fp)
 
+    def test_make_read_pairs_per_sample_errors(self):
+        fd, fp = mkstemp()
+        close(fd)
+        with open(fp, 'w') as f:
+            f.write('#SampleID\trun_prefix\n'
+                    'sample.1\ts1\n'
+                    'sample.2\ts1_S1\n'
+                    'sample.3\ts3_S3\n')
+        self._clean_up_files.append(fp)
+
+        obs = make_read_pairs_per_sample(
+            ['./folder/s3_S3_L001_R1.fastq.gz'], [], fp)
+        self.assertEqual(obs, [('s3_S3', 'sample.3',
+                                './folder/s3_S3_L001_R1.fastq.gz', None)])
+
+        with self.assertRaisesRegex(
+                ValueError, '^Multiple run prefixes match this fwd read: '
+                            's1_S1_L001_R1.fastq.gz$'):
+            make_read_pairs_per_sample(
+                ['./folder/s1_S1_L001_R1.fastq.gz'], [], fp)
+
+        with self.assertRaisesRegex(
+                ValueError, '^No run prefix matching this fwd read: '
+                            's4_S4_L001_R1.fastq.gz$'):
+            make_read_pairs_per_sample(
+                ['./folder/s4_S4_L001_R1.fastq.gz'], [], fp)
+
+        with self.assertRaisesRegex(
+                ValueError, '^This run prefix matches multiple fwd reads: '
+                            's3_S3$'):
+            make_read_pairs_per_sample(
+                ['./folder/s3_S3_L001_R1.fastq.gz',
+                 './folder/s3_S3_L002_R1.fastq.gz'], [], fp)
+
     def test_generate_trim_analysis_commands_forward_reverse(self):
         fd, fp = mkstemp()
         close(fd)
@@ -299,6 +340,407 @@ class QC_TrimTests(PluginTestCase):
              (od('1.SKB8.640193.R2.fastq.gz'), 'raw_reverse_seqs')]]
         self.assertEqual(exp_fps, obs_fps)
 
+    def _create_job(self):
+        # inserting new prep template
+        prep_info_dict = {'SKB7.640196': {'run_prefix': 'kd_test_1'}}
+        data = {'prep_info': dumps(prep_info_dict),
+                # magic #1 = testing study
+                'study': 1,
+                'data_type': 'Metagenomic'}
+        pid = self.qclient.post('/apitest/prep_template/', data=data)['prep']
+
+        # inserting artifacts
+        in_dir = mkdtemp()
+        self._clean_up_files.append(in_dir)
+        fp1_1 = join(in_dir, 'kd_test_1_R1.fastq.gz')
+        fp1_2 = join(in_dir, 'kd_test_1_R2.fastq.gz')
+        copyfile('support_files/kd_test_1_R1.fastq.gz', fp1_1)
+        copyfile('support_files/kd_test_1_R2.fastq.gz', fp1_2)
+        data = {
+            'filepaths': dumps([
+                (fp1_1, 'raw_forward_seqs'),
+                (fp1_2, 'raw_reverse_seqs')]),
+            'type': "per_sample_FASTQ",
+            'name': "Test QC_Trim artifact",
+            'prep': pid}
+        aid = self.qclient.post('/apitest/artifact/', data=data)['artifact']
+
+        self.params['input'] = aid
+        data = {'user': 'demo@microbio.me',
+                'command': dumps(['qp-shogun', '0.0.1', 'Atropos v1.1.15']),
+                'status': 'running',
+                'parameters': dumps(self.params)}
+        return self.qclient.post('/apitest/processing_job/', data=data)['job']
+
+    def test_run_commands_parallel(self):
+        jid = self._create_job()
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        commands = ['touch %s' % join(out_dir, str(i)) for i in range(5)]
+
+        success, msg = _run_commands(
+            self.qclient, jid, commands, 'Running (%d/5)', 'test', n_jobs=3)
+
+        self.assertTrue(success)
+        self.assertEqual("", msg)
+        for i in range(5):
+            self.assertTrue(exists(join(out_dir, str(i))))
+
+    def test_run_commands_parallel_error(self):
+        jid = self._create_job()
+        commands = ['true', 'echo "failed" 1>&2; false', 'true']
+
+        success, msg = _run_commands(
+            self.qclient, jid, commands, 'Running (%d/3)', 'test', n_jobs=2)
+
+        self.assertFalse(success)
+        self.assertEqual(
+            "Error running test:\nStd out: \nStd err: failed\n\n\n"
+            "Command run was:\necho \"failed\" 1>&2; false", msg)
+
+    def test_run_commands_outputs(self):
+        jid = self._create_job()
+        commands = ['echo out1; echo err1 1>&2', 'echo out2', 'false']
+        outputs = {}
+
+        success, msg = _run_commands(
+            self.qclient, jid, commands, 'Running (%d/3)', 'test',
+            outputs=outputs)
+
+        self.assertFalse(success)
+        self.assertEqual(outputs, {commands[0]: ('out1\n', 'err1\n'),
+                                   commands[1]: ('out2\n', '')})
+
+    def test_run_commands_core_budget(self):
+        jid = self._create_job()
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        commands = ['touch %s' % join(out_dir, str(i)) for i in range(5)]
+        threads = dict(zip(commands, [1, 3, 2, 8, 1]))
+
+        success, msg = _run_commands(
+            self.qclient, jid, commands, 'Running (%d/5)', 'test',
+            threads=threads, core_budget=4)
+
+        self.assertTrue(success)
+        self.assertEqual("", msg)
+        for i in range(5):
+            self.assertTrue(exists(join(out_dir, str(i))))
+
+        commands = ['true', 'echo "failed" 1>&2; false', 'true']
+        success, msg = _run_commands(
+            self.qclient, jid, commands, 'Running (%d/3)', 'test',
+            threads=dict.fromkeys(commands, 2), core_budget=2)
+        self.assertFalse(success)
+        self.assertEqual(
+            "Error running test:\nStd out: \nStd err: failed\n\n\n"
+            "Command run was:\necho \"failed\" 1>&2; false", msg)
+
+    def test_allocate_threads(self):
+        in_dir = mkdtemp()
+        self._clean_up_files.append(in_dir)
+        samples = []
+        for i, size in enumerate([300, 100, 0, 400]):
+            fp = join(in_dir, 's%d.fastq.gz' % i)
+            with open(fp, 'w') as f:
+                f.write('A' * size)
+            samples.append(('s%d' % i, 's%d' % i, fp, None))
+
+        # the budget is shared by size, mean size is 200
+        self.assertEqual(_allocate_threads(samples, 8), [3, 1, 1, 4])
+        self.assertEqual(_allocate_threads(samples, 16), [6, 2, 1, 8])
+        # more samples than cores, the large ones still get more threads
+        self.assertEqual(_allocate_threads(samples, 2), [2, 1, 1, 2])
+        # samples with both reads
+        self.assertEqual(
+            _allocate_threads([('s0', 's0', samples[0][2], samples[1][2]),
+                               ('s3', 's3', samples[3][2], None)], 8),
+            [4, 4])
+        self.assertEqual(_allocate_threads([], 8), [])
+
+    def test_core_budget(self):
+        budget = _CoreBudget(4)
+        self.assertTrue(budget.acquire(3))
+        self.assertEqual(budget.available, 1)
+
+        acquired = []
+        waiter = Thread(target=lambda: acquired.append(budget.acquire(2)))
+        waiter.start()
+        waiter.join(0.1)
+        # not enough cores until the first command finishes
+        self.assertTrue(waiter.is_alive())
+        budget.release(3)
+        waiter.join()
+        self.assertEqual(acquired, [True])
+        self.assertEqual(budget.available, 2)
+
+        # requests are capped to the budget
+        budget.release(2)
+        self.assertTrue(budget.acquire(10))
+        self.assertEqual(budget.available, 0)
+        budget.release(10)
+
+        budget.abort()
+        self.assertFalse(budget.acquire(1))
+
+    def test_progress_reporter(self):
+        class SlowClient(object):
+            url = 'https://localhost:21174'
+
+            def __init__(self):
+                self.steps = []
+                self.sending = Event()
+                self.release = Event()
+
+            def update_job_step(self, job_id, new_step):
+                self.sending.set()
+                self.release.wait()
+                if new_step == 'fail':
+                    raise ValueError('Qiita is down')
+                self.steps.append((job_id, new_step))
+
+        qclient = SlowClient()
+        progress = ProgressReporter(qclient, interval=60)
+        self.assertEqual(progress.url, qclient.url)
+        progress.update_job_step('job', 'fail')
+        qclient.sending.wait()
+        # Qiita is still busy with the first step, the rest are coalesced
+        # without waiting for it
+        for i in range(100):
+            progress.update_job_step('job', 'Step %d' % i)
+        self.assertEqual(qclient.steps, [])
+        # the step that failed is logged, the last step is sent on close,
+        # without waiting for the interval
+        with self.assertLogs('qp_shogun.utils', 'WARNING') as logs:
+            qclient.release.set()
+            progress.close()
+        self.assertEqual(qclient.steps, [('job', 'Step 99')])
+        self.assertEqual(logs.output, [
+            "WARNING:qp_shogun.utils:The step 'fail' of job job can't be "
+            "sent to Qiita: Qiita is down"])
+        progress.update_job_step('job', 'Finished')
+        self.assertEqual(qclient.steps[-1], ('job', 'Finished'))
+
+        @_with_progress_reporter
+        def command(qclient, job_id, parameters, out_dir):
+            qclient.update_job_step(job_id, 'Step 1 of 1')
+            raise RuntimeError('failed')
+
+        qclient = SlowClient()
+        qclient.release.set()
+        with self.assertRaises(RuntimeError):
+            command(qclient, 'job', {}, None)
+        self.assertEqual(qclient.steps, [('job', 'Step 1 of 1')])
+
+    def test_system_call_with_metrics(self):
+        std_out, std_err, return_value, metrics = _system_call_with_metrics(
+            'echo out; echo err 1>&2; exit 3')
+
+        self.assertEqual(std_out, 'out\n')
+        self.assertEqual(std_err, 'err\n')
+        self.assertEqual(return_value, 3)
+        self.assertEqual(metrics['command'], 'echo out; echo err 1>&2; exit 3')
+        self.assertEqual(metrics['return_value'], 3)
+        for key in ('wall_time', 'user_time', 'system_time', 'max_rss',
+                    'read_bytes', 'written_bytes'):
+            self.assertGreaterEqual(metrics[key], 0)
+        self.assertGreater(metrics['max_rss'], 0)
+
+    def test_run_commands_metrics(self):
+        jid = self._create_job()
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        metrics = JobMetrics()
+        metrics.stage('first')
+        success, msg = _run_commands(
+            self.qclient, jid, ['true', 'true'], 'Running (%d/2)', 'test',
+            n_jobs=2, metrics=metrics)
+        self.assertTrue(success)
+        metrics.stage('second')
+        success, msg = _run_commands(
+            self.qclient, jid, ['false'], 'Running (%d/1)', 'test',
+            metrics=metrics)
+        self.assertFalse(success)
+
+        fp = metrics.write(out_dir)
+        self.assertEqual(fp, join(out_dir, METRICS_FN))
+        with open(fp) as f:
+            obs = load(f)['stages']
+        self.assertEqual([s['name'] for s in obs], ['first', 'second'])
+        self.assertEqual([c['command'] for c in obs[0]['commands']],
+                         ['true', 'true'])
+        self.assertEqual([c['return_value'] for c in obs[1]['commands']],
+                         [1])
+        for stage in obs:
+            for key in ('wall_time', 'user_time', 'system_time', 'max_rss',
+                        'max_children_rss', 'read_bytes', 'written_bytes'):
+                self.assertGreaterEqual(stage[key], 0)
+        self.assertIn('details in %s' % METRICS_FN, metrics.summary())
+
+    def test_read_stats(self):
+        self.assertEqual(
+            _parse_atropos_report(ATROPOS_REPORT, ''),
+            {'reads_in': 2500, 'reads_out': 2436, 'bases_in': 1507000,
+             'bases_out': 1431218})
+        self.assertEqual(_parse_atropos_report('', 'error'), {})
+
+        samples = [('s1', 'SKB8.640193', 'fwd_1', 'rev_1'),
+                   ('s2', 'SKD8.640184', 'fwd_2', 'rev_2')]
+        # the second command didn't run, e.g. its results were cached
+        stats = _sample_read_stats(
+            ['cmd1', 'cmd2'], samples, {'cmd1': (ATROPOS_REPORT, '')},
+            _parse_atropos_report)
+        stats[0]['length_histogram'] = {151: 2400, 80: 36}
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        fp = _write_read_stats(out_dir, stats)
+        self.assertEqual(fp, join(out_dir, READ_STATS_FN))
+        with open(fp) as f:
+            obs = f.read()
+        self.assertEqual(
+            obs,
+            'sample\treads_in\treads_out\tbases_in\tbases_out\t'
+            'fraction_removed\tlength_histogram\n'
+            'SKB8.640193\t2500\t2436\t1507000\t1431218\t0.025600\t'
+            '80:36,151:2400\n'
+            'SKD8.640184\t\t\t\t\t\t\n')
+
+    def test_result_cache(self):
+        in_dir = mkdtemp()
+        out_dir = mkdtemp()
+        cache_dir = join(mkdtemp(), 'cache')
+        self._clean_up_files.extend([in_dir, out_dir, dirname(cache_dir)])
+        samples = []
+        for name, content in (('s1', 'a'), ('s2', 'b')):
+            fwd_fp = join(in_dir, '%s_R1.fastq.gz' % name)
+            with open(fwd_fp, 'w') as f:
+                f.write(content)
+            samples.append((name, name, fwd_fp, None))
+        suffixes = ['%s.R1.fastq.gz', '%s.R2.fastq.gz']
+        commands = ['cmd s1', 'cmd s2']
+
+        # disabled
+        self.assertEqual(_cached_commands(
+            commands, samples, out_dir, suffixes, 'QC_Trim', '-q 15'),
+            (commands, []))
+
+        environ['QC_RESULT_CACHE_DP'] = cache_dir
+        try:
+            # miss: the results are stored once the commands finish
+            obs, to_store = _cached_commands(
+                commands, samples, out_dir, suffixes, 'QC_Trim', '-q 15')
+            self.assertEqual(obs, commands)
+            self.assertEqual([fps for _, fps in to_store],
+                             [[join(out_dir, 's1.R1.fastq.gz'),
+                               join(out_dir, 's1.R2.fastq.gz')],
+                              [join(out_dir, 's2.R1.fastq.gz'),
+                               join(out_dir, 's2.R2.fastq.gz')]])
+            for name in ('s1', 's2'):
+                with open(join(out_dir, '%s.R1.fastq.gz' % name), 'w') as f:
+                    f.write('trimmed %s' % name)
+            _cache_results(to_store)
+            self.assertEqual(len(listdir(cache_dir)), 2)
+
+            # hit: the outputs are restored, even under another name
+            new_out_dir = mkdtemp()
+            self._clean_up_files.append(new_out_dir)
+            samples[1] = ('s3', 's3', samples[1][2], None)
+            obs, to_store = _cached_commands(
+                commands, samples, new_out_dir, suffixes, 'QC_Trim', '-q 15')
+            self.assertEqual((obs, to_store), ([], []))
+            self.assertEqual(sorted(listdir(new_out_dir)),
+                             ['s1.R1.fastq.gz', 's3.R1.fastq.gz'])
+            with open(join(new_out_dir, 's3.R1.fastq.gz')) as f:
+                self.assertEqual(f.read(), 'trimmed s2')
+
+            # the cache holds copies: rewriting the job's outputs in place,
+            # or restoring again over them, doesn't change it
+            with open(join(out_dir, 's1.R1.fastq.gz'), 'w') as f:
+                f.write('rewritten')
+            obs, _ = _cached_commands(
+                commands, samples, new_out_dir, suffixes, 'QC_Trim', '-q 15')
+            self.assertEqual(obs, [])
+            with open(join(new_out_dir, 's1.R1.fastq.gz')) as f:
+                self.assertEqual(f.read(), 'trimmed s1')
+
+            # other parameters are a miss
+            obs, to_store = _cached_commands(
+                commands, samples, out_dir, suffixes, 'QC_Trim', '-q 20')
+            self.assertEqual(obs, commands)
+
+            # eviction keeps the cache under its maximum size, and removes
+            # the partial entries of crashed jobs once they are stale
+            stale = mkdtemp(dir=cache_dir, prefix='.tmp_')
+            utime(stale, (0, 0))
+            recent = mkdtemp(dir=cache_dir, prefix='.tmp_')
+            environ['QC_RESULT_CACHE_MAX_GB'] = '0'
+            _cache_results(to_store[:1])
+            self.assertEqual(listdir(cache_dir), [basename(recent)])
+        finally:
+            del environ['QC_RESULT_CACHE_DP']
+            environ.pop('QC_RESULT_CACHE_MAX_GB', None)
+
+    def test_db_registry(self):
+        parent_dir = mkdtemp()
+        self._clean_up_files.append(parent_dir)
+        db_folder = join(parent_dir, 'dbs')
+        makedirs(join(db_folder, 'db_b'))
+        makedirs(join(db_folder, 'db_a'))
+        with open(join(db_folder, 'README'), 'w') as f:
+            f.write('not a database')
+
+        registry_dir = join(parent_dir, 'registry')
+        environ['QC_REGISTRY_DP'] = registry_dir
+        self.addCleanup(environ.pop, 'QC_REGISTRY_DP')
+
+        self.assertEqual(get_registered_dbs(db_folder), ['db_a', 'db_b'])
+        # the manifest is only written to the registry directory
+        self.assertEqual(sorted(listdir(parent_dir)), ['dbs', 'registry'])
+        self.assertEqual(len(listdir(registry_dir)), 1)
+        self.assertEqual(sorted(listdir(db_folder)),
+                         ['README', 'db_a', 'db_b'])
+
+        # adding a database changes the folder's mtime
+        makedirs(join(db_folder, 'db_c'))
+        utime(db_folder, ns=(0, 10 ** 9))
+        self.assertEqual(get_registered_dbs(db_folder),
+                         ['db_a', 'db_b', 'db_c'])
+
+        md_fp = join(db_folder, 'db_a', 'metadata.yaml')
+        with open(md_fp, 'w') as f:
+            f.write('function: a\n')
+        parsed = []
+
+        def parser(fp):
+            parsed.append(fp)
+            with open(fp) as f:
+                return f.read().split(':')[1].strip()
+
+        db_path = join(db_folder, 'db_a')
+        self.assertEqual(
+            get_registered_metadata(db_path, 'metadata.yaml', parser), 'a')
+        self.assertEqual(
+            get_registered_metadata(db_path, 'metadata.yaml', parser), 'a')
+        self.assertEqual(parsed, [md_fp])
+
+        with open(md_fp, 'w') as f:
+            f.write('function: b\n')
+        utime(md_fp, ns=(0, 10 ** 9))
+        self.assertEqual(
+            get_registered_metadata(db_path, 'metadata.yaml', parser), 'b')
+        self.assertEqual(parsed, [md_fp, md_fp])
+
+        # a manifest that can't be written is logged, not an error
+        rmtree(registry_dir)
+        with open(registry_dir, 'w') as f:
+            f.write('not a directory')
+        makedirs(join(db_folder, 'db_d'))
+        utime(db_folder, ns=(0, 2 * 10 ** 9))
+        with self.assertLogs('qp_shogun.utils', 'WARNING'):
+            self.assertEqual(get_registered_dbs(db_folder),
+                             ['db_a', 'db_b', 'db_c', 'db_d'])
+
     def test_per_sample_ainfo_error(self):
         in_dir = mkdtemp()
         self._clean_up_files.append(in_dir)
@@ -312,6 +754,24 @@ class QC_TrimTests(PluginTestCase):
                               'Atropos', 'QC_Trim Files', True)
 
 
+ATROPOS_REPORT = (
+    "=======\n"
+    "Trimming\n"
+    "=======\n\n"
+    "Pairs                                records fraction\n"
+    "----------------------------------- -------- --------\n"
+    "Total read pairs processed:            2,500\n"
+    "  Read 1 with adapter:                    89     3.6%\n"
+    "  Read 2 with adapter:                    83     3.3%\n"
+    "Pairs that were too short:                64     2.6%\n"
+    "Pairs written (passing filters):       2,436    97.4%\n\n"
+    "Base pairs                                 bp fraction\n"
+    "----------------------------------- --------- --------\n"
+    "Total basepairs processed:          1,507,000\n"
+    "  Read 1:                             753,500\n"
+    "  Read 2:                             753,500\n"
+    "Total written (filtered):           1,431,218    95.0%\n")
+
 MAPPING_FILE = (
     "#SampleID\tplatform\tbarcode\texperiment_design_description\t"
     "library_construction_protocol\tcenter_name\tprimer\trun_prefix\t"
@@ -7,9 +7,12 @@
 # -----------------------------------------------------------------------------
 
 from os.path import join
+from re import search
 from qp_shogun.utils import (
     _format_params, make_read_pairs_per_sample,
-    _run_commands, _per_sample_ainfo)
+    _run_commands, _per_sample_ainfo, _get_n_jobs, JobMetrics,
+    _cached_commands, _cache_results, _get_core_budget, _allocate_threads,
+    _sample_read_stats, _write_read_stats, _with_progress_reporter)
 
 ATROPOS_PARAMS = {
     'adapter': 'Fwd read adapter', 'A': 'Rev read adapter',
@@ -20,9 +23,17 @@ ATROPOS_PARAMS = {
     'trim-n': 'Trim Ns on ends of reads', 'threads': 'Number of threads used',
     'nextseq-trim': 'NextSeq-specific quality trimming'}
 
+# the lines of the atropos report with the read statistics, for single and
+# paired-end reads
+ATROPOS_REPORT_STATS = {
+    'reads_in': r'Total read(?: pair)?s processed:\s+([\d,]+)',
+    'reads_out': r'(?:Reads|Pairs) written \(passing filters\):\s+([\d,]+)',
+    'bases_in': r'Total basepairs processed:\s+([\d,]+)',
+    'bases_out': r'Total written \(filtered\):\s+([\d,]+)'}
+
 
 def generate_trim_commands(forward_seqs, reverse_seqs, map_file,
-                           out_dir, parameters):
+                           out_dir, parameters, core_budget=None):
     """Generates the QC_Trim commands
 
     Parameters
@@ -37,6 +48,9 @@ def generate_trim_commands(forward_seqs, reverse_seqs, map_file,
         The job output directory
     parameters : dict
         The command's parameters, keyed by parameter name
+    core_budget : int, optional
+        If given, the threads of each command are allocated from it with
+        _allocate_threads instead of taken from the parameters
 
     Returns
     -------
@@ -57,8 +71,14 @@ def generate_trim_commands(forward_seqs, reverse_seqs, map_file,
     cmds = []
 
     param_string = _format_params(parameters, ATROPOS_PARAMS)
-
-    for run_prefix, sample, f_fp, r_fp in samples:
+    if core_budget is not None:
+        threads = _allocate_threads(samples, core_budget)
+
+    for i, (run_prefix, sample, f_fp, r_fp) in enumerate(samples):
+        if core_budget is not None:
+            sample_params = dict(parameters)
+            sample_params['Number of threads used'] = str(threads[i])
+            param_string = _format_params(sample_params, ATROPOS_PARAMS)
         cmds.append('atropos trim %s -o %s -p %s -pe1 %s -pe2 %s'
                     % (param_string, join(out_dir, '%s.R1.fastq.gz' %
                        sample), join(out_dir, '%s.R2.fastq.gz' %
@@ -66,6 +86,22 @@ def generate_trim_commands(forward_seqs, reverse_seqs, map_file,
     return cmds, samples
 
 
+def _parse_atropos_report(std_out, std_err):
+    """Returns the read statistics in the report atropos writes to std out
+
+    Reads are counted as pairs for paired-end samples; the statistics that
+    are not in the report are left out.
+    """
+    stats = {}
+    for stat, pattern in ATROPOS_REPORT_STATS.items():
+        match = search(pattern, std_out)
+        if match is not None:
+            stats[stat] = int(match.group(1).replace(',', ''))
+
+    return(stats)
+
+
+@_with_progress_reporter
 def trim(qclient, job_id, parameters, out_dir):
     """Run Atropos with the given parameters
 
@@ -85,7 +121,10 @@ def trim(qclient, job_id, parameters, out_dir):
     bool, list, str
         The results of the job
     """
+    metrics = JobMetrics()
+
     # Step 1 get the rest of the information need to run Atropos
+    metrics.stage('Collecting information')
     qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
     artifact_id = parameters['input']
     del parameters['input']
@@ -100,26 +139,53 @@ def trim(qclient, job_id, parameters, out_dir):
     qiime_map = prep_info['qiime-map']
 
     # Step 2 generating command atropos
+    metrics.stage('Generating QC_Trim commands')
     qclient.update_job_step(job_id, "Step 2 of 4: Generating"
                                     " QC_Trim commands")
     rs = fps['raw_reverse_seqs'] if 'raw_reverse_seqs' in fps else []
+    core_budget = _get_core_budget()
     commands, samples = generate_trim_commands(fps['raw_forward_seqs'],
                                                rs, qiime_map, out_dir,
-                                               parameters)
+                                               parameters,
+                                               core_budget=core_budget)
+    threads = None
+    if core_budget is not None:
+        threads = dict(zip(commands,
+                           _allocate_threads(samples, core_budget)))
 
     # Step 3 execute atropos
+    metrics.stage('Executing QC_Trim')
+    suffixes = ['%s.R1.fastq.gz', '%s.R2.fastq.gz']
+    sample_cmds = commands
+    commands, to_store = _cached_commands(
+        commands, samples, out_dir, suffixes, 'QC_Trim',
+        _format_params(parameters, ATROPOS_PARAMS))
     len_cmd = len(commands)
     msg = "Step 3 of 4: Executing QC_Trim job (%d/{0})".format(len_cmd)
-    success, msg = _run_commands(qclient, job_id, commands, msg, 'QC_Trim')
+    outputs = {}
+    success, msg = _run_commands(qclient, job_id, commands, msg, 'QC_Trim',
+                                 n_jobs=_get_n_jobs(), metrics=metrics,
+                                 threads=threads, core_budget=core_budget,
+                                 outputs=outputs)
     if not success:
+        metrics.write(out_dir)
         return False, None, msg
+    _cache_results(to_store)
+    # the read statistics come from the atropos reports, so the outputs
+    # don't have to be read again
+    _write_read_stats(out_dir, _sample_read_stats(
+        sample_cmds, samples, outputs, _parse_atropos_report))
 
     # Step 4 generating artifacts
+    metrics.stage('Generating new artifacts')
     msg = "Step 4 of 4: Generating new artifacts (%d/{0})".format(len_cmd)
-    suffixes = ['%s.R1.fastq.gz', '%s.R2.fastq.gz']
     prg_name = 'Atropos'
     file_type_name = 'Adapter trimmed files'
     ainfo = _per_sample_ainfo(
         out_dir, samples, suffixes, prg_name, file_type_name, bool(rs))
 
+    metrics.write(out_dir)
+    qclient.update_job_step(
+        job_id, "Step 4 of 4: Finished, %s" % metrics.summary())
+
     return True, ainfo, ""
@@ -11,9 +11,39 @@
 # -----------------------------------------------------------------------------
 from qiita_client.util import system_call, get_sample_names_by_run_prefix
 from itertools import zip_longest
-from os.path import basename, join, exists
-from functools import partial
+from os import (environ, wait4, WIFEXITED, WEXITSTATUS, WTERMSIG, link,
+                listdir, makedirs, remove, rename, replace, stat, utime,
+                chmod)
+from os.path import (basename, join, exists, isdir, getsize, getmtime,
+                     abspath, dirname, expanduser)
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Condition, Thread
+from collections import deque
+from subprocess import Popen
+from tempfile import TemporaryFile, NamedTemporaryFile, mkdtemp
+from shutil import copyfile, rmtree
+from hashlib import sha256
+from time import perf_counter, time
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from json import dump, load
 from qiita_client import ArtifactInfo
+import logging
+
+METRICS_FN = 'resource_metrics.json'
+
+READ_STATS_FN = 'read_stats.tsv'
+READ_STATS_COLUMNS = ['sample', 'reads_in', 'reads_out', 'bases_in',
+                      'bases_out', 'fraction_removed', 'length_histogram']
+
+# seconds after which a partial result cache entry, left by a job that
+# crashed while storing it, is removed
+STALE_CACHE_ENTRY_AGE = 86400
+
+logger = logging.getLogger(__name__)
+
+# database registries, keyed by the absolute path of the databases folder
+_REGISTRIES = {}
 
 
 def make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file):
@@ -64,6 +94,10 @@ def make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file):
     # These are prefixes that should match uniquely to forward reads
     # sn_by_rp is dict of samples keyed by run prefixes
     sn_by_rp = get_sample_names_by_run_prefix(map_file)
+    # a file name can only match the prefixes of its first k characters, for
+    # every distinct prefix length k, so matching takes one lookup per length
+    # instead of one startswith per run prefix
+    rp_lengths = sorted(set(len(rp) for rp in sn_by_rp))
 
     # make pairings
     samples = []
@@ -73,19 +107,18 @@ def make_read_pairs_per_sample(forward_seqs, reverse_seqs, map_file):
         # fwd_fp is the fwd read filepath
         fwd_fn = basename(fwd_fp)
 
-        # iterate over run prefixes and make sure only one matches
-        run_prefix = None
-        for rp in sn_by_rp:
-            if fwd_fn.startswith(rp) and run_prefix is None:
-                run_prefix = rp
-            elif fwd_fn.startswith(rp) and run_prefix is not None:
-                raise ValueError('Multiple run prefixes match this fwd read: '
-                                 '%s' % fwd_fn)
+        # look up the run prefixes and make sure only one matches
+        matches = [fwd_fn[:k] for k in rp_lengths
+                   if k <= len(fwd_fn) and fwd_fn[:k] in sn_by_rp]
+        if len(matches) > 1:
+            raise ValueError('Multiple run prefixes match this fwd read: '
+                             '%s' % fwd_fn)
 
         # make sure that we got one matching run prefix:
-        if run_prefix is None:
+        if not matches:
             raise ValueError('No run prefix matching this fwd read: %s'
                              % fwd_fn)
+        run_prefix = matches[0]
 
         if run_prefix in used_prefixes:
             raise ValueError('This run prefix matches multiple fwd reads: '
@@ -134,19 +167,875 @@ def _format_params(parameters, func_params):
     return(param_string)
 
 
-def _run_commands(qclient, job_id, commands, msg, cmd_name):
-    for i, cmd in enumerate(commands):
-        qclient.update_job_step(job_id, msg % i)
-        std_out, std_err, return_value = system_call(cmd)
-        if return_value != 0:
-            error_msg = ("Error running %s:\nStd out: %s\nStd err: %s"
-                         "\n\nCommand run was:\n%s"
-                         % (cmd_name, std_out, std_err, cmd))
-            return False, error_msg
+def _get_n_jobs():
+    """Returns the number of commands that can run at the same time
+
+    Returns
+    -------
+    int
+        The value of the QC_PARALLEL_JOBS environment variable, 1 (i.e. run
+        serially) if it is not set
+    """
+    return max(1, int(environ.get('QC_PARALLEL_JOBS', 1)))
+
+
+def _get_core_budget():
+    """Returns the number of cores the commands of a job can use
+
+    Returns
+    -------
+    int or None
+        The value of the QC_CORE_BUDGET environment variable, None if it is
+        not set, in which case each command uses the threads in its
+        parameters and QC_PARALLEL_JOBS of them run at the same time
+    """
+    core_budget = environ.get('QC_CORE_BUDGET')
+    if not core_budget:
+        return None
+    return max(1, int(core_budget))
+
+
+def _allocate_threads(samples, core_budget):
+    """Splits a core budget between the commands of the samples
+
+    Parameters
+    ----------
+    samples : list of tup
+        The 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+    core_budget : int
+        The number of cores
+
+    Returns
+    -------
+    list of int
+        The threads of each sample's command
+
+    Notes
+    -----
+    Every sample gets its share of the budget, if all of them ran at the same
+    time (at least one thread), scaled by the size of its input relative to
+    the mean, so the large samples, which take the longest, get more threads
+    and the small ones fewer. No sample gets more than the budget.
+    """
+    if not samples:
+        return []
+    sizes = [sum(getsize(fp) for fp in (f_fp, r_fp) if fp is not None)
+             for _, _, f_fp, r_fp in samples]
+    share = max(1, core_budget // len(samples))
+    mean_size = sum(sizes) / len(sizes) or 1
+    return [min(core_budget, max(1, int(round(share * size / mean_size))))
+            for size in sizes]
+
+
+class _CoreBudget(object):
+    """Hands out cores to commands in the order they ask for them
+
+    Handing them out in order keeps the commands asking for many cores from
+    waiting forever behind the ones asking for fewer.
+    """
+
+    def __init__(self, cores):
+        self.cores = cores
+        self.available = cores
+        self.aborted = False
+        self._condition = Condition()
+        self._queue = deque()
+
+    def acquire(self, n):
+        """Waits for n cores, at most the budget; False if aborted"""
+        n = min(n, self.cores)
+        with self._condition:
+            ticket = object()
+            self._queue.append(ticket)
+            self._condition.wait_for(
+                lambda: self.aborted or (self._queue[0] is ticket and
+                                         self.available >= n))
+            self._queue.remove(ticket)
+            if not self.aborted:
+                self.available -= n
+            self._condition.notify_all()
+            return not self.aborted
+
+    def release(self, n):
+        with self._condition:
+            self.available += min(n, self.cores)
+            self._condition.notify_all()
+
+    def abort(self):
+        """Makes the waiting and future acquire calls return False"""
+        with self._condition:
+            self.aborted = True
+            self._condition.notify_all()
+
+
+def _usage_metrics(usage):
+    # ru_maxrss is in kilobytes and ru_inblock/ru_oublock in 512-byte blocks
+    return {'user_time': usage.ru_utime,
+            'system_time': usage.ru_stime,
+            'max_rss': usage.ru_maxrss * 1024,
+            'read_bytes': usage.ru_inblock * 512,
+            'written_bytes': usage.ru_oublock * 512}
+
+
+def _system_call_with_metrics(cmd):
+    """Runs cmd in a shell, like system_call, and measures its resources
+
+    Parameters
+    ----------
+    cmd : str
+        The command to run
+
+    Returns
+    -------
+    str, str, int, dict
+        The standard output, standard error, return value and the resource
+        usage of the command (and the processes it waited for): wall time,
+        user and system CPU time in seconds, peak RSS and the bytes read
+        and written to disk
+
+    Notes
+    -----
+    The peak RSS is the one reported by the kernel, which also counts the
+    memory of this process copied by the fork before the command started.
+    """
+    # the output goes to files so the process can be reaped with wait4,
+    # which is what returns its resource usage
+    with TemporaryFile('w+') as out_f, TemporaryFile('w+') as err_f:
+        start = perf_counter()
+        proc = Popen(cmd, universal_newlines=True, shell=True,
+                     stdout=out_f, stderr=err_f)
+        _, status, usage = wait4(proc.pid, 0)
+        wall_time = perf_counter() - start
+        if WIFEXITED(status):
+            return_value = WEXITSTATUS(status)
+        else:
+            return_value = -WTERMSIG(status)
+        proc.returncode = return_value
+
+        out_f.seek(0)
+        err_f.seek(0)
+        std_out = out_f.read()
+        std_err = err_f.read()
+
+    metrics = {'command': cmd, 'return_value': return_value,
+               'wall_time': wall_time}
+    metrics.update(_usage_metrics(usage))
+
+    return std_out, std_err, return_value, metrics
+
+
+class JobMetrics(object):
+    """Resource usage of the stages of a job and of the commands they run
+
+    Stages are consecutive: starting one finishes the previous one. The
+    usage of a stage is the one of this process plus the one of the
+    children it reaped while the stage was running; max_rss and
+    max_children_rss are the peaks of the job up to the end of the stage.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._start = None
+
+    def stage(self, name):
+        """Finishes the running stage, if any, and starts a new one
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage
+        """
+        self.finish()
+        self.stages.append({'name': name, 'commands': []})
+        self._start = (perf_counter(), getrusage(RUSAGE_SELF),
+                       getrusage(RUSAGE_CHILDREN))
+
+    def add_command(self, metrics):
+        """Adds the metrics of a command to the running stage
+
+        Parameters
+        ----------
+        metrics : dict
+            The metrics as returned by _system_call_with_metrics
+        """
+        self.stages[-1]['commands'].append(metrics)
+
+    def finish(self):
+        """Finishes the running stage, if any"""
+        if self._start is None:
+            return
+        start, self_start, children_start = self._start
+        self._start = None
+        stage = self.stages[-1]
+        stage['wall_time'] = perf_counter() - start
+        usage = _usage_metrics(getrusage(RUSAGE_SELF))
+        children = _usage_metrics(getrusage(RUSAGE_CHILDREN))
+        before = _usage_metrics(self_start)
+        children_before = _usage_metrics(children_start)
+        for key in ('user_time', 'system_time', 'read_bytes',
+                    'written_bytes'):
+            stage[key] = (usage[key] - before[key] +
+                          children[key] - children_before[key])
+        stage['max_rss'] = usage['max_rss']
+        stage['max_children_rss'] = children['max_rss']
+
+    def summary(self):
+        """Returns a one line summary of the usage of the whole job"""
+        self.finish()
+        wall_time = sum(s['wall_time'] for s in self.stages)
+        cpu_time = sum(s['user_time'] + s['system_time']
+                       for s in self.stages)
+        max_rss = max([0] + [max(s['max_rss'], s['max_children_rss'])
+                             for s in self.stages])
+        return ('%.1fs wall time, %.1fs CPU time, %.1f MB peak RSS; '
+                'details in %s' % (wall_time, cpu_time, max_rss / 1048576.,
+                                   METRICS_FN))
+
+    def write(self, out_dir):
+        """Finishes the running stage and writes the metrics as JSON
+
+        Parameters
+        ----------
+        out_dir : str
+            The directory where METRICS_FN is written
+
+        Returns
+        -------
+        str
+            The filepath of the metrics file
+        """
+        self.finish()
+        fp = join(out_dir, METRICS_FN)
+        with open(fp, 'w') as f:
+            dump({'stages': self.stages}, f, indent=4)
+
+        return(fp)
+
+
+class ProgressReporter(object):
+    """Sends the job step updates of a Qiita client from a background thread
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient
+        The Qiita server client
+    interval : float, optional
+        The minimum number of seconds between updates; QC_PROGRESS_INTERVAL,
+        or 5 if it is not set, by default
+
+    Notes
+    -----
+    update_job_step only records the step, so the job never waits for
+    Qiita. The thread sends the last step recorded as soon as it can and
+    then waits for the interval, so the steps recorded meanwhile are
+    coalesced into the last one. close sends the steps that are still
+    pending before returning, so the final step is never lost. Everything
+    else is passed through to qclient, so the reporter can be used in its
+    place.
+    """
+    def __init__(self, qclient, interval=None):
+        if interval is None:
+            interval = float(environ.get('QC_PROGRESS_INTERVAL', 5))
+        self._qclient = qclient
+        self._interval = interval
+        self._pending = {}
+        self._closed = False
+        self._cond = Condition()
+        self._thread = Thread(target=self._send_steps, daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self._qclient, name)
+
+    def update_job_step(self, job_id, new_step):
+        """Records the job's current step, to be sent to Qiita"""
+        with self._cond:
+            if not self._closed:
+                self._pending[job_id] = new_step
+                self._cond.notify()
+                return
+        # after close the steps are sent right away
+        self._qclient.update_job_step(job_id, new_step)
+
+    def _send_steps(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                steps = self._pending
+                self._pending = {}
+            for job_id, step in steps.items():
+                try:
+                    self._qclient.update_job_step(job_id, step)
+                except Exception as e:
+                    # the steps are informative, failing to send one
+                    # doesn't stop the job
+                    logger.warning('The step %r of job %s can\'t be sent to '
+                                   'Qiita: %s', step, job_id, e)
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed,
+                                    timeout=self._interval)
+
+    def close(self):
+        """Sends the pending steps and stops the thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+def _with_progress_reporter(command):
+    """Decorates a command so its step updates go through a ProgressReporter
+
+    The reporter replaces the command's qclient and is closed, sending the
+    last step, when the command returns or raises.
+    """
+    @wraps(command)
+    def reporting_command(qclient, job_id, parameters, out_dir):
+        progress = ProgressReporter(qclient)
+        try:
+            return command(progress, job_id, parameters, out_dir)
+        finally:
+            progress.close()
+    return reporting_command
+
+
+def _run_commands(qclient, job_id, commands, msg, cmd_name, n_jobs=1,
+                  metrics=None, threads=None, core_budget=None, outputs=None):
+    """Runs the commands, serially or through a pool of workers
+
+    Parameters
+    ----------
+    qclient : tgp.qiita_client.QiitaClient or ProgressReporter
+        The Qiita server client, or the reporter of its step updates so they
+        don't wait for Qiita
+    job_id : str
+        The job id
+    commands : list of str
+        The commands to run
+    msg : str
+        The step message, formatted with the number of finished commands
+    cmd_name : str
+        The name of the command, used in the error message
+    n_jobs : int, optional
+        The maximum number of commands running at the same time
+    metrics : JobMetrics, optional
+        If given, the resource usage of each command is added to it
+    threads : dict of {str: int}, optional
+        The cores used by each command, required by core_budget
+    core_budget : int, optional
+        If given, replaces n_jobs: commands start, in order of decreasing
+        threads, as long as the threads of the running commands fit in it
+    outputs : dict, optional
+        If given, the std out and std err of each command that succeeds are
+        added to it, keyed by command
+
+    Returns
+    -------
+    bool, str
+        Whether all the commands succeeded and the error message, if any
+
+    Notes
+    -----
+    When running in parallel the first failing command is reported and all
+    the commands that haven't started yet are cancelled; the ones that are
+    already running are allowed to finish.
+    """
+    budget = None
+    if core_budget is not None and len(commands) > 1:
+        budget = _CoreBudget(core_budget)
+        n_jobs = core_budget
+        # the commands using the most cores start first, so the small ones
+        # fill the cores left at the end
+        commands = sorted(commands, key=lambda cmd: -threads[cmd])
+
+    def run(cmd):
+        if metrics is None:
+            std_out, std_err, return_value = system_call(cmd)
+        else:
+            std_out, std_err, return_value, cmd_metrics = \
+                _system_call_with_metrics(cmd)
+            metrics.add_command(cmd_metrics)
+        if outputs is not None and return_value == 0:
+            outputs[cmd] = (std_out, std_err)
+        return std_out, std_err, return_value
+
+    def call(cmd):
+        if budget is None:
+            return run(cmd)
+        if not budget.acquire(threads[cmd]):
+            # another command failed, the result is ignored
+            return '', '', 0
+        try:
+            return run(cmd)
+        finally:
+            budget.release(threads[cmd])
+
+    if n_jobs <= 1 or len(commands) <= 1:
+        for i, cmd in enumerate(commands):
+            qclient.update_job_step(job_id, msg % i)
+            std_out, std_err, return_value = call(cmd)
+            if return_value != 0:
+                error_msg = ("Error running %s:\nStd out: %s\nStd err: %s"
+                             "\n\nCommand run was:\n%s"
+                             % (cmd_name, std_out, std_err, cmd))
+                return False, error_msg
+
+        return True, ""
+
+    qclient.update_job_step(job_id, msg % 0)
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(commands))) as pool:
+        futures = {pool.submit(call, cmd): cmd for cmd in commands}
+        for i, future in enumerate(as_completed(futures), 1):
+            std_out, std_err, return_value = future.result()
+            if return_value != 0:
+                for f in futures:
+                    f.cancel()
+                if budget is not None:
+                    budget.abort()
+                error_msg = ("Error running %s:\nStd out: %s\nStd err: %s"
+                             "\n\nCommand run was:\n%s"
+                             % (cmd_name, std_out, std_err, futures[future]))
+                return False, error_msg
+            qclient.update_job_step(job_id, msg % i)
 
     return True, ""
 
 
+def _sample_read_stats(commands, samples, outputs, parser):
+    """Collects the read statistics of each sample from its command's output
+
+    Parameters
+    ----------
+    commands : list of str
+        The per sample commands
+    samples : list of tup
+        The 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+        the commands were generated from, in the same order
+    outputs : dict of {str: (str, str)}
+        The std out and std err of the commands that ran, see _run_commands
+    parser : function
+        Returns the statistics, keyed by READ_STATS_COLUMNS, found in the std
+        out and std err of a command
+
+    Returns
+    -------
+    list of dict
+        The statistics of each sample; only the sample name for the ones
+        whose command didn't run, e.g. because their results were cached
+    """
+    stats = []
+    for cmd, (_, sample, _, _) in zip(commands, samples):
+        sample_stats = {'sample': sample}
+        if cmd in outputs:
+            sample_stats.update(parser(*outputs[cmd]))
+        stats.append(sample_stats)
+
+    return(stats)
+
+
+def _write_read_stats(out_dir, stats):
+    """Writes the per sample read statistics as a tab separated file
+
+    Parameters
+    ----------
+    out_dir : str
+        The directory where READ_STATS_FN is written
+    stats : list of dict
+        The statistics of each sample, keyed by READ_STATS_COLUMNS; the
+        missing ones are left empty. The length histogram is a dict with the
+        number of reads of each length, and the fraction of reads removed is
+        computed from the reads in and out
+
+    Returns
+    -------
+    str
+        The filepath of the statistics
+    """
+    fp = join(out_dir, READ_STATS_FN)
+    with open(fp, 'w') as f:
+        f.write('%s\n' % '\t'.join(READ_STATS_COLUMNS))
+        for sample_stats in stats:
+            row = dict(sample_stats)
+            if row.get('reads_in') and row.get('reads_out') is not None:
+                row['fraction_removed'] = '%.6f' % (
+                    1 - row['reads_out'] / row['reads_in'])
+            if 'length_histogram' in row:
+                row['length_histogram'] = ','.join(
+                    '%d:%d' % item
+                    for item in sorted(row['length_histogram'].items()))
+            f.write('%s\n' % '\t'.join(
+                str(row.get(column, '')) for column in READ_STATS_COLUMNS))
+
+    return(fp)
+
+
+def _get_result_cache():
+    """Returns the result cache settings
+
+    Returns
+    -------
+    str, int or None, None
+        The cache directory (QC_RESULT_CACHE_DP) and its maximum size in
+        bytes (QC_RESULT_CACHE_MAX_GB, 100 by default); None, None if the
+        cache is disabled, i.e. QC_RESULT_CACHE_DP is not set
+    """
+    cache_dir = environ.get('QC_RESULT_CACHE_DP')
+    if not cache_dir:
+        return None, None
+    max_size = float(environ.get('QC_RESULT_CACHE_MAX_GB', 100)) * 1024 ** 3
+    return cache_dir, int(max_size)
+
+
+def _checksum(fp):
+    """Returns the sha256 hexdigest of the contents of fp"""
+    checksum = sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(partial(f.read, 4194304), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _result_cache_key(cmd_name, param_string, fps):
+    """Returns the cache key of running cmd_name on fps
+
+    Parameters
+    ----------
+    cmd_name : str
+        The command name, e.g. QC_Trim
+    param_string : str
+        The command's parameters, as formatted by _format_params
+    fps : list of str or None
+        The input filepaths, None for missing files
+
+    Returns
+    -------
+    str
+        The sha256 hexdigest of the command, parameters and input checksums
+    """
+    parts = [cmd_name, param_string]
+    parts.extend('' if fp is None else _checksum(fp) for fp in fps)
+    return sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    # Only used to restore the read-only cached files; an existing dst is
+    # replaced rather than written through, which could reach the cache
+    if exists(dst):
+        remove(dst)
+    try:
+        link(src, dst)
+    except OSError:
+        copyfile(src, dst)
+
+
+def _restore_cached_results(cache_dir, key, out_fps):
+    """Restores the outputs of a cached command
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory
+    key : str
+        The cache key, from _result_cache_key
+    out_fps : list of str
+        The filepaths where the command writes its outputs, in order
+
+    Returns
+    -------
+    bool
+        Whether the key was cached and the outputs were restored
+    """
+    entry = join(cache_dir, key)
+    if not isdir(entry):
+        return False
+
+    restored = []
+    try:
+        for i, fp in enumerate(out_fps):
+            cached_fp = join(entry, str(i))
+            if exists(cached_fp):
+                _link_or_copy(cached_fp, fp)
+                restored.append(fp)
+        # mark the entry as recently used
+        utime(entry)
+    except OSError:
+        # the entry was evicted while restoring it
+        for fp in restored:
+            remove(fp)
+        return False
+
+    return True
+
+
+def _store_cached_results(cache_dir, key, out_fps):
+    """Adds the outputs of a command to the cache
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory
+    key : str
+        The cache key, from _result_cache_key
+    out_fps : list of str
+        The outputs of the command; the ones that don't exist are not
+        restored on a hit
+    """
+    makedirs(cache_dir, exist_ok=True)
+    # entries are created under a temporary name so other jobs never see a
+    # partial one
+    temp_entry = mkdtemp(dir=cache_dir, prefix='.tmp_')
+    # the outputs are copied, so the entry is a new inode that rewriting
+    # the job's files can't change, and made read-only as restores link it
+    for i, fp in enumerate(out_fps):
+        if exists(fp):
+            cached_fp = join(temp_entry, str(i))
+            copyfile(fp, cached_fp)
+            chmod(cached_fp, 0o444)
+    try:
+        rename(temp_entry, join(cache_dir, key))
+    except OSError:
+        # another job cached the same results
+        rmtree(temp_entry)
+
+
+def _evict_cached_results(cache_dir, max_size):
+    """Removes the least recently used entries until the cache fits max_size
+
+    Partial entries older than STALE_CACHE_ENTRY_AGE, left by jobs that
+    crashed while storing them, are removed too.
+    """
+    entries = []
+    total = 0
+    for name in listdir(cache_dir):
+        entry = join(cache_dir, name)
+        if name.startswith('.tmp_'):
+            try:
+                if time() - getmtime(entry) > STALE_CACHE_ENTRY_AGE:
+                    rmtree(entry, ignore_errors=True)
+            except OSError:
+                # stored by its job in the meantime
+                pass
+            continue
+        if name.startswith('.') or not isdir(entry):
+            continue
+        try:
+            size = sum(getsize(join(entry, fn)) for fn in listdir(entry))
+            entries.append((getmtime(entry), size, entry))
+        except OSError:
+            # evicted by another job
+            continue
+        total += size
+
+    for _, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def _cached_commands(commands, samples, out_dir, suffixes, cmd_name,
+                     param_string):
+    """Restores the cached results and returns the commands left to run
+
+    Parameters
+    ----------
+    commands : list of str
+        The per sample commands
+    samples : list of tup
+        The 4-tuples with run prefix, sample name, fwd read fp, rev read fp
+        the commands were generated from, in the same order
+    out_dir : str
+        The job output directory
+    suffixes : list of str
+        The output filenames of each sample, formatted with the sample name
+    cmd_name : str
+        The command name, part of the cache key
+    param_string : str
+        The formatted parameters, part of the cache key
+
+    Returns
+    -------
+    list of str
+        The commands whose results are not cached
+    list of (str, list of str)
+        The cache key and output filepaths of those commands, to store their
+        results with _cache_results once they succeed
+
+    Notes
+    -----
+    The cache is opt-in, see _get_result_cache; when it is disabled all the
+    commands are returned and there is nothing to store.
+    """
+    cache_dir, _ = _get_result_cache()
+    if cache_dir is None:
+        return commands, []
+
+    missing_commands = []
+    to_store = []
+    for cmd, (_, sample, fwd_fp, rev_fp) in zip(commands, samples):
+        key = _result_cache_key(cmd_name, param_string, [fwd_fp, rev_fp])
+        out_fps = [join(out_dir, suffix % sample) for suffix in suffixes]
+        if not _restore_cached_results(cache_dir, key, out_fps):
+            missing_commands.append(cmd)
+            to_store.append((key, out_fps))
+
+    return missing_commands, to_store
+
+
+def _cache_results(to_store):
+    """Stores the results of the commands returned by _cached_commands
+
+    Parameters
+    ----------
+    to_store : list of (str, list of str)
+        The cache keys and output filepaths returned by _cached_commands
+    """
+    cache_dir, max_size = _get_result_cache()
+    if cache_dir is None or not to_store:
+        return
+    for key, out_fps in to_store:
+        _store_cached_results(cache_dir, key, out_fps)
+    _evict_cached_results(cache_dir, max_size)
+
+
+def _registry_dir():
+    """Returns the directory of the database manifests
+
+    Returns
+    -------
+    str
+        The value of the QC_REGISTRY_DP environment variable, or qp-shogun
+        in the user's cache directory if it is not set
+    """
+    registry_dir = environ.get('QC_REGISTRY_DP')
+    if not registry_dir:
+        registry_dir = join(environ.get('XDG_CACHE_HOME') or
+                            join(expanduser('~'), '.cache'), 'qp-shogun')
+    return registry_dir
+
+
+def _registry_fp(db_folder):
+    # The manifest of each databases folder is named after its path, so the
+    # plugin never writes to the databases or their parent folder
+    return join(_registry_dir(), 'dbs.%s.json'
+                % sha256(abspath(db_folder).encode()).hexdigest())
+
+
+def _write_registry(db_folder, registry):
+    # Writes the manifest atomically; if it can't be written every process
+    # builds its own registry
+    registry_fp = _registry_fp(db_folder)
+    msg = 'The manifest of the databases in %s can\'t be written to %s: %s'
+    try:
+        makedirs(dirname(registry_fp), exist_ok=True)
+        f = NamedTemporaryFile('w', dir=dirname(registry_fp), delete=False,
+                               prefix='.tmp_', suffix='.json')
+    except OSError as e:
+        logger.warning(msg, db_folder, registry_fp, e)
+        return
+    try:
+        with f:
+            dump(registry, f)
+        chmod(f.name, 0o644)
+        replace(f.name, registry_fp)
+    except OSError as e:
+        remove(f.name)
+        logger.warning(msg, db_folder, registry_fp, e)
+    except BaseException:
+        remove(f.name)
+        raise
+
+
+def _get_registry(db_folder):
+    """Returns the registry of the databases in db_folder
+
+    Parameters
+    ----------
+    db_folder : str
+        The folder with one subfolder per database
+
+    Returns
+    -------
+    dict
+        The folder's mtime ('mtime'), the sorted names of the databases
+        ('dbs') and the cached metadata values of each database ('metadata')
+
+    Notes
+    -----
+    The registry is kept in memory and in a manifest file in the registry
+    directory (QC_REGISTRY_DP), and is rebuilt when db_folder's mtime
+    changes, i.e. when a database is added, removed or renamed; otherwise
+    only db_folder is stat'ed.
+    """
+    db_folder = abspath(db_folder)
+    mtime = stat(db_folder).st_mtime_ns
+    registry = _REGISTRIES.get(db_folder)
+    if registry is None or registry['mtime'] != mtime:
+        try:
+            with open(_registry_fp(db_folder)) as f:
+                registry = load(f)
+        except (OSError, ValueError):
+            registry = None
+        if registry is None or registry.get('mtime') != mtime:
+            dbs = sorted(folder for folder in listdir(db_folder)
+                         if isdir(join(db_folder, folder)))
+            registry = {'mtime': mtime, 'dbs': dbs, 'metadata': {}}
+            _write_registry(db_folder, registry)
+        _REGISTRIES[db_folder] = registry
+
+    return registry
+
+
+def get_registered_dbs(db_folder):
+    """Returns the names of the databases in db_folder
+
+    Parameters
+    ----------
+    db_folder : str
+        The folder with one subfolder per database
+
+    Returns
+    -------
+    list of str
+        The sorted names of the subfolders of db_folder
+    """
+    return list(_get_registry(db_folder)['dbs'])
+
+
+def get_registered_metadata(db_path, fn, parser):
+    """Returns a value parsed from a file of a database, through the registry
+
+    Parameters
+    ----------
+    db_path : str
+        The database folder
+    fn : str
+        The name of the file in db_path
+    parser : callable
+        Called with the file's path, returns the value to cache, which must
+        be JSON serializable
+
+    Returns
+    -------
+    object
+        The value returned by parser, which is only called again when the
+        file's mtime changes
+    """
+    db_path = abspath(db_path)
+    db_folder, db = dirname(db_path), basename(db_path)
+    fp = join(db_path, fn)
+    mtime = stat(fp).st_mtime_ns
+    registry = _get_registry(db_folder)
+    db_metadata = registry['metadata'].setdefault(db, {})
+    if fn not in db_metadata or db_metadata[fn][0] != mtime:
+        db_metadata[fn] = [mtime, parser(fp)]
+        _write_registry(db_folder, registry)
+
+    return db_metadata[fn][1]
+
+
 def _per_sample_ainfo(
         out_dir, samples, suffixes, prg_name,
         files_type_name, fwd_and_rev=False):
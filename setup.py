@@ -50,7 +50,7 @@ setup(name='qp-shogun',
             'shogun/databases/*']},
       scripts=['scripts/configure_shogun', 'scripts/start_shogun'],
       extras_require={'test': ["nose >= 0.10.1", "pep8"]},
-      install_requires=['click >= 3.3', 'future', 'pandas >= 0.15',
-                        'h5py >= 2.3.1', 'biom-format'],
+      install_requires=['click >= 3.3', 'future', 'pandas >= 0.15', 'numpy',
+                        'scipy', 'h5py >= 2.3.1', 'biom-format'],
       classifiers=classifiers
       )